@@ -8,6 +8,10 @@
     :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
     :license: BSD.
 """
+import os
+import sys
+import mmap
+from threading import Thread
 from warnings import warn
 
 from ponyguruma.constants import OPTION_NONE, ENCODING_ASCII, SYNTAX_DEFAULT
@@ -18,6 +22,21 @@ class RegexpWarning(RegexpError):
     __module__ = 'ponyguruma'
 
 
+class CompileErrors(RegexpError):
+    """
+    Raised by `compile_many` if patterns failed to compile.  `errors`
+    is a list of ``(index, pattern, exception)`` for all of them.
+    """
+    __module__ = 'ponyguruma'
+
+    def __init__(self, errors):
+        RegexpError.__init__(self, '%d of the patterns failed to compile, '
+                             'the first one is #%d %r: %s' % (
+                             len(errors), errors[0][0], errors[0][1],
+                             errors[0][2]))
+        self.errors = errors
+
+
 class CalculatedProperty(object):
 
     def __init__(self, func):
@@ -47,20 +66,54 @@ class Regexp(BaseRegexp):
 
     # __new__ signature:
     # def __new__(cls, pattern, flags=OPTION_NONE,
-    #             encoding=ENCODING_ASCII, syntax=SYNTAX_DEFAULT)
+    #             encoding=ENCODING_ASCII, syntax=SYNTAX_DEFAULT,
+    #             strict=False, lazy=False)
+    #
+    # If `lazy` is true the pattern is compiled when the regexp is used
+    # for the first time, so regexps defined at import time cost nothing
+    # until they are needed.  Errors in the pattern are raised by that
+    # first use in that case.
+    #
+    # Regexps created with the same arguments compare equal and share
+    # the compiled pattern, so compiling a pattern that is already in
+    # use elsewhere is cheap and costs no extra memory.
+    #
+    # If `strict` is true, matching a unicode pattern against a byte
+    # string (or the other way round) raises a `TypeError` instead of
+    # converting the string with the default encoding.
+    #
+    # Unicode patterns accept `ENCODING_UTF8` as encoding.  In that case
+    # the pattern and the strings are matched in their utf-8 encoding,
+    # which touches less memory for mostly-ascii text than the internal
+    # unicode representation.  Positions are still character offsets.
+    #
+    # The work a single match attempt may do can be bounded by setting
+    # the `retry_limit` and `match_stack_limit` attributes, or globally
+    # with `set_retry_limit` and `set_match_stack_limit`.  Exceeding a
+    # limit raises a `MatchLimitError`.
 
     def factory(cls, flags=OPTION_NONE, encoding=ENCODING_ASCII,
-                syntax=SYNTAX_DEFAULT):
+                syntax=SYNTAX_DEFAULT, strict=False, lazy=False):
         """
         Return a factory function that creates Regexp objects with a defined
         set of Oniguruma flags, encoding and syntax.
         """
         def create(pattern):
-            return cls(pattern, flags, encoding, syntax)
+            return cls(pattern, flags, encoding, syntax, strict, lazy)
         return create
     factory = classmethod(factory)
 
-    def match(self, string, pos=0, endpos=-1):
+    def prepare(self, string):
+        """
+        Convert `string` for matching with this regexp and return an
+        object that can be passed to all the matching methods instead
+        of the string.  Use this if you match the same string many
+        times so that the conversion and the offset index used for
+        character positions are only created once.
+        """
+        return regexp_subject(self, string)
+
+    def match(self, string, pos=0, endpos=-1, timeout=None, detached=False):
         """
         If zero or more characters at the beginning of `string` match
         the regular expression pattern, return a corresponding `Match`
@@ -73,12 +126,27 @@ class Regexp(BaseRegexp):
 
         **Note:** If you want to locate a match anywhere in `string`
         you should use `search` instead.
+
+        `timeout` can be a number of seconds or a `Deadline`.  If it
+        expires before matching is done a `MatchTimeout` is raised.  All
+        the other matching methods accept it too.  Searches with a
+        timeout run at full speed unless they backtrack a lot, those can
+        take two or three times as long as without one.
+
+        If `detached` is true the match is detached from the string
+        right away, see `Match.detach`.  `search` and `find` accept it
+        too.
         """
-        state = regexp_match(self, string, pos, endpos, True)
+        state = regexp_match(self, string, pos, endpos, True,
+                             _get_deadline(timeout))
         if state is not None:
+            if detached:
+                state = match_detach(state)
+            if _track_overhead:
+                return _timed_match(state)
             return Match(state)
 
-    def search(self, string, pos=0, endpos=-1):
+    def search(self, string, pos=0, endpos=-1, timeout=None, detached=False):
         """
         Scan through `string` looking for a location where the regular
         expression pattern produces a match, and return a corresponding
@@ -88,37 +156,170 @@ class Regexp(BaseRegexp):
 
         The pos and endpos parameters can be used to limit the search range.
         """
-        state = regexp_match(self, string, pos, endpos, False)
+        state = regexp_match(self, string, pos, endpos, False,
+                             _get_deadline(timeout))
+        if state is not None:
+            if detached:
+                state = match_detach(state)
+            if _track_overhead:
+                return _timed_match(state)
+            return Match(state)
+
+    def rsearch(self, string, pos=0, endpos=-1, timeout=None,
+                detached=False):
+        """
+        Like `search` but return the match that starts last between
+        `pos` and `endpos`.  The start positions are tried backwards
+        from `endpos`, so finding the last match in a big string or
+        mmap only costs time for the part after it.
+
+        Note that the match that starts last is not always the last
+        match `find` yields: ``\d+`` finds the last digit of a number,
+        use ``(?<!\d)\d+`` or anchors like ``^`` for whole numbers or
+        lines.
+        """
+        state = regexp_match(self, string, pos, endpos, False,
+                             _get_deadline(timeout), None, -1)
         if state is not None:
+            if detached:
+                state = match_detach(state)
+            if _track_overhead:
+                return _timed_match(state)
             return Match(state)
 
-    def find(self, string, pos=0, endpos=-1):
+    def find(self, string, pos=0, endpos=-1, timeout=None, detached=False):
         """
         Return an iterator yielding `Match` instances over all
         non-overlapping matches for the pattern in string.  Empty matches
         are included in the result unless they touch the beginning of
-        another match.
+        another match.  A timeout applies to the whole iteration.
         """
+        subject = regexp_subject(self, string)
+        deadline = _get_deadline(timeout)
         while 1:
-            state = regexp_match(self, string, pos, endpos, False)
+            state = regexp_match(self, subject, pos, endpos, False, deadline)
             if state is None:
                 return
-            m = Match(state)
+            if detached:
+                state = match_detach(state)
+            if _track_overhead:
+                m = _timed_match(state)
+            else:
+                m = Match(state)
             pos = m.end()
             yield m
 
-    def findstrings(self, string, pos=0, endpos=-1):
+    def rfind(self, string, pos=0, endpos=-1, timeout=None, detached=False):
+        """
+        Like `find` but yield the matches from the end of the string to
+        the start, for example to read the last entries of a log first.
+        The string is searched in blocks of a few kilobytes from the end,
+        every block like `find` would and up to the start of the matches
+        of the block after it.  In short strings this is `find`
+        backwards, in long ones a match can be cut at the start of a
+        block, so use anchors or lookbehind like ``(?<!\w)\w+`` if
+        that matters.
+        """
+        subject = regexp_subject(self, string)
+        deadline = _get_deadline(timeout)
+        last = -1
+        spans = []
+        while 1:
+            # the search also collects the spans of the matches in a
+            # block before the match, which are yielded backwards
+            del spans[:]
+            state = regexp_match(self, subject, pos, endpos, False,
+                                 deadline, None, last, spans)
+            if state is None:
+                return
+            found = match_get_groups(state)[0]
+            for start, end in reversed(spans):
+                if (start, end) != found:
+                    state = regexp_match(self, subject, start, endpos,
+                                         True, deadline)
+                if detached:
+                    state = match_detach(state)
+                if _track_overhead:
+                    yield _timed_match(state)
+                else:
+                    yield Match(state)
+            if spans[0][0] <= pos:
+                return
+            # the next block ends where the matches of this one start
+            endpos = spans[0][0]
+            last = endpos - 1
+
+    def findstrings(self, string, pos=0, endpos=-1, timeout=None):
         """
         Like find but yields the string value of the matches.
         """
-        for match in self.find(string, pos, endpos):
+        for match in self.find(string, pos, endpos, timeout):
             yield match.group()
 
-    def subn(self, repl, string, count=0, pos=0, endpos=-1):
+    def findspans(self, string, pos=0, endpos=-1, timeout=None):
+        """
+        Like find but yields the `spans` of the matches, a tuple with
+        a ``(start, end)`` tuple per group.  No match objects or
+        substrings are created, the spans can be used to slice the
+        string or a memoryview of it later.
+        """
+        subject = regexp_subject(self, string)
+        deadline = _get_deadline(timeout)
+        while 1:
+            state = regexp_match(self, subject, pos, endpos, False, deadline)
+            if state is None:
+                return
+            spans = match_get_groups(state)
+            pos = spans[0][1]
+            yield spans
+
+    def grep_lines(self, source, invert=False, count=False, timeout=None,
+                   encoding='utf-8'):
+        r"""
+        Search `source` line by line like grep and return an iterator
+        over ``(line_no, line_start, line_end, match)`` for the lines
+        with a match.  Line numbers start at one, `line_end` is the
+        offset of the newline.  `source` can be a string, an object
+        with the buffer interface like an mmap or a file.  The whole
+        file is mapped into memory if possible, unicode patterns read
+        and decode it with `encoding`.
+
+        Instead of one search per line a single search runs over the
+        whole buffer and only the lines with a match are looked up, so
+        lines without a match cost nothing in python.  A match that
+        runs over the end of its line is searched for again in the line
+        alone, like grep does for every line.  Otherwise ``\A`` and
+        ``\z`` refer to the whole buffer, ``^`` and ``$`` match at every
+        line anyway.
+
+        If `invert` is true the lines without a match are returned, with
+        `None` as match.  If `count` is true only the number of lines is
+        returned.
+        """
+        subject = regexp_subject(self, _grep_source(source, self,
+                                                    encoding))
+        lines = _grep_hits(self, subject, _get_deadline(timeout))
+        if count:
+            n = 0
+            for line in lines:
+                n += 1
+            if invert:
+                newlines, start, end = subject_find_line(subject, 0,
+                                                         subject.length)
+                n = newlines + (start < subject.length) - n
+            return n
+        if invert:
+            return _grep_inverted(subject, lines)
+        return lines
+
+    def subn(self, repl, string, count=0, pos=0, endpos=-1, timeout=None):
         """
         Perform the same operation as `sub()`, but return a tuple
         ``(new_string, number_of_subs_made)``.
         """
+        subject = regexp_subject(self, string)
+        string = _sliceable(subject.string)
+        deadline = _get_deadline(timeout)
         new = [string[:pos]]
         if not callable(repl):
             if '\\' in repl:
@@ -129,11 +330,14 @@ class Regexp(BaseRegexp):
             endpos = len(string)
         n = skipped = 0
         while 1:
-            state = regexp_match(self, string, pos, endpos, False)
+            state = regexp_match(self, subject, pos, endpos, False, deadline)
             if state is None:
                 break
             n += 1
-            m = Match(state)
+            if _track_overhead:
+                m = _timed_match(state)
+            else:
+                m = Match(state)
             startpos = m.start()
             new.append(string[pos - skipped:startpos])
             pos = m.end()
@@ -148,7 +352,7 @@ class Regexp(BaseRegexp):
         new.append(string[pos:])
         return ''.join(new), n
 
-    def sub(self, repl, string, count=0, pos=0, endpos=-1):
+    def sub(self, repl, string, count=0, pos=0, endpos=-1, timeout=None):
         r"""
         Return the string obtained by replacing the leftmost
         non-overlapping occurrences of the pattern in string by the
@@ -158,10 +362,15 @@ class Regexp(BaseRegexp):
         object instance and has to return a string.  Otherwise `repr`
         must be a string that can have group references (``\1`` or
         ``\g<name>``).
+
+        The string is converted to the type of the pattern once before
+        matching starts, so the return value is a unicode string for
+        unicode patterns and a byte string otherwise.
         """
-        return self.subn(repl, string, count, pos, endpos)[0]
+        return self.subn(repl, string, count, pos, endpos, timeout)[0]
 
-    def split(self, string, maxsplit=0, pos=0, endpos=-1, flat=False):
+    def split(self, string, maxsplit=0, pos=0, endpos=-1, flat=False,
+              timeout=None):
         """
         Split string by the occurrences of the pattern.  If capturing
         parentheses are used in pattern, then the text of all groups
@@ -175,16 +384,22 @@ class Regexp(BaseRegexp):
         `flat` to `True` the tuples will be merged into the list so that all
         groups become part of the result as strings.
         """
+        subject = regexp_subject(self, string)
+        string = _sliceable(subject.string)
+        deadline = _get_deadline(timeout)
         result = []
         startstring = string[:pos]
         n = 0
-        push_match = (flag and result.append or result.extend)
+        push_match = (flat and result.extend or result.append)
         while 1:
-            state = regexp_match(self, string, pos, endpos, False)
+            state = regexp_match(self, subject, pos, endpos, False, deadline)
             if state is None:
                 break
             n += 1
-            m = Match(state)
+            if _track_overhead:
+                m = _timed_match(state)
+            else:
+                m = Match(state)
             result.append(string[pos:m.start()])
             if len(m):
                 push_match(m.groups)
@@ -195,6 +410,33 @@ class Regexp(BaseRegexp):
         result[0] = startstring + result[0]
         return result
 
+    def stats(self, reset=False):
+        """
+        Return a dict with the statistics of this regexp: the number of
+        engine `calls`, `hits` and `misses`, the `bytes_scanned` and the
+        `engine_time` in seconds.  Statistics are only collected if the
+        `collect_stats` attribute is set or `set_collect_stats` enabled
+        them for all regexps.  If `reset` is true the counters are reset
+        to zero afterwards.
+        """
+        return regexp_stats(self, reset)
+
+    def profile(self, string, pos=0, endpos=-1, from_start=False):
+        """
+        Search `string` (or match it if `from_start` is true) once with
+        a copy of the pattern that has Oniguruma callouts at the start
+        of the pattern, of every group and of every alternative, and
+        return a `MatchProfile` with the number of times the engine
+        reached and backtracked over those positions.  This is slow and
+        meant for finding out why a pattern is slow.
+        """
+        pattern, offsets = _instrument_pattern(self.pattern)
+        profiler = regexp_profiler(self, pattern, len(offsets))
+        state = regexp_match(self, string, pos, endpos, from_start, None,
+                             profiler)
+        return MatchProfile(self, state is not None and Match(state) or None,
+                            offsets, profiler.counts)
+
     def __str__(self):
         return str(self.pattern)
 
@@ -205,8 +447,204 @@ class Regexp(BaseRegexp):
         return 'Regexp(%r)' % (self.pattern,)
 
 
+# true if set_overhead_tracking enabled the overhead histograms
+_track_overhead = False
+
+
+def _timed_match(state):
+    """Create a `Match` and record the time it took."""
+    start = overhead_timer()
+    match = Match(state)
+    overhead_record_wrap(overhead_timer() - start)
+    return match
+
+
+def _sliceable(string):
+    """Return a buffer of subjects that don't slice into strings."""
+    if isinstance(string, basestring):
+        return string
+    try:
+        return buffer(string)
+    except TypeError:
+        # memoryviews only have the new buffer interface
+        return string.tobytes()
+
+
+def _grep_source(source, regexp, encoding):
+    """Return the data of a source for `Regexp.grep_lines`."""
+    if not hasattr(source, 'read'):
+        return source
+    if not regexp.unicode_mode:
+        try:
+            fileno = source.fileno()
+            if os.fstat(fileno).st_size:
+                return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            pass
+    data = source.read()
+    if regexp.unicode_mode and isinstance(data, str):
+        data = data.decode(encoding)
+    return data
+
+
+def _grep_hits(regexp, subject, deadline):
+    """Yield the lines with a match for `Regexp.grep_lines`."""
+    pos = line_start = 0
+    line_no = 1
+    while 1:
+        state = regexp_match(regexp, subject, pos, -1, False, deadline)
+        if state is None:
+            return
+        spans = match_get_groups(state)
+        newlines, start, end = subject_find_line(subject, line_start,
+                                                 spans[0][0])
+        # there is no line after a newline at the end
+        if start == subject.length:
+            return
+        line_no += newlines
+        # search the line alone, the end of a string after a newline
+        # is no line start but an empty line has one
+        if spans[0][1] > end:
+            state = regexp_match(regexp, subject, spans[0][0], end, False,
+                                 deadline, None, None, None, start)
+        if state is not None:
+            if _track_overhead:
+                yield line_no, start, end, _timed_match(state)
+            else:
+                yield line_no, start, end, Match(state)
+        pos = line_start = end + 1
+        line_no += 1
+
+
+def _grep_inverted(subject, lines):
+    """Yield the lines without a match for `Regexp.grep_lines`."""
+    line_no = 1
+    pos = 0
+    for hit_no, hit_start, hit_end, match in lines:
+        while pos < hit_start:
+            newlines, start, end = subject_find_line(subject, pos, pos)
+            yield line_no, start, end, None
+            line_no += 1
+            pos = end + 1
+        line_no = hit_no + 1
+        pos = hit_end + 1
+    while pos < subject.length:
+        newlines, start, end = subject_find_line(subject, pos, pos)
+        yield line_no, start, end, None
+        line_no += 1
+        pos = end + 1
+
+
+def _get_deadline(timeout):
+    """Convert a timeout in seconds into a `Deadline`."""
+    if timeout is None or isinstance(timeout, Deadline):
+        return timeout
+    return Deadline(timeout)
+
+
+def _skip_class(pattern, pos):
+    """Return the position after the character class at `pos`."""
+    depth = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        pos += 1
+        if char == '\\':
+            pos += 1
+        elif char == '[':
+            depth += 1
+            if pattern[pos:pos + 1] == '^':
+                pos += 1
+            # a closing bracket at the start is a literal
+            if pattern[pos:pos + 1] == ']':
+                pos += 1
+        elif char == ']':
+            depth -= 1
+            if not depth:
+                break
+    return pos
+
+
+def _group_head(pattern, pos):
+    """
+    Return the position after the head of the group at `pos`, or -1 if
+    the parentheses only set options.
+    """
+    if not pattern.startswith('(?', pos):
+        return pos + 1
+    rest = pattern[pos + 2:pos + 4]
+    if rest[:1] in (':', '=', '!', '>', '~'):
+        return pos + 3
+    if rest in ('<=', '<!'):
+        return pos + 4
+    # named groups and conditions
+    for opening, closing in ('<', '>'), ("'", "'"), ('P<', '>'), ('(', ')'):
+        if rest.startswith(opening):
+            end = pattern.find(closing, pos + 2 + len(opening))
+            return end < 0 and len(pattern) or end + 1
+    end = pos + 2
+    while end < len(pattern) and pattern[end] not in ':)':
+        end += 1
+    if pattern[end:end + 1] == ')':
+        return -1
+    return end + 1
+
+
+def _instrument_pattern(pattern):
+    """
+    Insert numbered callouts at the start of the pattern and after every
+    group head and alternation bar.  Return the new pattern and the
+    offsets in the old pattern the callouts were inserted at.  Callouts
+    are not allowed in look-behind and absent groups, so their contents
+    are left alone.
+    """
+    result = []
+    offsets = []
+    # for every open group a flag that tells if callouts are forbidden
+    groups = []
+
+    def callout(offset):
+        if True not in groups:
+            result.append('(?{%d}X)' % len(offsets))
+            offsets.append(offset)
+
+    callout(0)
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        end = pos + 1
+        if char == '\\':
+            end += 1
+        elif char == '[':
+            end = _skip_class(pattern, pos)
+        elif char == ')':
+            if groups:
+                groups.pop()
+        elif char == '(' and pattern.startswith('(?#', pos):
+            end = pattern.find(')', pos) + 1 or len(pattern)
+        elif char == '(':
+            end = _group_head(pattern, pos)
+            if end < 0:
+                end = pattern.find(')', pos) + 1
+            else:
+                head = pattern[pos:end]
+                groups.append(head[:4] in ('(?<=', '(?<!') or
+                              head[:3] == '(?~')
+                result.append(head)
+                callout(end)
+                pos = end
+                continue
+        elif char == '|':
+            result.append(char)
+            callout(end)
+            pos = end
+            continue
+        result.append(pattern[pos:end])
+        pos = end
+    return type(pattern)().join(result), offsets
+
+
 # XXX: not expanding other escapes here... and do not replace \\1
-_repl_re = Regexp(r"\\(?:(\d+)|g<(.+?)>)")
+_repl_re = Regexp(r"\\(?:(\d+)|g<(.+?)>)", lazy=True)
 
 
 class Match(object):
@@ -226,6 +664,15 @@ class Match(object):
         return match_get_groups(self.state)
     spans = CalculatedProperty(spans)
 
+    def char_spans(self):
+        """
+        Like `spans` but with character instead of byte offsets for byte
+        strings in multibyte encodings.  The offset index needed for that
+        is shared by all matches on the same subject.
+        """
+        return match_get_char_groups(self.state)
+    char_spans = CalculatedProperty(char_spans)
+
     def groupnames(self):
         """
         A dict for name -> group_number.
@@ -300,6 +747,26 @@ class Match(object):
             group = self.groupnames[group]
         return self.spans[group]
 
+    def char_span(self, group=0):
+        """
+        The span of a single group in characters.  See `char_spans`.
+        """
+        if isinstance(group, basestring):
+            group = self.groupnames[group]
+        return self.char_spans[group]
+
+    def char_start(self, group=0):
+        """
+        Get the start position of a group in characters.
+        """
+        return self.char_span(group)[0]
+
+    def char_end(self, group=0):
+        """
+        Get the end position of a group in characters.
+        """
+        return self.char_span(group)[1]
+
     def start(self, group=0):
         """
         Get the start position of a group or the whole match if no
@@ -322,6 +789,37 @@ class Match(object):
             group = self.groupnames[group]
         return match_extract_group(self.state, group)
 
+    def group_view(self, group=0):
+        """
+        Return a memoryview of a group in the matched data instead of a
+        copy, or `None` if the group didn't match.  This works for byte
+        strings and objects with the buffer interface like `bytearray`
+        or `mmap`, a bytearray can't be resized while views of it exist.
+        An mmap has to stay open while its views are used.
+        Unicode subjects raise a `TypeError`, use `span` to slice those.
+        """
+        if isinstance(group, basestring):
+            group = self.groupnames[group]
+        return match_group_view(self.state, group)
+
+    def detach(self):
+        """
+        Replace the reference to the string this match was found in with
+        a copy of the part the groups cover and return the match.  Spans
+        and groups stay the same but `string` becomes `None`.  Use this
+        for matches that are kept around so that they don't keep a big
+        string alive.
+        """
+        self.state = match_detach(self.state)
+        return self
+
+    def detached(self):
+        """
+        True if the match was detached from its string.
+        """
+        return self.state.detached
+    detached = property(detached, doc=detached.__doc__)
+
     def re(self):
         """
         The regular expression object that created this match.
@@ -331,7 +829,8 @@ class Match(object):
 
     def string(self):
         """
-        The string this match object matches on.
+        The string this match object matches on or `None` if the match
+        was detached.
         """
         return self.state.string
     string = property(string, doc=re.__doc__)
@@ -392,6 +891,33 @@ class Match(object):
         )
 
 
+class MatchProfile(object):
+    """
+    The result of `Regexp.profile`.  `positions` is a list of
+    ``(offset, steps, backtracks)`` tuples for the profiled offsets in
+    the pattern, ordered so that the positions with the most
+    backtracking come first.  `steps` counts how often the engine
+    reached a position, `backtracks` how often it returned to it.
+    """
+    __module__ = 'ponyguruma'
+
+    def __init__(self, regexp, match, offsets, counts):
+        self.regexp = regexp
+        self.match = match
+        self.positions = [(offset, steps, backtracks) for offset,
+                          (steps, backtracks) in zip(offsets, counts)]
+        self.positions.sort(key=lambda item: (-item[2], -item[1], item[0]))
+        self.steps = sum([item[1] for item in self.positions])
+        self.backtracks = sum([item[2] for item in self.positions])
+
+    def __repr__(self):
+        return '<%s steps: %d, backtracks: %d>' % (
+            self.__class__.__name__,
+            self.steps,
+            self.backtracks
+        )
+
+
 class Scanner(object):
     """
     Simple regular expression based scanner.  This scanner keeps track
@@ -534,6 +1060,104 @@ def warn_func(message):
     warn(RegexpWarning(message), stacklevel=2)
 
 
+def slow_match_func(regexp, length, pos, endpos, elapsed):
+    """
+    Called from the C extension if a single engine call took longer than
+    the threshold set with `set_slow_match_threshold`.  It gets the
+    regexp, the length of the string, the search range and the elapsed
+    seconds.  Override `ponyguruma.slow_match_func` to log slow matches,
+    the default implementation ignores them.
+    """
+
+
+def stats_snapshot(reset=False):
+    """
+    Return a list of ``(regexp, stats)`` tuples for all living regexps
+    that collected statistics, ordered by the time spent in the engine.
+    The regexps using the most time come first.
+    """
+    result = [(regexp, regexp_stats(regexp, reset))
+              for regexp in get_stats_registry()]
+    result.sort(key=lambda item: item[1]['engine_time'], reverse=True)
+    return result
+
+
+def set_overhead_tracking(enabled):
+    """
+    Enable or disable recording where the time of matching calls goes.
+    The phases are argument parsing, type checks, the conversion of
+    the subject, the allocation of the match state, the engine itself
+    and, for `Regexp.match` and `Regexp.search`, the creation of the
+    `Match` object.  Tracking itself adds some overhead to every call.
+    """
+    global _track_overhead
+    overhead_set_tracking(enabled)
+    _track_overhead = bool(enabled)
+
+
+def get_overhead_histograms(reset=False):
+    """
+    Return a list of ``(phase, calls, total_seconds, buckets)`` tuples
+    with the recorded overhead.  ``buckets[n]`` is the number of calls
+    that spent between 2**n and 2**(n+1) nanoseconds in the phase.
+    """
+    return overhead_get_histograms(reset)
+
+
+def set_memory_tracking(enabled):
+    """
+    Enable or disable measuring how much memory oniguruma allocates for
+    the patterns compiled from now on.  The measurement uses the malloc
+    statistics of glibc and makes compiling a lot slower.  Measured
+    compiles hold the GIL so that other threads don't allocate in the
+    meantime, `compile_many` doesn't compile in parallel then.  Without
+    it, or on other platforms, the sizes are estimated from the length
+    of the patterns.
+    """
+    memory_set_tracking(enabled)
+
+
+def memory_report():
+    """
+    Return a dict with the number of live compiled programs, regexps,
+    subjects and match states and the bytes they use.  The keys are
+    ``programs``, ``regexps``, ``subjects`` and ``match_states`` with
+    the counts, the same with a ``_bytes`` suffix for the sizes and
+    ``total_bytes``.  ``measured_programs`` tells how many of the
+    program sizes were measured rather than estimated, see
+    `set_memory_tracking`.  The strings matched are not included, only
+    the copies made for matching them.
+    """
+    report = memory_get_counters()
+    report['total_bytes'] = sum([value for key, value in report.items()
+                                 if key.endswith('_bytes')])
+    return report
+
+
+def dump_overhead(file=None, reset=False):
+    """Write the overhead histograms in a readable form to `file`."""
+    if file is None:
+        file = sys.stdout
+    histograms = get_overhead_histograms(reset)
+    total = sum([item[2] for item in histograms]) or 1.0
+    file.write('%-10s %10s %12s %10s %7s\n' % ('phase', 'calls', 'total',
+                                               'mean', 'share'))
+    for phase, calls, seconds, buckets in histograms:
+        file.write('%-10s %10d %10.3fms %8.0fns %6.1f%%\n' % (
+            phase, calls, seconds * 1e3, calls and seconds / calls * 1e9,
+            seconds / total * 100))
+    for phase, calls, seconds, buckets in histograms:
+        if not calls:
+            continue
+        file.write('\n%s:\n' % phase)
+        peak = max(buckets)
+        for bucket, count in enumerate(buckets):
+            if count:
+                file.write('  %10dns - %10dns %10d %s\n' % (
+                    2 ** bucket, 2 ** (bucket + 1), count,
+                    '#' * int(40 * count / peak)))
+
+
 _special_escapes = {
     '\r':   '\\r',
     '\n':   '\\n',
@@ -547,16 +1171,66 @@ _special_escapes = {
 
 def escape(pattern):
     """Escape all non-alphanumeric characters in pattern."""
-    s = list(pattern)
-    for i, c in enumerate(s):
-        if not ('a' <= c <= 'z' or 'A' <= c <= 'Z' or '0' <= c <= '9'):
-            if c in _special_escapes:
-                s[i] = _special_escapes[c]
-            else:
-                s[i] = '\\' + c
-    return type(pattern)().join(s)
+    return escape_pattern(pattern, _special_escapes)
+
+
+def compile_many(specs, threads=4):
+    """
+    Compile a list of patterns on `threads` threads and return the
+    regexps in the same order.  Every item is a pattern or a tuple of
+    the `Regexp` arguments ``(pattern, flags, encoding, syntax)``.
+    Oniguruma compiles without holding the GIL, so large grammars are
+    compiled in parallel.  All patterns are compiled even if some fail,
+    a `CompileErrors` exception then reports all the errors.
+    """
+    regexps = []
+    errors = []
+    for index, spec in enumerate(specs):
+        if not isinstance(spec, tuple):
+            spec = (spec,)
+        try:
+            regexps.append(Regexp(lazy=True, *spec))
+        except (TypeError, RegexpError), err:
+            regexps.append(None)
+            errors.append((index, spec[0], err))
+    pending = [(index, regexp) for index, regexp in enumerate(regexps)
+               if regexp is not None]
+    pending.reverse()
+
+    def compile_pending():
+        # list.pop and list.append are atomic, no lock needed
+        while 1:
+            try:
+                index, regexp = pending.pop()
+            except IndexError:
+                return
+            try:
+                regexp_compile(regexp)
+            except RegexpError, err:
+                errors.append((index, regexp.pattern, err))
+
+    workers = [Thread(target=compile_pending) for x in
+               xrange(min(threads, len(pending)) - 1)]
+    for worker in workers:
+        worker.start()
+    compile_pending()
+    for worker in workers:
+        worker.join()
+    if errors:
+        errors.sort(key=lambda x: x[0])
+        raise CompileErrors(errors)
+    return regexps
 
 
 ALL_OBJECTS = ['Regexp', 'Scanner', 'Match', 'RegexpError',
-               'RegexpWarning', 'warn_func', 'escape']
+               'RegexpWarning', 'MatchLimitError', 'MatchTimeout',
+               'MatchProfile', 'CompileErrors',
+               'Deadline', 'warn_func', 'escape', 'compile_many',
+               'get_retry_limit', 'set_retry_limit',
+               'get_match_stack_limit', 'set_match_stack_limit',
+               'get_collect_stats', 'set_collect_stats', 'stats_snapshot',
+               'slow_match_func', 'get_slow_match_threshold',
+               'set_slow_match_threshold', 'set_overhead_tracking',
+               'get_overhead_histograms', 'dump_overhead',
+               'set_memory_tracking', 'memory_report']
 __all__ = ALL_OBJECTS + ['ALL_OBJECTS']
@@ -12,6 +12,15 @@
 #include "pyconfig.h"
 #include "oniguruma.h"
 #include <stdio.h>
+#ifdef __GLIBC__
+#  include <malloc.h>
+#endif
+#ifdef MS_WINDOWS
+#  include <windows.h>
+#else
+#  include <time.h>
+#  include <sys/time.h>
+#endif
 
 /* Calculate the proper encoding to use for Python Unicode strings */
 #if Py_UNICODE_SIZE == 2
@@ -30,23 +39,195 @@
 #  error "unsupported Py_UNICODE_SIZE"
 #endif
 
+/* per search retry and stack limits need oniguruma 6.8 */
+#if defined(ONIGURUMA_VERSION_INT) && ONIGURUMA_VERSION_INT >= 60800
+#  define HAVE_MATCH_PARAM
+#endif
+
+/* return code used if the deadline was reached */
+#define DEADLINE_EXPIRED (-10000)
+
+/* searches with a deadline run with a budget of retries and check the
+   deadline when it is used up.  such a search can't be resumed, so the
+   next one gets twice the budget as long as it should take less than an
+   eighth of the remaining time, or DEADLINE_LATENCY seconds if the
+   deadline only waits for a cancel.  otherwise the start positions are
+   tried one by one for as long as the search took before the next try.
+   single attempts run for at least DEADLINE_SLICE seconds */
+#if defined(HAVE_MATCH_PARAM) && defined(ONIGERR_RETRY_LIMIT_IN_SEARCH_OVER)
+#  define HAVE_SEARCH_BUDGET
+#endif
+#define DEADLINE_BUDGET 10000
+#define DEADLINE_LATENCY 0.05
+#define DEADLINE_SLICE 0.001
+
+/* oniguruma offsets are ints, so subjects beyond 2 GiB are matched in
+   windows.  a window starts a bit before the search position so that
+   lookbehinds see the data before it, and matches that start in the
+   last part of a window are searched again in the next one */
+#define WINDOW_CONTEXT 65536
+#define WINDOW_MARGIN (INT_MAX / 2)
+
+/* backward searches start with a block of this many bytes before the
+   start and double it until they find a match, rfind collects the
+   matches in this many bytes before every match it finds */
+#define BACKWARD_BLOCK 64
+#define RFIND_BLOCK 4096
+
+/* a compiled pattern, shared by all regexps with the same pattern,
+   flags, encoding and syntax */
 typedef struct {
-	PyObject_HEAD
 	regex_t *regex;
+	PyObject *key;			/* the key in the programs table */
+	Py_ssize_t users;		/* number of regexps using it */
+	Py_ssize_t size;		/* bytes oniguruma allocated for it */
+	int measured;			/* false if size is an estimate */
+} Program;
+
+typedef struct {
+	PyObject_HEAD
+	regex_t *regex;			/* NULL until a lazy regexp is used */
+	Program *program;		/* the program regex belongs to */
 	PyObject *pattern;
+	OnigOptionType options;
+	int encoding;			/* -1 for internal unicode */
+	int syntax;
 	int unicode;
+	int utf8;
+	int strict;
+	int search_anchor;		/* true if the pattern contains \G */
+	unsigned long retry_limit;	/* 0 means the global default */
+	unsigned long stack_limit;	/* 0 means the global default */
+#ifdef HAVE_MATCH_PARAM
+	OnigMatchParam *match_param;	/* NULL unless a limit is set */
+#endif
+	int collect_stats;		/* true if calls are counted */
+	int stats_registered;		/* true once in the stats registry */
+	PY_LONG_LONG calls;		/* number of engine calls */
+	PY_LONG_LONG hits;
+	PY_LONG_LONG misses;
+	PY_LONG_LONG bytes_scanned;	/* size of the ranges searched */
+	double engine_time;		/* seconds spent in the engine */
+	PyObject *literal;		/* the string a literal pattern matches */
+	PyObject *literal_data;		/* the literal in the subject encoding */
+	PyObject *required;		/* tuple of strings every match contains */
+	PyObject *required_data;	/* the same in the subject encoding */
+	PyObject *weakreflist;
 } BaseRegexp;
 
+/* number of bytes covered by one entry of a subject's offset index */
+#define INDEX_BLOCK_SIZE 256
+
+typedef struct {
+	PyObject_HEAD
+	PyObject *string;	/* the string converted for the regexp */
+	PyObject *encoded;	/* utf-8 encoding of string or NULL */
+	OnigEncoding enc;	/* the encoding of the buffer */
+	UChar *str;		/* the buffer oniguruma works on */
+	Py_ssize_t size;	/* size of the buffer in bytes */
+	Py_ssize_t length;	/* length of the string */
+	int single_byte;	/* true if every character is one byte */
+	Py_ssize_t last_byte;	/* last converted byte offset and the */
+	Py_ssize_t last_char;	/* character offset it corresponds to */
+	Py_ssize_t chars;	/* number of characters once indexed */
+	Py_ssize_t *index;	/* character offsets of the first character
+				   in each block of the buffer */
+	unsigned char *index_skip; /* the byte offsets of those characters
+				      relative to the block start */
+	Py_ssize_t accounted;	/* size counted in the memory report */
+	Py_buffer view;		/* the buffer of a bytearray or other object */
+	int has_view;		/* with the new buffer interface if true */
+	int old_buffer;		/* with the old buffer interface if true */
+} Subject;
+
 typedef struct {
 	PyObject_HEAD
 	BaseRegexp *regexp;
-	PyObject *string;
+	Subject *subject;
 	OnigRegion *region;
 	Py_ssize_t pos;
 	Py_ssize_t endpos;
+	Py_ssize_t accounted;	/* size counted in the memory report */
+	int detached;		/* true if subject is only the matched part */
+	Py_ssize_t byte_base;	/* offset of the matched part in the */
+	Py_ssize_t char_base;	/* original string in bytes and characters */
+	Py_ssize_t window;	/* byte offset the region is relative to */
 } MatchState;
 
+typedef struct {
+	PyObject_HEAD
+	double expires;		/* monotonic time or 0 for no timeout */
+	volatile int cancelled;
+} Deadline;
+
+typedef struct {
+	PyObject_HEAD
+	regex_t *regex;		/* the pattern with profiling callouts */
+	OnigSyntaxType syntax;	/* the syntax it was compiled with */
+	Py_ssize_t callouts;
+	unsigned long *progress;	/* how often each callout was */
+	unsigned long *retraction;	/* reached and backtracked over */
+} Profiler;
+
 static PyObject *RegexpError;
+static PyObject *MatchLimitError;
+static PyObject *MatchTimeout;
+
+/* statistics are collected for all regexps if true.  the registry
+   holds weak references to the regexps that have statistics, the
+   references of dead regexps are dropped once it reaches the limit */
+static int collect_all_stats = 0;
+static PyObject *stats_registry;
+static Py_ssize_t stats_registry_limit = 64;
+
+/* maps the keys of compiled regexps to capsules of their programs */
+static PyObject *programs;
+
+/* live objects and their sizes for the memory report.  oniguruma has
+   no way to tell how big a program is, if memory tracking is enabled
+   the malloc statistics are checked before and after compiling,
+   otherwise the size is estimated from the length of the pattern */
+static int track_memory = 0;
+static Py_ssize_t live_regexps = 0;
+static Py_ssize_t regexp_bytes = 0;
+static Py_ssize_t live_subjects = 0;
+static Py_ssize_t subject_bytes = 0;
+static Py_ssize_t live_states = 0;
+static Py_ssize_t state_bytes = 0;
+#define PROGRAM_SIZE_ESTIMATE(pattern_size) (512 + 8 * (pattern_size))
+/* engine calls taking longer than this many seconds are reported to
+   ponyguruma.slow_match_func.  0 disables the reports */
+static double slow_match_threshold = 0.0;
+
+/* if overhead tracking is enabled the time regexp_match spends in its
+   phases is recorded in histograms with power of two nanosecond
+   buckets.  the wrap phase is the creation of the Match object which
+   the _highlevel module reports */
+enum {
+	OVERHEAD_PARSE,
+	OVERHEAD_TYPECHECK,
+	OVERHEAD_SUBJECT,
+	OVERHEAD_REGION,
+	OVERHEAD_ENGINE,
+	OVERHEAD_WRAP,
+	OVERHEAD_PHASES
+};
+#define OVERHEAD_BUCKETS 40
+
+typedef struct {
+	PY_LONG_LONG count;
+	double total;
+	PY_LONG_LONG buckets[OVERHEAD_BUCKETS];
+} Histogram;
+
+static const char *overhead_phases[OVERHEAD_PHASES] = {
+	"parse", "typecheck", "subject", "region", "engine", "wrap"
+};
+static Histogram overhead[OVERHEAD_PHASES];
+static int track_overhead = 0;
+
+/* true for the ascii characters escape() doesn't escape */
+static char escape_plain[128];
 
 
 /**
@@ -99,6 +280,50 @@ get_onig_encoding(int encoding)
 	}
 }
 
+/**
+ * A monotonic clock in seconds.
+ */
+static double
+monotonic_time(void)
+{
+#ifdef MS_WINDOWS
+	LARGE_INTEGER freq, now;
+	QueryPerformanceFrequency(&freq);
+	QueryPerformanceCounter(&now);
+	return (double)now.QuadPart / (double)freq.QuadPart;
+#elif defined(CLOCK_MONOTONIC)
+	struct timespec ts;
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return ts.tv_sec + ts.tv_nsec * 1e-9;
+#else
+	struct timeval tv;
+	gettimeofday(&tv, NULL);
+	return tv.tv_sec + tv.tv_usec * 1e-6;
+#endif
+}
+
+
+/**
+ * Add a duration to the overhead histogram of a phase.  Bucket n counts
+ * durations from 2**n up to 2**(n+1) nanoseconds.
+ */
+static void
+record_overhead(int phase, double seconds)
+{
+	Histogram *histogram = &overhead[phase];
+	double ns = seconds * 1e9;
+	int bucket = 0;
+
+	while (ns >= 2.0 && bucket < OVERHEAD_BUCKETS - 1) {
+		ns /= 2.0;
+		bucket++;
+	}
+	histogram->count++;
+	histogram->total += seconds;
+	histogram->buckets[bucket]++;
+}
+
+
 /**
  * Like get_onig_encoding, but for the syntax.
  */
@@ -149,485 +374,3887 @@ init_python_syntax(void)
 
 
 /**
- * Create a new Regexp object.
+ * Check if a pattern contains the \G anchor.  It matches at the start
+ * position of a search, so searches for such patterns can't be split
+ * into slices.
  */
-static PyObject *
-BaseRegexp_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+static int
+has_search_anchor(PyObject *pattern)
 {
-	PyObject *pattern;
-	int ienc = -1, isyn = 10, rv;
-	OnigOptionType options = ONIG_OPTION_NONE;
-	OnigSyntaxType *syn;
-	OnigEncodingType *enc;
-	UChar *pstr, *pend;
-	OnigErrorInfo einfo;
-	BaseRegexp *self;
-	static char *kwlist[] = {"pattern", "flags", "encoding", "syntax", NULL};
-
-	self = (BaseRegexp *)type->tp_alloc(type, 0);
-	if (!self)
-		return NULL;
-	/* Initialize them in case __new__ fails. */
-	self->regex = NULL;
-	self->pattern = NULL;
+	Py_ssize_t i, n;
 
-	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|iii:BaseRegexp", kwlist,
-					 &pattern, &options, &ienc, &isyn)) {
-		Py_DECREF(self);
-		return NULL;
-	}
 	if (PyUnicode_Check(pattern)) {
-		if (ienc != -1) {
-			PyErr_SetString(PyExc_TypeError, "an encoding can "
-					"only be given for non-unicode patterns");
-			Py_DECREF(self);
-			return NULL;
-		}
-		enc = UNICODE_ENCODING;
-		pstr = (UChar *) PyUnicode_AS_UNICODE(pattern);
-		pend = pstr + (PyUnicode_GET_SIZE(pattern) * sizeof(PY_UNICODE_TYPE));
-		self->unicode = 1;
-	}
-	else if (PyString_Check(pattern)) {
-		if (ienc == -1) ienc = 0;
-		enc = get_onig_encoding(ienc);
-		pstr = (UChar *) PyString_AS_STRING(pattern);
-		pend = pstr + PyString_GET_SIZE(pattern);
-		self->unicode = 0;
+		Py_UNICODE *s = PyUnicode_AS_UNICODE(pattern);
+		n = PyUnicode_GET_SIZE(pattern);
+		for (i = 0; i < n - 1; i++)
+			if (s[i] == '\\' && s[++i] == 'G')
+				return 1;
 	}
 	else {
-		PyErr_SetString(PyExc_TypeError, "pattern must be string or unicode");
-		Py_DECREF(self);
-		return NULL;
-	}
-	/* Got to keep a reference to the pattern string */
-	Py_INCREF(pattern);
-	self->pattern = pattern;
-
-	/* XXX: check for invalid values? */
-	syn = get_onig_syntax(isyn);
-
-	rv = onig_new(&(self->regex), pstr, pend, options, enc, syn, &einfo);
-
-	if (rv != ONIG_NORMAL) {
-		UChar s[ONIG_MAX_ERROR_MESSAGE_LEN];
-		onig_error_code_to_str(s, rv, &einfo);
-		PyErr_SetString(RegexpError, (char *)s);
-		Py_DECREF(self);
-		return NULL;
+		char *s = PyString_AS_STRING(pattern);
+		n = PyString_GET_SIZE(pattern);
+		for (i = 0; i < n - 1; i++)
+			if (s[i] == '\\' && s[++i] == 'G')
+				return 1;
 	}
-
-	return (PyObject *)self;
+	return 0;
 }
 
+
 /**
- * oniguruma requires that we free the regex object.
+ * Get the character an escape of c stands for or -1 if it's not a
+ * simple escape.  next is the character after c or -1.
  */
-static void
-BaseRegexp_dealloc(BaseRegexp *self)
+static long
+simple_escape(unsigned long c, long next)
 {
-	if (self->regex)
-		onig_free(self->regex);
-	Py_XDECREF(self->pattern);
-	self->ob_type->tp_free((PyObject *)self);
+	switch (c) {
+	case 'n': return '\n';
+	case 't': return '\t';
+	case 'r': return '\r';
+	case 'f': return '\f';
+	case '0':
+		/* \0 followed by digits is an octal escape */
+		return (next >= '0' && next <= '7') ? -1 : 0;
+	}
+	if (c >= 128 || escape_plain[c])
+		return -1;
+	return c;
 }
 
+
 /**
- * read only property for the unicode flag.
+ * Helpers for looking at str and unicode patterns.
  */
-static PyObject *
-BaseRegexp_getunicode(BaseRegexp *self, void *closure)
-{
-	return PyBool_FromLong(self->unicode);
-}
+#define PATTERN_LENGTH(pattern, unicode) ((unicode) \
+	? PyUnicode_GET_SIZE(pattern) : PyString_GET_SIZE(pattern))
+#define PATTERN_CHAR(pattern, unicode, i) ((unicode) \
+	? (unsigned long)PyUnicode_AS_UNICODE(pattern)[i] \
+	: (unsigned long)(unsigned char)PyString_AS_STRING(pattern)[i])
 
 static PyObject *
-BaseRegexp_getpattern(BaseRegexp *self, void *closure)
+string_from_chars(int unicode, unsigned long *chars, Py_ssize_t length)
 {
-	Py_INCREF(self->pattern);
-	return self->pattern;
+	PyObject *rv;
+	Py_ssize_t i;
+
+	if (unicode) {
+		rv = PyUnicode_FromUnicode(NULL, length);
+		if (rv)
+			for (i = 0; i < length; i++)
+				PyUnicode_AS_UNICODE(rv)[i] = (Py_UNICODE)chars[i];
+	}
+	else {
+		rv = PyString_FromStringAndSize(NULL, length);
+		if (rv)
+			for (i = 0; i < length; i++)
+				PyString_AS_STRING(rv)[i] = (char)chars[i];
+	}
+	return rv;
 }
 
+
+/**
+ * Get the string matched by a pattern without metacharacters or NULL.
+ * Besides escaped punctuation only the escapes escape() generates are
+ * understood, everything else is left to the engine.
+ */
+#define LITERAL_OPTIONS (ONIG_OPTION_MULTILINE | ONIG_OPTION_SINGLELINE | \
+			 ONIG_OPTION_NEGATE_SINGLELINE | \
+			 ONIG_OPTION_CAPTURE_GROUP | \
+			 ONIG_OPTION_DONT_CAPTURE_GROUP)
+
 static PyObject *
-BaseRegexp_getflags(BaseRegexp *self, void *closure)
+get_literal(PyObject *pattern, int isyn)
 {
-	return PyInt_FromLong(onig_get_options(self->regex));
-}
+	Py_ssize_t i, n, length = 0;
+	unsigned long c, *buffer;
+	long e;
+	int unicode = PyUnicode_Check(pattern);
+	PyObject *rv = NULL;
 
-static PyGetSetDef BaseRegexp_getsetters[] = {
-	{"unicode_mode", (getter)BaseRegexp_getunicode, NULL,
-	 "True if the pattern is in unicode mode.", NULL},
-	{"pattern", (getter)BaseRegexp_getpattern, NULL,
-	 "the pattern string the Regexp was built from.", NULL},
-	{"flags", (getter)BaseRegexp_getflags, NULL,
-	 "the flags the Regexp was built with.", NULL},
-	{NULL}
-};
+#define CHAR_AT(i) PATTERN_CHAR(pattern, unicode, i)
 
+	n = PATTERN_LENGTH(pattern, unicode);
+	if (n == 0)
+		return NULL;
+	/* ASIS has no metacharacters, only perl like syntaxes are parsed */
+	if (isyn == 0) {
+		Py_INCREF(pattern);
+		return pattern;
+	}
+	if (isyn < 6)
+		return NULL;
 
-static PyTypeObject BaseRegexpType = {
-	PyObject_HEAD_INIT(NULL)
-	0,				/* ob_size */
-	"ponyguruma._lowlevel.BaseRegexp", /* tp_name */
-	sizeof(BaseRegexp),		/* tp_basicsize */
-	0,				/* tp_itemsize */
-	(destructor)BaseRegexp_dealloc,	/* tp_dealloc */
-	0,				/* tp_print */
-	0,				/* tp_getattr */
-	0,				/* tp_setattr */
-	0,				/* tp_compare */
-	0,				/* tp_repr */
-	0,				/* tp_as_number */
-	0,				/* tp_as_sequence */
-	0,				/* tp_as_mapping */
-	0,				/* tp_hash */
-	0,				/* tp_call */
-	0,				/* tp_str */
-	0,				/* tp_getattro */
-	0,				/* tp_setattro */
-	0,				/* tp_as_buffer */
-	Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
-	"",				/* tp_doc */
-	0,				/* tp_traverse */
-	0,				/* tp_clear */
-	0,				/* tp_richcompare */
-	0,				/* tp_weaklistoffset */
-	0,				/* tp_iter */
-	0,				/* tp_iternext */
-	0,				/* tp_methods */
-	0,				/* tp_members */
-	BaseRegexp_getsetters,		/* tp_getset */
-	0,				/* tp_base */
-	0,				/* tp_dict */
-	0,				/* tp_descr_get */
-	0,				/* tp_descr_set */
-	0,				/* tp_dictoffset */
-	0,				/* tp_init */
-	0,				/* tp_alloc */
-	BaseRegexp_new			/* tp_new */
+	buffer = PyMem_Malloc(n * sizeof(unsigned long));
+	if (!buffer)
+		return PyErr_NoMemory();
+	for (i = 0; i < n; i++) {
+		c = CHAR_AT(i);
+		if (c == '\\') {
+			if (++i >= n)
+				goto nonliteral;
+			e = simple_escape(CHAR_AT(i),
+					  i + 1 < n ? (long)CHAR_AT(i + 1) : -1);
+			if (e < 0)
+				goto nonliteral;
+			c = e;
+		}
+		else if (c == '[') {
+			/* escape() writes backspaces as [\b] */
+			if (i + 3 < n && CHAR_AT(i + 1) == '\\' &&
+			    CHAR_AT(i + 2) == 'b' && CHAR_AT(i + 3) == ']') {
+				c = '\b';
+				i += 3;
+			}
+			else
+				goto nonliteral;
+		}
+		else if (c && c < 128 && strchr("^$.|?*+()[]{}", (int)c))
+			goto nonliteral;
+		buffer[length++] = c;
+	}
+	rv = string_from_chars(unicode, buffer, length);
 
-};
+nonliteral:
+	PyMem_Free(buffer);
+	return rv;
+#undef CHAR_AT
+}
 
 
 /**
- * oniguruma requires that we free the match state objects.
+ * Get the index after the character class starting at i or -1.
  */
-static void
-MatchState_dealloc(MatchState *self)
+static Py_ssize_t
+skip_class(PyObject *pattern, int unicode, Py_ssize_t i, Py_ssize_t n)
 {
-	Py_XDECREF(self->regexp);
-	Py_XDECREF(self->string);
-	if (self->region)
-		onig_region_free(self->region, 1);
-	self->ob_type->tp_free(self);
+	int depth = 0;
+	unsigned long c;
+
+	for (; i < n; i++) {
+		c = PATTERN_CHAR(pattern, unicode, i);
+		if (c == '\\')
+			i++;
+		else if (c == '[') {
+			depth++;
+			/* a ] at the start of a class is a literal */
+			if (i + 1 < n && PATTERN_CHAR(pattern, unicode, i + 1) == '^')
+				i++;
+			if (i + 1 < n && PATTERN_CHAR(pattern, unicode, i + 1) == ']')
+				i++;
+		}
+		else if (c == ']' && --depth == 0)
+			return i + 1;
+	}
+	return -1;
 }
 
 
-static PyObject *
-MatchState_getregexp(MatchState *self, void *closure)
+/**
+ * Get the index after the group starting at i or -1.  Inline options
+ * could turn on ignorecase or extended mode, groups with them give -2.
+ */
+static Py_ssize_t
+skip_group(PyObject *pattern, int unicode, Py_ssize_t i, Py_ssize_t n)
 {
-	Py_INCREF(self->regexp);
-	return (PyObject *)self->regexp;
+	int depth = 0;
+	unsigned long c, next;
+
+	for (; i < n; i++) {
+		c = PATTERN_CHAR(pattern, unicode, i);
+		if (c == '\\')
+			i++;
+		else if (c == '[') {
+			i = skip_class(pattern, unicode, i, n);
+			if (i < 0)
+				return -1;
+			i--;
+		}
+		else if (c == '(') {
+			depth++;
+			if (i + 2 >= n || PATTERN_CHAR(pattern, unicode, i + 1) != '?')
+				continue;
+			next = PATTERN_CHAR(pattern, unicode, i + 2);
+			if (next == '#') {
+				/* comments end at the first parenthesis */
+				while (i < n && PATTERN_CHAR(pattern, unicode, i) != ')')
+					i++;
+				if (i >= n)
+					return -1;
+				if (--depth == 0)
+					return i + 1;
+			}
+			else if (next == '-' || next == '^' ||
+				 (next >= 'a' && next <= 'z') ||
+				 (next >= 'A' && next <= 'Z'))
+				return -2;
+		}
+		else if (c == ')' && --depth == 0)
+			return i + 1;
+	}
+	return -1;
 }
 
-static PyObject *
-MatchState_getstring(MatchState *self, void *closure)
+
+/**
+ * Add a run of characters to a list of required literals that is
+ * ordered by length and doesn't contain strings that are part of
+ * others.
+ */
+static int
+add_required_literal(PyObject *literals, int unicode, unsigned long *chars,
+		     Py_ssize_t length)
 {
-	Py_INCREF(self->string);
-	return self->string;
+	PyObject *item, *literal;
+	Py_ssize_t i, pos;
+	int rv = 0;
+
+	if (length <= 0)
+		return 0;
+	literal = string_from_chars(unicode, chars, length);
+	if (!literal)
+		return -1;
+	pos = PyList_GET_SIZE(literals);
+	for (i = PyList_GET_SIZE(literals) - 1; i >= 0; i--) {
+		item = PyList_GET_ITEM(literals, i);
+		if (PyObject_Length(item) >= length) {
+			rv = PySequence_Contains(item, literal);
+			if (rv)
+				goto done;
+		}
+		else {
+			rv = PySequence_Contains(literal, item);
+			if (rv > 0 && PySequence_DelItem(literals, i) < 0)
+				rv = -1;
+			if (rv < 0)
+				goto done;
+			pos = i;
+		}
+	}
+	rv = PyList_Insert(literals, pos, literal);
+done:
+	Py_DECREF(literal);
+	return rv < 0 ? -1 : 0;
 }
 
+
+/**
+ * Get a tuple of the strings every match of a pattern contains.  These
+ * are the runs of literal characters on the top level of the pattern
+ * that are not made optional by a quantifier, the longest first.
+ * Groups and classes are skipped.  Patterns with alternatives, inline
+ * options, escapes that take arguments and \A or \G, which make a
+ * search fail early, get no strings.  If multibyte is true the pattern
+ * is a utf-8 byte string.
+ */
 static PyObject *
-MatchState_getpos(MatchState *self, void *closure)
+get_required_literals(PyObject *pattern, int isyn, int multibyte)
 {
-	return PyInt_FromSsize_t(self->pos);
+	Py_ssize_t i, j, n, length = 0, run = 0;
+	unsigned long c, *buffer;
+	long e, next;
+	int unicode = PyUnicode_Check(pattern), last_char = 0, repeated, exact;
+	PyObject *literals, *rv;
+
+#define CHAR_AT(i) PATTERN_CHAR(pattern, unicode, i)
+#define NEXT_AT(i) ((i) < n ? (long)CHAR_AT(i) : -1L)
+#define END_RUN() do {							\
+	if (add_required_literal(literals, unicode, buffer + run,	\
+				 length - run) < 0)			\
+		goto error;						\
+	run = length;							\
+	last_char = 0;							\
+} while (0)
+
+	literals = PyList_New(0);
+	n = PATTERN_LENGTH(pattern, unicode);
+	if (!literals || isyn < 6 || n == 0)
+		goto done;
+	buffer = PyMem_Malloc(n * sizeof(unsigned long));
+	if (!buffer) {
+		PyErr_NoMemory();
+		Py_CLEAR(literals);
+		goto done;
+	}
+
+	for (i = 0; i < n; i++) {
+		c = CHAR_AT(i);
+		if (c == '\\') {
+			next = NEXT_AT(i + 1);
+			i++;
+			e = next < 0 ? -1 : simple_escape(next, NEXT_AT(i + 1));
+			if (e >= 0) {
+				buffer[length++] = e;
+				last_char = 1;
+			}
+			/* escapes for one character or a position */
+			else if (next > 0 && next < 128 &&
+				 strchr("dDwWsShHbBzZRNOXKvae", (int)next))
+				END_RUN();
+			else
+				goto nothing;
+		}
+		else if (c == '(' || c == '[') {
+			j = (c == '(') ? skip_group(pattern, unicode, i, n)
+				       : skip_class(pattern, unicode, i, n);
+			if (j < 0)
+				goto nothing;
+			/* comments vanish, a quantifier after them applies to
+			   the last character */
+			if (c == '(' && NEXT_AT(i + 1) == '?' &&
+			    NEXT_AT(i + 2) == '#') {
+				next = NEXT_AT(j);
+				if (!last_char && (next == '?' || next == '*' ||
+						   next == '+' || next == '{'))
+					goto nothing;
+				i = j - 1;
+				continue;
+			}
+			i = j - 1;
+			END_RUN();
+		}
+		else if (c == '?' || c == '*' || c == '+' || c == '{') {
+			repeated = c == '+';
+			exact = 0;
+			if (c == '{') {
+				/* {n}, {n,}, {,m} and {n,m} */
+				for (j = i + 1; j < n && CHAR_AT(j) >= '0' &&
+				     CHAR_AT(j) <= '9'; j++)
+					if (CHAR_AT(j) != '0')
+						repeated = 1;
+				if (j == i + 1 && NEXT_AT(j) != ',')
+					goto nothing;
+				exact = NEXT_AT(j) != ',';
+				if (!exact)
+					for (j++; j < n && CHAR_AT(j) >= '0' &&
+					     CHAR_AT(j) <= '9'; j++)
+						;
+				if (NEXT_AT(j) != '}')
+					goto nothing;
+				i = j;
+			}
+			/* lazy and possessive quantifiers.  only java and perl
+			   have possessive intervals, elsewhere {n}+ repeats
+			   the interval and {n}? makes it optional */
+			next = NEXT_AT(i + 1);
+			if (next == '?') {
+				if (exact && isyn > 8)
+					repeated = 0;
+				i++;
+			}
+			else if (next == '+' && (c != '{' || isyn <= 8))
+				i++;
+			/* a quantifier on a quantifier */
+			next = NEXT_AT(i + 1);
+			if (next == '?' || next == '*' || next == '+' ||
+			    next == '{')
+				goto nothing;
+			if (!repeated && last_char) {
+				if (multibyte)
+					while (length > run &&
+					       (buffer[length - 1] & 0xc0) == 0x80)
+						length--;
+				length--;
+			}
+			END_RUN();
+		}
+		else if (c == '|' || c == ')')
+			goto nothing;
+		else if (c && c < 128 && strchr(".^$]}", (int)c))
+			END_RUN();
+		else {
+			buffer[length++] = c;
+			last_char = 1;
+		}
+	}
+	END_RUN();
+	goto finish;
+
+nothing:
+	PyList_SetSlice(literals, 0, PyList_GET_SIZE(literals), NULL);
+	goto finish;
+error:
+	Py_CLEAR(literals);
+finish:
+	PyMem_Free(buffer);
+done:
+	if (!literals)
+		return NULL;
+	rv = PyList_AsTuple(literals);
+	Py_DECREF(literals);
+	return rv;
+#undef CHAR_AT
+#undef NEXT_AT
+#undef END_RUN
 }
 
+
+/**
+ * Get the required literals of a regexp in the encoding of its
+ * subjects.
+ */
 static PyObject *
-MatchState_getendpos(MatchState *self, void *closure)
+get_required_data(BaseRegexp *self)
 {
-	return PyInt_FromSsize_t(self->endpos);
+	PyObject *rv, *item;
+	Py_ssize_t i, n = PyTuple_GET_SIZE(self->required);
+
+	if (!self->utf8) {
+		Py_INCREF(self->required);
+		return self->required;
+	}
+	rv = PyTuple_New(n);
+	for (i = 0; rv && i < n; i++) {
+		item = PyUnicode_AsUTF8String(PyTuple_GET_ITEM(self->required, i));
+		if (!item)
+			Py_CLEAR(rv);
+		else
+			PyTuple_SET_ITEM(rv, i, item);
+	}
+	return rv;
 }
 
-static PyGetSetDef MatchState_getsetters[] = {
-	{"regexp", (getter)MatchState_getregexp, NULL, "", NULL},
+
+/**
+ * The number of bytes malloc handed out or -1 if that's unknown.  This
+ * walks the heap, which is too slow to do unless memory tracking is
+ * enabled.
+ */
+static Py_ssize_t
+heap_in_use(void)
+{
+#if defined(__GLIBC__) && (__GLIBC__ > 2 || __GLIBC_MINOR__ >= 33)
+	struct mallinfo2 info = mallinfo2();
+	return (Py_ssize_t)(info.uordblks + info.hblkhd);
+#elif defined(__GLIBC__)
+	struct mallinfo info = mallinfo();
+	return (Py_ssize_t)(unsigned int)info.uordblks +
+		(Py_ssize_t)(unsigned int)info.hblkhd;
+#else
+	return -1;
+#endif
+}
+
+/**
+ * The memory a subject uses besides the string it was created for.
+ */
+static Py_ssize_t
+subject_size(Subject *subject)
+{
+	Py_ssize_t size = subject->ob_type->tp_basicsize;
+
+	if (subject->index)
+		size += (subject->size / INDEX_BLOCK_SIZE + 1) *
+			(sizeof(Py_ssize_t) + sizeof(unsigned char));
+	if (subject->encoded)
+		size += subject->encoded->ob_type->tp_basicsize +
+			PyString_GET_SIZE(subject->encoded);
+	return size;
+}
+
+/**
+ * Update the memory report after the size of a subject changed.
+ */
+static void
+account_subject(Subject *subject)
+{
+	Py_ssize_t size = subject_size(subject);
+	subject_bytes += size - subject->accounted;
+	subject->accounted = size;
+}
+
+/**
+ * The memory a match state and its region use.
+ */
+static Py_ssize_t
+state_size(MatchState *state)
+{
+	Py_ssize_t size = state->ob_type->tp_basicsize;
+
+	if (state->region)
+		size += sizeof(OnigRegion) +
+			2 * state->region->allocated * sizeof(int);
+	return size;
+}
+
+static void
+account_state(MatchState *state)
+{
+	Py_ssize_t size = state_size(state);
+	state_bytes += size - state->accounted;
+	state->accounted = size;
+}
+
+/**
+ * The memory of a regexp, including its share of the program.
+ */
+static Py_ssize_t
+regexp_size(BaseRegexp *self)
+{
+	Py_ssize_t size = self->ob_type->tp_basicsize;
+
+	if (self->program)
+		size += self->program->size / self->program->users;
+	return size;
+}
+
+/**
+ * The key of a regexp in the programs table.  The type of the pattern
+ * is part of it because equal byte strings and unicode patterns
+ * compile to different programs.
+ */
+static PyObject *
+get_regexp_key(BaseRegexp *self)
+{
+	PyObject *key = PyTuple_New(5);
+	if (!key)
+		return NULL;
+	Py_INCREF(self->pattern->ob_type);
+	PyTuple_SET_ITEM(key, 0, (PyObject *)self->pattern->ob_type);
+	Py_INCREF(self->pattern);
+	PyTuple_SET_ITEM(key, 1, self->pattern);
+	PyTuple_SET_ITEM(key, 2, PyInt_FromLong((long)self->options));
+	PyTuple_SET_ITEM(key, 3, PyInt_FromLong(self->encoding));
+	PyTuple_SET_ITEM(key, 4, PyInt_FromLong(self->syntax));
+	if (!PyTuple_GET_ITEM(key, 2) || !PyTuple_GET_ITEM(key, 3) ||
+	    !PyTuple_GET_ITEM(key, 4)) {
+		Py_DECREF(key);
+		return NULL;
+	}
+	return key;
+}
+
+/**
+ * Look up the program for a key.  Returns a borrowed pointer or NULL.
+ */
+static Program *
+find_program(PyObject *key)
+{
+	PyObject *capsule = PyDict_GetItem(programs, key);
+	if (!capsule)
+		return NULL;
+	return (Program *)PyCapsule_GetPointer(capsule, NULL);
+}
+
+/**
+ * Add a freshly compiled program to the programs table.  On error the
+ * regex is freed.
+ */
+static Program *
+add_program(PyObject *key, regex_t *regex, Py_ssize_t size, int measured)
+{
+	Program *program;
+	PyObject *capsule;
+
+	program = PyMem_New(Program, 1);
+	if (!program) {
+		onig_free(regex);
+		PyErr_NoMemory();
+		return NULL;
+	}
+	capsule = PyCapsule_New(program, NULL, NULL);
+	if (!capsule || PyDict_SetItem(programs, key, capsule) < 0) {
+		Py_XDECREF(capsule);
+		onig_free(regex);
+		PyMem_Free(program);
+		return NULL;
+	}
+	Py_DECREF(capsule);
+	Py_INCREF(key);
+	program->key = key;
+	program->regex = regex;
+	program->users = 0;
+	program->size = size;
+	program->measured = measured;
+	return program;
+}
+
+/**
+ * Stop using the program of a regexp.  The last user frees it.
+ */
+static void
+release_program(BaseRegexp *self)
+{
+	Program *program = self->program;
+	PyObject *type, *value, *traceback;
+
+	if (!program)
+		return;
+	self->program = NULL;
+	self->regex = NULL;
+	if (--program->users > 0)
+		return;
+
+	/* this runs from dealloc, where an exception may be set */
+	PyErr_Fetch(&type, &value, &traceback);
+	if (PyDict_DelItem(programs, program->key) < 0)
+		PyErr_Clear();
+	PyErr_Restore(type, value, traceback);
+	onig_free(program->regex);
+	Py_DECREF(program->key);
+	PyMem_Free(program);
+}
+
+/**
+ * Compile the pattern of a regexp.  A regexp equal to one that is
+ * already compiled shares its program.  Otherwise the GIL is released
+ * while oniguruma compiles so that several patterns can be compiled on
+ * different threads.  If another thread compiled the same pattern in
+ * the meantime its result is kept.
+ */
+static int
+compile_regexp(BaseRegexp *self)
+{
+	PyObject *pattern = self->pattern, *encoded = NULL, *key;
+	OnigEncodingType *enc;
+	OnigSyntaxType *syn;
+	regex_t *regex = NULL;
+	Program *program;
+	UChar *pstr, *pend;
+	OnigErrorInfo einfo;
+	Py_ssize_t before = -1, size = 0;
+	int rv, measure = track_memory;
+
+	key = get_regexp_key(self);
+	if (!key)
+		return -1;
+	program = find_program(key);
+	if (program)
+		goto share;
+	/* unicode patterns are either compiled for the internal
+	   representation of unicode strings or, if ENCODING_UTF8 is
+	   given, for the utf-8 encoding of pattern and subjects. */
+	if (self->utf8) {
+		encoded = PyUnicode_AsUTF8String(pattern);
+		if (!encoded) {
+			Py_DECREF(key);
+			return -1;
+		}
+		enc = ONIG_ENCODING_UTF8;
+		pstr = (UChar *) PyString_AS_STRING(encoded);
+		pend = pstr + PyString_GET_SIZE(encoded);
+	}
+	else if (self->unicode) {
+		enc = UNICODE_ENCODING;
+		pstr = (UChar *) PyUnicode_AS_UNICODE(pattern);
+		pend = pstr + (PyUnicode_GET_SIZE(pattern) *
+			       sizeof(PY_UNICODE_TYPE));
+	}
+	else {
+		enc = get_onig_encoding(self->encoding);
+		pstr = (UChar *) PyString_AS_STRING(pattern);
+		pend = pstr + PyString_GET_SIZE(pattern);
+	}
+
+	/* XXX: check for invalid values? */
+	syn = get_onig_syntax(self->syntax);
+	/* measured compiles keep the gil so that the difference of the
+	   heap statistics doesn't include what other threads allocate */
+	if (measure) {
+		before = heap_in_use();
+		rv = onig_new(&regex, pstr, pend, self->options, enc, syn,
+			      &einfo);
+		if (before >= 0)
+			size = heap_in_use() - before;
+	}
+	else {
+		Py_BEGIN_ALLOW_THREADS
+		rv = onig_new(&regex, pstr, pend, self->options, enc, syn,
+			      &einfo);
+		Py_END_ALLOW_THREADS
+	}
+	Py_XDECREF(encoded);
+	/* threads that run without the gil may still free memory */
+	if (before < 0 || size < 0) {
+		size = PROGRAM_SIZE_ESTIMATE(pend - pstr);
+		before = -1;
+	}
+
+	if (rv != ONIG_NORMAL) {
+		UChar s[ONIG_MAX_ERROR_MESSAGE_LEN];
+		onig_error_code_to_str(s, rv, &einfo);
+		PyErr_SetString(RegexpError, (char *)s);
+		Py_DECREF(key);
+		return -1;
+	}
+	if (self->regex) {
+		onig_free(regex);
+		Py_DECREF(key);
+		return 0;
+	}
+	program = find_program(key);
+	if (program)
+		onig_free(regex);
+	else {
+		program = add_program(key, regex, size, before >= 0);
+		if (!program) {
+			Py_DECREF(key);
+			return -1;
+		}
+	}
+
+  share:
+	Py_DECREF(key);
+	program->users++;
+	self->program = program;
+	self->regex = program->regex;
+
+	/* literals are found with a substring search.  that needs a case
+	   sensitive pattern and an encoding where a byte match can't start
+	   in the middle of a character */
+	if (!(self->options & ~LITERAL_OPTIONS) &&
+	    (self->unicode || self->encoding <= 17)) {
+		self->literal = get_literal(pattern, self->syntax);
+		if (self->literal && self->utf8)
+			self->literal_data = PyUnicode_AsUTF8String(self->literal);
+		else if (self->literal) {
+			Py_INCREF(self->literal);
+			self->literal_data = self->literal;
+		}
+		/* other patterns are only searched if the subject contains
+		   the strings every match contains */
+		else if (!PyErr_Occurred()) {
+			self->required = get_required_literals(pattern,
+				self->syntax, !self->unicode && self->encoding == 17);
+			if (self->required && PyTuple_GET_SIZE(self->required))
+				self->required_data = get_required_data(self);
+		}
+		if (PyErr_Occurred()) {
+			release_program(self);
+			Py_CLEAR(self->literal);
+			Py_CLEAR(self->literal_data);
+			Py_CLEAR(self->required);
+			Py_CLEAR(self->required_data);
+			return -1;
+		}
+	}
+	return 0;
+}
+
+/**
+ * Compile a lazy regexp if that didn't happen yet.  Everything that
+ * needs the oniguruma regex has to call this first.
+ */
+#define ENSURE_COMPILED(regexp) \
+	((regexp)->regex ? 0 : compile_regexp(regexp))
+
+
+/**
+ * Create a new Regexp object.  Unless lazy is true the pattern is
+ * compiled here, otherwise syntax errors are raised on first use.
+ */
+static PyObject *
+BaseRegexp_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+	PyObject *pattern;
+	int ienc = -1, isyn = 10, strict = 0, lazy = 0;
+	OnigOptionType options = ONIG_OPTION_NONE;
+	BaseRegexp *self;
+	static char *kwlist[] = {"pattern", "flags", "encoding", "syntax",
+				 "strict", "lazy", NULL};
+
+	self = (BaseRegexp *)type->tp_alloc(type, 0);
+	if (!self)
+		return NULL;
+	live_regexps++;
+	regexp_bytes += type->tp_basicsize;
+	/* Initialize them in case __new__ fails. */
+	self->regex = NULL;
+	self->program = NULL;
+	self->pattern = NULL;
+	self->retry_limit = 0;
+	self->stack_limit = 0;
+#ifdef HAVE_MATCH_PARAM
+	self->match_param = NULL;
+#endif
+	self->collect_stats = 0;
+	self->stats_registered = 0;
+	self->calls = self->hits = self->misses = self->bytes_scanned = 0;
+	self->engine_time = 0.0;
+	self->literal = NULL;
+	self->literal_data = NULL;
+	self->required = NULL;
+	self->required_data = NULL;
+	self->weakreflist = NULL;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|iiiii:BaseRegexp",
+					 kwlist, &pattern, &options, &ienc,
+					 &isyn, &strict, &lazy)) {
+		Py_DECREF(self);
+		return NULL;
+	}
+	if (PyUnicode_Check(pattern)) {
+		if (ienc != -1 && ienc != 17) {
+			PyErr_SetString(PyExc_TypeError, "the only encoding "
+					"that can be given for unicode patterns "
+					"is ENCODING_UTF8");
+			Py_DECREF(self);
+			return NULL;
+		}
+		self->unicode = 1;
+		self->utf8 = ienc == 17;
+	}
+	else if (PyString_Check(pattern)) {
+		if (ienc == -1) ienc = 0;
+		self->unicode = 0;
+		self->utf8 = 0;
+	}
+	else {
+		PyErr_SetString(PyExc_TypeError, "pattern must be string or unicode");
+		Py_DECREF(self);
+		return NULL;
+	}
+	/* Got to keep a reference to the pattern string */
+	Py_INCREF(pattern);
+	self->pattern = pattern;
+	self->options = options;
+	self->encoding = ienc;
+	self->syntax = isyn;
+	self->strict = strict != 0;
+	self->search_anchor = has_search_anchor(pattern);
+
+	if (!lazy && compile_regexp(self) < 0) {
+		Py_DECREF(self);
+		return NULL;
+	}
+	return (PyObject *)self;
+}
+
+/**
+ * oniguruma requires that we free the regex object.
+ */
+static void
+BaseRegexp_dealloc(BaseRegexp *self)
+{
+	if (self->weakreflist)
+		PyObject_ClearWeakRefs((PyObject *)self);
+	live_regexps--;
+	regexp_bytes -= self->ob_type->tp_basicsize;
+	release_program(self);
+#ifdef HAVE_MATCH_PARAM
+	if (self->match_param)
+		onig_free_match_param(self->match_param);
+#endif
+	Py_XDECREF(self->pattern);
+	Py_XDECREF(self->literal);
+	Py_XDECREF(self->literal_data);
+	Py_XDECREF(self->required);
+	Py_XDECREF(self->required_data);
+	self->ob_type->tp_free((PyObject *)self);
+}
+
+/**
+ * read only property for the unicode flag.
+ */
+static PyObject *
+BaseRegexp_getunicode(BaseRegexp *self, void *closure)
+{
+	return PyBool_FromLong(self->unicode);
+}
+
+/**
+ * read only property for the utf-8 flag.
+ */
+static PyObject *
+BaseRegexp_getutf8(BaseRegexp *self, void *closure)
+{
+	return PyBool_FromLong(self->utf8);
+}
+
+/**
+ * read only property for the literal of the pattern.
+ */
+static PyObject *
+BaseRegexp_getliteral(BaseRegexp *self, void *closure)
+{
+	PyObject *rv;
+
+	if (ENSURE_COMPILED(self) < 0)
+		return NULL;
+	rv = self->literal ? self->literal : Py_None;
+	Py_INCREF(rv);
+	return rv;
+}
+
+/**
+ * read only property for the required literals of the pattern.
+ */
+static PyObject *
+BaseRegexp_getrequired(BaseRegexp *self, void *closure)
+{
+	if (ENSURE_COMPILED(self) < 0)
+		return NULL;
+	if (self->literal)
+		return PyTuple_Pack(1, self->literal);
+	if (!self->required)
+		return PyTuple_New(0);
+	Py_INCREF(self->required);
+	return self->required;
+}
+
+/**
+ * read only property for the strict flag.
+ */
+static PyObject *
+BaseRegexp_getstrict(BaseRegexp *self, void *closure)
+{
+	return PyBool_FromLong(self->strict);
+}
+
+static PyObject *
+BaseRegexp_getpattern(BaseRegexp *self, void *closure)
+{
+	Py_INCREF(self->pattern);
+	return self->pattern;
+}
+
+static PyObject *
+BaseRegexp_getflags(BaseRegexp *self, void *closure)
+{
+	if (ENSURE_COMPILED(self) < 0)
+		return NULL;
+	return PyInt_FromLong(onig_get_options(self->regex));
+}
+
+/**
+ * read only property that tells if the pattern is compiled.
+ */
+static PyObject *
+BaseRegexp_getcompiled(BaseRegexp *self, void *closure)
+{
+	return PyBool_FromLong(self->regex != NULL);
+}
+
+/**
+ * Convert a python value into a limit.  None and 0 both mean that the
+ * global default applies.
+ */
+static int
+parse_limit(PyObject *value, unsigned long *limit)
+{
+	long rv;
+
+	if (!value) {
+		PyErr_SetString(PyExc_TypeError, "cannot delete limits");
+		return -1;
+	}
+	if (value == Py_None) {
+		*limit = 0;
+		return 0;
+	}
+	rv = PyInt_AsLong(value);
+	if (rv == -1 && PyErr_Occurred())
+		return -1;
+	if (rv < 0) {
+		PyErr_SetString(PyExc_ValueError, "limits must be >= 0");
+		return -1;
+	}
+#ifndef HAVE_MATCH_PARAM
+	if (rv) {
+		PyErr_SetString(PyExc_NotImplementedError, "per regexp limits "
+				"require oniguruma 6.8 or later");
+		return -1;
+	}
+#endif
+	*limit = (unsigned long)rv;
+	return 0;
+}
+
+#ifdef HAVE_MATCH_PARAM
+/**
+ * Create a new match param with the limits of the regexp.
+ */
+static OnigMatchParam *
+copy_match_param(BaseRegexp *regexp)
+{
+	OnigMatchParam *mp = onig_new_match_param();
+
+	if (!mp) {
+		PyErr_NoMemory();
+		return NULL;
+	}
+	onig_initialize_match_param(mp);
+	if (regexp->retry_limit)
+		onig_set_retry_limit_in_match_of_match_param(
+			mp, regexp->retry_limit);
+	if (regexp->stack_limit)
+		onig_set_match_stack_limit_size_of_match_param(
+			mp, (unsigned int)regexp->stack_limit);
+	return mp;
+}
+#endif
+
+/**
+ * Rebuild the match param after a limit was changed.
+ */
+static int
+BaseRegexp_updatelimits(BaseRegexp *self)
+{
+#ifdef HAVE_MATCH_PARAM
+	if (self->match_param) {
+		onig_free_match_param(self->match_param);
+		self->match_param = NULL;
+	}
+	if (!self->retry_limit && !self->stack_limit)
+		return 0;
+	self->match_param = copy_match_param(self);
+	if (!self->match_param)
+		return -1;
+#endif
+	return 0;
+}
+
+static PyObject *
+BaseRegexp_getretrylimit(BaseRegexp *self, void *closure)
+{
+	return PyLong_FromUnsignedLong(self->retry_limit);
+}
+
+static int
+BaseRegexp_setretrylimit(BaseRegexp *self, PyObject *value, void *closure)
+{
+	if (parse_limit(value, &self->retry_limit) < 0)
+		return -1;
+	return BaseRegexp_updatelimits(self);
+}
+
+static PyObject *
+BaseRegexp_getstacklimit(BaseRegexp *self, void *closure)
+{
+	return PyLong_FromUnsignedLong(self->stack_limit);
+}
+
+static int
+BaseRegexp_setstacklimit(BaseRegexp *self, PyObject *value, void *closure)
+{
+	if (parse_limit(value, &self->stack_limit) < 0)
+		return -1;
+	return BaseRegexp_updatelimits(self);
+}
+
+/**
+ * Drop the references of dead regexps from the stats registry.
+ */
+static int
+prune_stats_registry(void)
+{
+	PyObject *ref;
+	Py_ssize_t i;
+
+	for (i = PyList_GET_SIZE(stats_registry) - 1; i >= 0; i--) {
+		ref = PyList_GET_ITEM(stats_registry, i);
+		if (PyWeakref_GET_OBJECT(ref) == Py_None &&
+		    PySequence_DelItem(stats_registry, i) < 0)
+			return -1;
+	}
+	return 0;
+}
+
+/**
+ * Add a regexp to the stats registry.  This is done once it collects
+ * statistics so that only interesting regexps show up in snapshots.
+ * If the registry reached its limit it's pruned first and the limit is
+ * set to twice the size of what's left, so that short lived regexps
+ * don't make it grow and pruning stays cheap.
+ */
+static int
+register_stats(BaseRegexp *self)
+{
+	PyObject *ref;
+	int rv;
+
+	if (self->stats_registered)
+		return 0;
+	if (PyList_GET_SIZE(stats_registry) >= stats_registry_limit) {
+		if (prune_stats_registry() < 0)
+			return -1;
+		stats_registry_limit = PyList_GET_SIZE(stats_registry) * 2;
+		if (stats_registry_limit < 64)
+			stats_registry_limit = 64;
+	}
+	ref = PyWeakref_NewRef((PyObject *)self, NULL);
+	if (!ref)
+		return -1;
+	rv = PyList_Append(stats_registry, ref);
+	Py_DECREF(ref);
+	if (rv < 0)
+		return -1;
+	self->stats_registered = 1;
+	return 0;
+}
+
+/**
+ * property for the stats flag.  statistics are also collected if
+ * they are enabled globally.
+ */
+static PyObject *
+BaseRegexp_getcollectstats(BaseRegexp *self, void *closure)
+{
+	return PyBool_FromLong(self->collect_stats);
+}
+
+static int
+BaseRegexp_setcollectstats(BaseRegexp *self, PyObject *value, void *closure)
+{
+	int flag;
+
+	if (!value) {
+		PyErr_SetString(PyExc_TypeError, "can't delete collect_stats");
+		return -1;
+	}
+	flag = PyObject_IsTrue(value);
+	if (flag < 0)
+		return -1;
+	if (flag && register_stats(self) < 0)
+		return -1;
+	self->collect_stats = flag;
+	return 0;
+}
+
+/**
+ * Regexps are equal if they were created with the same arguments.
+ */
+static PyObject *
+BaseRegexp_richcompare(BaseRegexp *self, PyObject *other, int op)
+{
+	BaseRegexp *o = (BaseRegexp *)other;
+	int equal;
+
+	if ((op != Py_EQ && op != Py_NE) || self->ob_type != other->ob_type) {
+		Py_INCREF(Py_NotImplemented);
+		return Py_NotImplemented;
+	}
+	equal = self->options == o->options &&
+		self->encoding == o->encoding &&
+		self->syntax == o->syntax &&
+		self->strict == o->strict &&
+		self->pattern->ob_type == o->pattern->ob_type;
+	if (equal) {
+		equal = PyObject_RichCompareBool(self->pattern, o->pattern,
+						 Py_EQ);
+		if (equal < 0)
+			return NULL;
+	}
+	return PyBool_FromLong(op == Py_EQ ? equal : !equal);
+}
+
+static long
+BaseRegexp_hash(BaseRegexp *self)
+{
+	PyObject *key = get_regexp_key(self);
+	long rv;
+
+	if (!key)
+		return -1;
+	rv = PyObject_Hash(key);
+	Py_DECREF(key);
+	return rv;
+}
+
+static PyObject *
+BaseRegexp_sizeof(BaseRegexp *self)
+{
+	return PyInt_FromSsize_t(regexp_size(self));
+}
+
+static PyMethodDef BaseRegexp_methods[] = {
+	{"__sizeof__", (PyCFunction)BaseRegexp_sizeof, METH_NOARGS,
+	 "Size in bytes, including an equal share of the compiled program "
+	 "for every\nregexp using it."},
+	{NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef BaseRegexp_getsetters[] = {
+	{"unicode_mode", (getter)BaseRegexp_getunicode, NULL,
+	 "True if the pattern is in unicode mode.", NULL},
+	{"utf8_mode", (getter)BaseRegexp_getutf8, NULL,
+	 "True if unicode strings are matched in their utf-8 encoding.", NULL},
+	{"strict", (getter)BaseRegexp_getstrict, NULL,
+	 "True if strings of the wrong type are rejected instead of "
+	 "converted.", NULL},
+	{"pattern", (getter)BaseRegexp_getpattern, NULL,
+	 "the pattern string the Regexp was built from.", NULL},
+	{"literal", (getter)BaseRegexp_getliteral, NULL,
+	 "the string the pattern matches if it doesn't contain "
+	 "metacharacters, otherwise None.  Such patterns are matched "
+	 "without the engine.", NULL},
+	{"required_literals", (getter)BaseRegexp_getrequired, NULL,
+	 "tuple of strings every match contains.  The engine only "
+	 "searches subjects that contain all of them.", NULL},
+	{"flags", (getter)BaseRegexp_getflags, NULL,
+	 "the flags the Regexp was built with.", NULL},
+	{"compiled", (getter)BaseRegexp_getcompiled, NULL,
+	 "False until a lazy Regexp is used for the first time.", NULL},
+	{"retry_limit", (getter)BaseRegexp_getretrylimit,
+	 (setter)BaseRegexp_setretrylimit,
+	 "maximum number of backtracking retries for one match attempt "
+	 "or 0 for the global default.", NULL},
+	{"match_stack_limit", (getter)BaseRegexp_getstacklimit,
+	 (setter)BaseRegexp_setstacklimit,
+	 "maximum size of the match stack or 0 for the global default.",
+	 NULL},
+	{"collect_stats", (getter)BaseRegexp_getcollectstats,
+	 (setter)BaseRegexp_setcollectstats,
+	 "True if statistics are collected for this regexp.", NULL},
+	{NULL}
+};
+
+
+static PyTypeObject BaseRegexpType = {
+	PyObject_HEAD_INIT(NULL)
+	0,				/* ob_size */
+	"ponyguruma._lowlevel.BaseRegexp", /* tp_name */
+	sizeof(BaseRegexp),		/* tp_basicsize */
+	0,				/* tp_itemsize */
+	(destructor)BaseRegexp_dealloc,	/* tp_dealloc */
+	0,				/* tp_print */
+	0,				/* tp_getattr */
+	0,				/* tp_setattr */
+	0,				/* tp_compare */
+	0,				/* tp_repr */
+	0,				/* tp_as_number */
+	0,				/* tp_as_sequence */
+	0,				/* tp_as_mapping */
+	(hashfunc)BaseRegexp_hash,	/* tp_hash */
+	0,				/* tp_call */
+	0,				/* tp_str */
+	0,				/* tp_getattro */
+	0,				/* tp_setattro */
+	0,				/* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
+	"",				/* tp_doc */
+	0,				/* tp_traverse */
+	0,				/* tp_clear */
+	(richcmpfunc)BaseRegexp_richcompare, /* tp_richcompare */
+	offsetof(BaseRegexp, weakreflist), /* tp_weaklistoffset */
+	0,				/* tp_iter */
+	0,				/* tp_iternext */
+	BaseRegexp_methods,		/* tp_methods */
+	0,				/* tp_members */
+	BaseRegexp_getsetters,		/* tp_getset */
+	0,				/* tp_base */
+	0,				/* tp_dict */
+	0,				/* tp_descr_get */
+	0,				/* tp_descr_set */
+	0,				/* tp_dictoffset */
+	0,				/* tp_init */
+	0,				/* tp_alloc */
+	BaseRegexp_new			/* tp_new */
+
+};
+
+
+/**
+ * Objects with the old buffer interface, like mmaps, can't be kept from
+ * closing or resizing their buffer, so the pointer of their subjects is
+ * fetched again before every use.  Raises ValueError if the buffer was
+ * closed or changed its size.
+ */
+static int
+subject_refresh(Subject *subject)
+{
+	const void *buffer;
+	Py_ssize_t size;
+
+	if (!subject->old_buffer)
+		return 0;
+	if (PyObject_AsReadBuffer(subject->string, &buffer, &size) < 0) {
+		/* closed mmaps have no segments */
+		if (PyErr_ExceptionMatches(PyExc_TypeError)) {
+			PyErr_Clear();
+			PyErr_SetString(PyExc_ValueError, "the buffer of the "
+					"subject was closed");
+		}
+		return -1;
+	}
+	if (size != subject->size) {
+		PyErr_SetString(PyExc_ValueError, "the buffer of the subject "
+				"changed its size");
+		return -1;
+	}
+	subject->str = (UChar *)buffer;
+	return 0;
+}
+
+
+static void
+Subject_dealloc(Subject *self)
+{
+	Py_XDECREF(self->string);
+	Py_XDECREF(self->encoded);
+	PyMem_Free(self->index);
+	PyMem_Free(self->index_skip);
+	if (self->has_view)
+		PyBuffer_Release(&self->view);
+	live_subjects--;
+	subject_bytes -= self->accounted;
+	self->ob_type->tp_free((PyObject *)self);
+}
+
+
+static PyObject *
+Subject_getstring(Subject *self, void *closure)
+{
+	Py_INCREF(self->string);
+	return self->string;
+}
+
+static PyObject *
+Subject_getlength(Subject *self, void *closure)
+{
+	return PyInt_FromSsize_t(self->length);
+}
+
+static PyObject *
+Subject_sizeof(Subject *self)
+{
+	return PyInt_FromSsize_t(subject_size(self));
+}
+
+static PyMethodDef Subject_methods[] = {
+	{"__sizeof__", (PyCFunction)Subject_sizeof, METH_NOARGS,
+	 "Size in bytes, including the offset index and the utf-8 copy of "
+	 "the string."},
+	{NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef Subject_getsetters[] = {
+	{"string", (getter)Subject_getstring, NULL, "", NULL},
+	{"length", (getter)Subject_getlength, NULL, "", NULL},
+	{NULL}
+};
+
+
+/**
+ * Subjects export the bytes they are matched on so that memoryviews of
+ * groups keep them, and with them buffers like mmaps, alive.
+ */
+static int
+Subject_getbuffer(Subject *self, Py_buffer *view, int flags)
+{
+	if (subject_refresh(self) < 0)
+		return -1;
+	return PyBuffer_FillInfo(view, (PyObject *)self, (void *)self->str,
+				 self->size, 1, flags);
+}
+
+static PyBufferProcs Subject_as_buffer = {
+	0,				/* bf_getreadbuffer */
+	0,				/* bf_getwritebuffer */
+	0,				/* bf_getsegcount */
+	0,				/* bf_getcharbuffer */
+	(getbufferproc)Subject_getbuffer,	/* bf_getbuffer */
+	0,				/* bf_releasebuffer */
+};
+
+static PyTypeObject SubjectType = {
+	PyObject_HEAD_INIT(NULL)
+	0,				/* ob_size */
+	"ponyguruma._lowlevel.Subject",	/* tp_name */
+	sizeof(Subject),		/* tp_basicsize */
+	0,				/* tp_itemsize */
+	(destructor)Subject_dealloc,	/* tp_dealloc */
+	0,				/* tp_print */
+	0,				/* tp_getattr */
+	0,				/* tp_setattr */
+	0,				/* tp_compare */
+	0,				/* tp_repr */
+	0,				/* tp_as_number */
+	0,				/* tp_as_sequence */
+	0,				/* tp_as_mapping */
+	0,				/* tp_hash */
+	0,				/* tp_call */
+	0,				/* tp_str */
+	0,				/* tp_getattro */
+	0,				/* tp_setattro */
+	&Subject_as_buffer,		/* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER,	/* tp_flags */
+	"internal subject object",	/* tp_doc */
+	0,				/* tp_traverse */
+	0,				/* tp_clear */
+	0,				/* tp_richcompare */
+	0,				/* tp_weaklistoffset */
+	0,				/* tp_iter */
+	0,				/* tp_iternext */
+	Subject_methods,		/* tp_methods */
+	0,				/* tp_members */
+	Subject_getsetters,		/* tp_getset */
+};
+
+
+/**
+ * Get the length in bytes of the character at p.  The number of python
+ * characters it stands for is stored in width, which is two for
+ * characters outside the BMP on narrow unicode builds.
+ */
+static Py_ssize_t
+subject_char_len(Subject *subject, const UChar *p, const UChar *end,
+		 int *width)
+{
+	Py_ssize_t len = ONIGENC_MBC_ENC_LEN(subject->enc, p);
+	if (len < 1)
+		len = 1;
+	else if (len > end - p)
+		len = end - p;
+	*width = 1;
+#if Py_UNICODE_SIZE == 2
+	if (subject->encoded && len == 4)
+		*width = 2;
+#endif
+	return len;
+}
+
+/**
+ * Build the offset index of a subject.  The buffer is split into blocks
+ * of INDEX_BLOCK_SIZE bytes and for every block the character offset of
+ * the first character that starts in it is remembered, together with the
+ * distance of that character from the block start.  If it turns out that
+ * every character is a single byte the subject is marked as such and no
+ * index is kept.
+ */
+static int
+subject_build_index(Subject *subject)
+{
+	Py_ssize_t blocks, block = 0, chars = 0, offset = 0, len;
+	int width;
+	const UChar *end = subject->str + subject->size;
+
+	blocks = subject->size / INDEX_BLOCK_SIZE + 1;
+	subject->index = PyMem_New(Py_ssize_t, blocks);
+	subject->index_skip = PyMem_New(unsigned char, blocks);
+	if (!subject->index || !subject->index_skip) {
+		PyMem_Free(subject->index);
+		PyMem_Free(subject->index_skip);
+		subject->index = NULL;
+		subject->index_skip = NULL;
+		PyErr_NoMemory();
+		return -1;
+	}
+
+	while (offset < subject->size) {
+		while (block * INDEX_BLOCK_SIZE <= offset) {
+			subject->index[block] = chars;
+			subject->index_skip[block] = (unsigned char)
+				(offset - block * INDEX_BLOCK_SIZE);
+			block++;
+		}
+		len = subject_char_len(subject, subject->str + offset, end,
+				       &width);
+		offset += len;
+		chars += width;
+	}
+	/* the blocks after the last character start at the end */
+	for (; block < blocks; block++) {
+		subject->index[block] = chars;
+		subject->index_skip[block] = (unsigned char)
+			(subject->size - block * INDEX_BLOCK_SIZE);
+	}
+
+	subject->chars = chars;
+	if (chars == subject->size) {
+		subject->single_byte = 1;
+		PyMem_Free(subject->index);
+		PyMem_Free(subject->index_skip);
+		subject->index = NULL;
+		subject->index_skip = NULL;
+	}
+	account_subject(subject);
+	return 0;
+}
+
+/**
+ * Convert a byte offset into the buffer of a subject into a character
+ * offset.  Offsets close after the last converted one are counted from
+ * there, everything else is looked up in the offset index which is
+ * created on first use.  Either way at most one index block has to be
+ * scanned.  Returns -2 if building the index failed.
+ */
+static Py_ssize_t
+subject_char_offset(Subject *subject, Py_ssize_t offset)
+{
+	const UChar *p, *end;
+	Py_ssize_t chars, block;
+	int width;
+
+	if (offset < 0 || subject->single_byte)
+		return offset;
+	if (!subject->encoded && PyUnicode_Check(subject->string))
+		return offset / sizeof(Py_UNICODE);
+
+	if (offset >= subject->last_byte &&
+	    offset - subject->last_byte < INDEX_BLOCK_SIZE) {
+		p = subject->str + subject->last_byte;
+		chars = subject->last_char;
+	}
+	else {
+		if (!subject->index) {
+			if (subject_build_index(subject) < 0)
+				return -2;
+			if (subject->single_byte)
+				return offset;
+		}
+		block = offset / INDEX_BLOCK_SIZE;
+		p = subject->str + block * INDEX_BLOCK_SIZE +
+			subject->index_skip[block];
+		chars = subject->index[block];
+	}
+
+	end = subject->str + offset;
+	while (p < end) {
+		p += subject_char_len(subject, p, end, &width);
+		chars += width;
+	}
+	subject->last_byte = offset;
+	subject->last_char = chars;
+	return chars;
+}
+
+/**
+ * The reverse of subject_char_offset.  The block to scan is found with a
+ * binary search over the index.  Positions at or after the end of the
+ * string are returned as the size of the buffer without building the
+ * index, so the default endpos of a single search is free.  Returns -2
+ * if building the index failed.
+ */
+static Py_ssize_t
+subject_byte_offset(Subject *subject, Py_ssize_t pos)
+{
+	const UChar *p, *end;
+	Py_ssize_t chars, lo, hi, mid;
+	int width;
+
+	if (subject->single_byte)
+		return pos;
+	if (!subject->encoded && PyUnicode_Check(subject->string))
+		return pos * sizeof(Py_UNICODE);
+	if (pos >= subject->length)
+		return subject->size;
+
+	if (pos >= subject->last_char &&
+	    pos - subject->last_char < INDEX_BLOCK_SIZE) {
+		p = subject->str + subject->last_byte;
+		chars = subject->last_char;
+	}
+	else {
+		if (!subject->index) {
+			if (subject_build_index(subject) < 0)
+				return -2;
+			if (subject->single_byte)
+				return pos;
+		}
+		if (pos >= subject->chars)
+			return subject->size;
+		lo = 0;
+		hi = subject->size / INDEX_BLOCK_SIZE;
+		while (lo < hi) {
+			mid = (lo + hi + 1) / 2;
+			if (subject->index[mid] <= pos)
+				lo = mid;
+			else
+				hi = mid - 1;
+		}
+		p = subject->str + lo * INDEX_BLOCK_SIZE +
+			subject->index_skip[lo];
+		chars = subject->index[lo];
+	}
+
+	end = subject->str + subject->size;
+	while (chars < pos && p < end) {
+		p += subject_char_len(subject, p, end, &width);
+		chars += width;
+	}
+	subject->last_byte = p - subject->str;
+	subject->last_char = chars;
+	return subject->last_byte;
+}
+
+
+/**
+ * oniguruma requires that we free the match state objects.
+ */
+static void
+MatchState_dealloc(MatchState *self)
+{
+	Py_XDECREF(self->regexp);
+	Py_XDECREF(self->subject);
+	if (self->region)
+		onig_region_free(self->region, 1);
+	live_states--;
+	state_bytes -= self->accounted;
+	self->ob_type->tp_free(self);
+}
+
+
+static PyObject *
+MatchState_getregexp(MatchState *self, void *closure)
+{
+	Py_INCREF(self->regexp);
+	return (PyObject *)self->regexp;
+}
+
+static PyObject *
+MatchState_getstring(MatchState *self, void *closure)
+{
+	if (self->detached) {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+	Py_INCREF(self->subject->string);
+	return self->subject->string;
+}
+
+static PyObject *
+MatchState_getdetached(MatchState *self, void *closure)
+{
+	return PyBool_FromLong(self->detached);
+}
+
+static PyObject *
+MatchState_getpos(MatchState *self, void *closure)
+{
+	return PyInt_FromSsize_t(self->pos);
+}
+
+static PyObject *
+MatchState_getendpos(MatchState *self, void *closure)
+{
+	return PyInt_FromSsize_t(self->endpos);
+}
+
+static PyObject *
+MatchState_sizeof(MatchState *self)
+{
+	return PyInt_FromSsize_t(state_size(self));
+}
+
+static PyMethodDef MatchState_methods[] = {
+	{"__sizeof__", (PyCFunction)MatchState_sizeof, METH_NOARGS,
+	 "Size in bytes, including the region.  The subject is not "
+	 "included."},
+	{NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef MatchState_getsetters[] = {
+	{"regexp", (getter)MatchState_getregexp, NULL, "", NULL},
 	{"string", (getter)MatchState_getstring, NULL, "", NULL},
 	{"pos", (getter)MatchState_getpos, NULL, "", NULL},
 	{"endpos", (getter)MatchState_getendpos, NULL, "", NULL},
+	{"detached", (getter)MatchState_getdetached, NULL, "", NULL},
+	{NULL}
+};
+
+
+static PyTypeObject MatchStateType = {
+	PyObject_HEAD_INIT(NULL)
+	0,				/* ob_size */
+	"ponyguruma._lowlevel.MatchState", /* tp_name */
+	sizeof(MatchState),		/* tp_basicsize */
+	0,				/* tp_itemsize */
+	(destructor)MatchState_dealloc,	/* tp_dealloc */
+	0,				/* tp_print */
+	0,				/* tp_getattr */
+	0,				/* tp_setattr */
+	0,				/* tp_compare */
+	0,				/* tp_repr */
+	0,				/* tp_as_number */
+	0,				/* tp_as_sequence */
+	0,				/* tp_as_mapping */
+	0,				/* tp_hash */
+	0,				/* tp_call */
+	0,				/* tp_str */
+	0,				/* tp_getattro */
+	0,				/* tp_setattro */
+	0,				/* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT,		/* tp_flags */
+	"internal match state object",	/* tp_doc */
+	0,				/* tp_traverse */
+	0,				/* tp_clear */
+	0,				/* tp_richcompare */
+	0,				/* tp_weaklistoffset */
+	0,				/* tp_iter */
+	0,				/* tp_iternext */
+	MatchState_methods,		/* tp_methods */
+	0,				/* tp_members */
+	MatchState_getsetters,		/* tp_getset */
+};
+
+
+/**
+ * Create a new deadline.  Without a timeout it only expires when it's
+ * cancelled.
+ */
+static PyObject *
+Deadline_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+	PyObject *timeout = Py_None;
+	Deadline *self;
+	double seconds;
+	static char *kwlist[] = {"timeout", NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O:Deadline", kwlist,
+					 &timeout))
+		return NULL;
+	if (timeout == Py_None)
+		seconds = 0.0;
+	else {
+		seconds = PyFloat_AsDouble(timeout);
+		if (seconds == -1.0 && PyErr_Occurred())
+			return NULL;
+		if (seconds < 0.0) {
+			PyErr_SetString(PyExc_ValueError,
+					"timeout must be >= 0");
+			return NULL;
+		}
+	}
+
+	self = (Deadline *)type->tp_alloc(type, 0);
+	if (!self)
+		return NULL;
+	self->expires = (timeout == Py_None) ? 0.0 : monotonic_time() + seconds;
+	self->cancelled = 0;
+	return (PyObject *)self;
+}
+
+/**
+ * Check a deadline.  This doesn't need the GIL.
+ */
+static int
+deadline_expired(Deadline *self)
+{
+	return self->cancelled ||
+		(self->expires > 0.0 && monotonic_time() >= self->expires);
+}
+
+static PyObject *
+Deadline_cancel(Deadline *self)
+{
+	self->cancelled = 1;
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *
+Deadline_getcancelled(Deadline *self, void *closure)
+{
+	return PyBool_FromLong(self->cancelled);
+}
+
+static PyObject *
+Deadline_getexpired(Deadline *self, void *closure)
+{
+	return PyBool_FromLong(deadline_expired(self));
+}
+
+static PyObject *
+Deadline_getremaining(Deadline *self, void *closure)
+{
+	double remaining;
+
+	if (self->cancelled)
+		return PyFloat_FromDouble(0.0);
+	if (self->expires <= 0.0) {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+	remaining = self->expires - monotonic_time();
+	return PyFloat_FromDouble(remaining > 0.0 ? remaining : 0.0);
+}
+
+static PyMethodDef Deadline_methods[] = {
+	{"cancel", (PyCFunction)Deadline_cancel, METH_NOARGS,
+	 "Cancel all matching operations using this deadline.  This can be "
+	 "called from any thread, but searches in mmaps and other objects "
+	 "with the old buffer interface keep the GIL and only stop at the "
+	 "timeout."},
+	{NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef Deadline_getsetters[] = {
+	{"cancelled", (getter)Deadline_getcancelled, NULL,
+	 "True if the deadline was cancelled.", NULL},
+	{"expired", (getter)Deadline_getexpired, NULL,
+	 "True if the deadline was cancelled or the timeout is over.", NULL},
+	{"remaining", (getter)Deadline_getremaining, NULL,
+	 "The seconds left or None if there is no timeout.", NULL},
+	{NULL}
+};
+
+
+static PyTypeObject DeadlineType = {
+	PyObject_HEAD_INIT(NULL)
+	0,				/* ob_size */
+	"ponyguruma.Deadline",		/* tp_name */
+	sizeof(Deadline),		/* tp_basicsize */
+	0,				/* tp_itemsize */
+	0,				/* tp_dealloc */
+	0,				/* tp_print */
+	0,				/* tp_getattr */
+	0,				/* tp_setattr */
+	0,				/* tp_compare */
+	0,				/* tp_repr */
+	0,				/* tp_as_number */
+	0,				/* tp_as_sequence */
+	0,				/* tp_as_mapping */
+	0,				/* tp_hash */
+	0,				/* tp_call */
+	0,				/* tp_str */
+	0,				/* tp_getattro */
+	0,				/* tp_setattro */
+	0,				/* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT,		/* tp_flags */
+	"Deadline(timeout=None)\n\n"
+	"A point in time after which matching operations are abandoned "
+	"with\na MatchTimeout error, or a token that can be cancelled from "
+	"another\nthread.",		/* tp_doc */
+	0,				/* tp_traverse */
+	0,				/* tp_clear */
+	0,				/* tp_richcompare */
+	0,				/* tp_weaklistoffset */
+	0,				/* tp_iter */
+	0,				/* tp_iternext */
+	Deadline_methods,		/* tp_methods */
+	0,				/* tp_members */
+	Deadline_getsetters,		/* tp_getset */
+	0,				/* tp_base */
+	0,				/* tp_dict */
+	0,				/* tp_descr_get */
+	0,				/* tp_descr_set */
+	0,				/* tp_dictoffset */
+	0,				/* tp_init */
+	0,				/* tp_alloc */
+	Deadline_new			/* tp_new */
+};
+
+
+static void
+Profiler_dealloc(Profiler *self)
+{
+	if (self->regex)
+		onig_free(self->regex);
+	PyMem_Free(self->progress);
+	PyMem_Free(self->retraction);
+	PyObject_Del(self);
+}
+
+/**
+ * the counters of all callouts as list of (progress, retraction) tuples.
+ */
+static PyObject *
+Profiler_getcounts(Profiler *self, void *closure)
+{
+	PyObject *result, *item;
+	Py_ssize_t i;
+
+	result = PyList_New(self->callouts);
+	if (!result)
+		return NULL;
+	for (i = 0; i < self->callouts; i++) {
+		item = Py_BuildValue("(kk)", self->progress[i],
+				     self->retraction[i]);
+		if (!item) {
+			Py_DECREF(result);
+			return NULL;
+		}
+		PyList_SET_ITEM(result, i, item);
+	}
+	return result;
+}
+
+static PyGetSetDef Profiler_getsetters[] = {
+	{"counts", (getter)Profiler_getcounts, NULL, "", NULL},
 	{NULL}
 };
 
 
-static PyTypeObject MatchStateType = {
-	PyObject_HEAD_INIT(NULL)
-	0,				/* ob_size */
-	"ponyguruma._lowlevel.MatchState", /* tp_name */
-	sizeof(MatchState),		/* tp_basicsize */
-	0,				/* tp_itemsize */
-	(destructor)MatchState_dealloc,	/* tp_dealloc */
-	0,				/* tp_print */
-	0,				/* tp_getattr */
-	0,				/* tp_setattr */
-	0,				/* tp_compare */
-	0,				/* tp_repr */
-	0,				/* tp_as_number */
-	0,				/* tp_as_sequence */
-	0,				/* tp_as_mapping */
-	0,				/* tp_hash */
-	0,				/* tp_call */
-	0,				/* tp_str */
-	0,				/* tp_getattro */
-	0,				/* tp_setattro */
-	0,				/* tp_as_buffer */
-	Py_TPFLAGS_DEFAULT,		/* tp_flags */
-	"internal match state object",	/* tp_doc */
-	0,				/* tp_traverse */
-	0,				/* tp_clear */
-	0,				/* tp_richcompare */
-	0,				/* tp_weaklistoffset */
-	0,				/* tp_iter */
-	0,				/* tp_iternext */
-	0,				/* tp_methods */
-	0,				/* tp_members */
-	MatchState_getsetters,		/* tp_getset */
-};
+static PyTypeObject ProfilerType = {
+	PyObject_HEAD_INIT(NULL)
+	0,				/* ob_size */
+	"ponyguruma._lowlevel.Profiler", /* tp_name */
+	sizeof(Profiler),		/* tp_basicsize */
+	0,				/* tp_itemsize */
+	(destructor)Profiler_dealloc,	/* tp_dealloc */
+	0,				/* tp_print */
+	0,				/* tp_getattr */
+	0,				/* tp_setattr */
+	0,				/* tp_compare */
+	0,				/* tp_repr */
+	0,				/* tp_as_number */
+	0,				/* tp_as_sequence */
+	0,				/* tp_as_mapping */
+	0,				/* tp_hash */
+	0,				/* tp_call */
+	0,				/* tp_str */
+	0,				/* tp_getattro */
+	0,				/* tp_setattro */
+	0,				/* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT,		/* tp_flags */
+	"internal profiler object",	/* tp_doc */
+	0,				/* tp_traverse */
+	0,				/* tp_clear */
+	0,				/* tp_richcompare */
+	0,				/* tp_weaklistoffset */
+	0,				/* tp_iter */
+	0,				/* tp_iternext */
+	0,				/* tp_methods */
+	0,				/* tp_members */
+	Profiler_getsetters,		/* tp_getset */
+};
+
+/**
+ * Convert a string to the type the regexp operates on.  Byte strings are
+ * decoded and unicode strings are encoded using the default encoding,
+ * unless the regexp is in strict mode where a TypeError is raised instead
+ * of copying the string.  Returns a new reference.
+ */
+static PyObject *
+convert_string(BaseRegexp *regexp, PyObject *string)
+{
+	if (regexp->unicode ? PyUnicode_Check(string) : PyString_Check(string)) {
+		Py_INCREF(string);
+		return string;
+	}
+	if (!PyString_Check(string) && !PyUnicode_Check(string)) {
+		PyErr_SetString(PyExc_TypeError, "string to match must be "
+				"string or unicode");
+		return NULL;
+	}
+	if (regexp->strict) {
+		PyErr_SetString(PyExc_TypeError, regexp->unicode
+				? "strict regexp requires a unicode string"
+				: "strict regexp requires a byte string");
+		return NULL;
+	}
+	if (regexp->unicode)
+		/* Decode using default encoding. */
+		return PyUnicode_FromEncodedObject(string, NULL, NULL);
+	/* Encode using default encoding. */
+	return PyUnicode_AsEncodedString(string, NULL, NULL);
+}
+
+/**
+ * Create a subject for a regexp from a string.  If a subject is passed
+ * that was created for a compatible regexp before, it's returned as is.
+ * Returns a new reference.
+ */
+static Subject *
+get_subject(BaseRegexp *regexp, PyObject *string)
+{
+	Subject *subject;
+
+	if (ENSURE_COMPILED(regexp) < 0)
+		return NULL;
+	if (PyObject_TypeCheck(string, &SubjectType)) {
+		subject = (Subject *)string;
+		if ((subject->encoded != NULL) == regexp->utf8 &&
+		    PyUnicode_Check(subject->string) == regexp->unicode &&
+		    subject->enc == onig_get_encoding(regexp->regex)) {
+			if (subject_refresh(subject) < 0)
+				return NULL;
+			Py_INCREF(subject);
+			return subject;
+		}
+		string = subject->string;
+	}
+
+	subject = PyObject_New(Subject, &SubjectType);
+	if (!subject)
+		return NULL;
+	live_subjects++;
+	subject->accounted = 0;
+	subject->has_view = 0;
+	subject->old_buffer = 0;
+	subject->encoded = NULL;
+	subject->enc = onig_get_encoding(regexp->regex);
+	subject->last_byte = subject->last_char = 0;
+	subject->index = NULL;
+	subject->index_skip = NULL;
+
+	/* byte regexps match objects with the buffer interface, like
+	   bytearray or mmap, in place */
+	if (!regexp->unicode && !PyString_Check(string) &&
+	    !PyUnicode_Check(string) && (PyObject_CheckBuffer(string) ||
+					 PyObject_CheckReadBuffer(string))) {
+		const void *buffer;
+		Py_INCREF(string);
+		subject->string = string;
+		/* buffer objects export the new interface without keeping
+		   the object they refer to from resizing */
+		if (PyObject_CheckBuffer(string) && !PyBuffer_Check(string)) {
+			if (PyObject_GetBuffer(string, &subject->view,
+					       PyBUF_SIMPLE) < 0) {
+				Py_DECREF(subject);
+				return NULL;
+			}
+			subject->has_view = 1;
+			buffer = subject->view.buf;
+			subject->size = subject->view.len;
+		}
+		else if (PyObject_AsReadBuffer(string, &buffer,
+						&subject->size) < 0) {
+			Py_DECREF(subject);
+			return NULL;
+		}
+		else
+			subject->old_buffer = 1;
+		subject->str = (UChar *)buffer;
+		subject->length = subject->size;
+		subject->single_byte = ONIGENC_MBC_MAXLEN(subject->enc) == 1;
+		subject->chars = subject->single_byte ? subject->size : -1;
+		account_subject(subject);
+		return subject;
+	}
+
+	subject->string = convert_string(regexp, string);
+	if (!subject->string) {
+		Py_DECREF(subject);
+		return NULL;
+	}
+
+	if (regexp->utf8) {
+		subject->encoded = PyUnicode_AsUTF8String(subject->string);
+		if (!subject->encoded) {
+			Py_DECREF(subject);
+			return NULL;
+		}
+		subject->str = (UChar *) PyString_AS_STRING(subject->encoded);
+		subject->size = PyString_GET_SIZE(subject->encoded);
+		subject->length = PyUnicode_GET_SIZE(subject->string);
+		subject->single_byte = subject->size == subject->length;
+	}
+	else if (regexp->unicode) {
+		subject->str = (UChar *) PyUnicode_AS_UNICODE(subject->string);
+		subject->length = PyUnicode_GET_SIZE(subject->string);
+		subject->size = subject->length * sizeof(Py_UNICODE);
+		subject->single_byte = 0;
+	}
+	else {
+		subject->str = (UChar *) PyString_AS_STRING(subject->string);
+		subject->size = subject->length =
+			PyString_GET_SIZE(subject->string);
+		subject->single_byte = ONIGENC_MBC_MAXLEN(subject->enc) == 1;
+	}
+	subject->chars = subject->single_byte ? subject->size : -1;
+	account_subject(subject);
+	return subject;
+}
+
+
+/**
+ * convert a string once so that it can be matched repeatedly.
+ */
+static PyObject *
+regexp_subject(PyObject *self, PyObject *args)
+{
+	PyObject *string;
+	BaseRegexp *regexp;
+
+	if (!PyArg_ParseTuple(args, "OO:subject", &regexp, &string))
+		return NULL;
+	if (!PyObject_IsInstance((PyObject *)regexp,
+				 (PyObject *)&BaseRegexpType)) {
+		PyErr_SetString(PyExc_TypeError, "regular expression "
+				"object required");
+		return NULL;
+	}
+	return (PyObject *)get_subject(regexp, string);
+}
+
+
+/**
+ * Find the line of a position for grepping.  Returns the number of
+ * newlines between from, which has to be the start of a line, and pos
+ * and the start and the end of the line pos is in.  The end of a line
+ * is the offset of its newline.  Offsets are characters for unicode
+ * strings and bytes otherwise.
+ */
+static PyObject *
+subject_find_line(PyObject *self, PyObject *args)
+{
+	Subject *subject;
+	Py_ssize_t from, pos, start, end, lines = 0;
+	const UChar *s, *p;
+	int chars;
+
+	if (!PyArg_ParseTuple(args, "Onn:subject_find_line", &subject, &from,
+			      &pos))
+		return NULL;
+	if (!PyObject_TypeCheck(subject, &SubjectType)) {
+		PyErr_SetString(PyExc_TypeError, "subject required");
+		return NULL;
+	}
+	chars = PyUnicode_Check(subject->string);
+	if (!chars && ONIGENC_MBC_MINLEN(subject->enc) > 1) {
+		PyErr_SetString(PyExc_ValueError, "lines need an ASCII "
+				"compatible encoding");
+		return NULL;
+	}
+	if (from < 0 || from > pos || pos > subject->length) {
+		PyErr_SetString(PyExc_ValueError, "invalid line offsets");
+		return NULL;
+	}
+	if (subject_refresh(subject) < 0)
+		return NULL;
+	if (chars) {
+		pos = subject_byte_offset(subject, pos);
+		from = subject_byte_offset(subject, from);
+		if (pos == -2 || from == -2)
+			return NULL;
+	}
+
+	s = subject->str;
+	start = from;
+	if (chars && !subject->encoded) {
+		const Py_UNICODE *u = (const Py_UNICODE *)(s + from);
+		const Py_UNICODE *upos = (const Py_UNICODE *)(s + pos);
+		const Py_UNICODE *uend = (const Py_UNICODE *)(s +
+							      subject->size);
+		for (; u < upos; u++)
+			if (*u == '\n') {
+				lines++;
+				start = (const UChar *)(u + 1) - s;
+			}
+		while (u < uend && *u != '\n')
+			u++;
+		end = (const UChar *)u - s;
+	}
+	else {
+		for (p = s + from; p < s + pos; p++) {
+			p = memchr(p, '\n', s + pos - p);
+			if (!p)
+				break;
+			lines++;
+			start = p + 1 - s;
+		}
+		p = memchr(s + pos, '\n', subject->size - pos);
+		end = p ? p - s : subject->size;
+	}
+
+	if (chars) {
+		start = subject_char_offset(subject, start);
+		end = subject_char_offset(subject, end);
+		if (start == -2 || end == -2)
+			return NULL;
+	}
+	return Py_BuildValue("(nnn)", lines, start, end);
+}
+
+
+/**
+ * Return the number of compiled programs and the number of regexps
+ * using them.
+ */
+static PyObject *
+get_program_stats(PyObject *self)
+{
+	PyObject *key, *capsule;
+	Py_ssize_t pos = 0, users = 0;
+
+	while (PyDict_Next(programs, &pos, &key, &capsule))
+		users += ((Program *)PyCapsule_GetPointer(capsule,
+							   NULL))->users;
+	return Py_BuildValue("(nn)", PyDict_Size(programs), users);
+}
+
+
+/**
+ * Compile a lazy regexp now.  Used by compile_many to compile on a
+ * pool of threads.
+ */
+static PyObject *
+regexp_compile(PyObject *self, PyObject *regexp)
+{
+	if (!PyObject_IsInstance(regexp, (PyObject *)&BaseRegexpType)) {
+		PyErr_SetString(PyExc_TypeError, "regular expression "
+				"object required");
+		return NULL;
+	}
+	if (ENSURE_COMPILED((BaseRegexp *)regexp) < 0)
+		return NULL;
+	Py_RETURN_NONE;
+}
+
+/**
+ * Compile a copy of the regexp's pattern with contents callouts for
+ * profiling.  The callouts are numbered in the order they appear in
+ * the pattern, which has to use the same string type as the regexp.
+ */
+static PyObject *
+regexp_profiler(PyObject *self, PyObject *args)
+{
+	BaseRegexp *regexp;
+	PyObject *pattern;
+	Py_ssize_t callouts;
+#ifdef HAVE_MATCH_PARAM
+	PyObject *encoded = NULL;
+	Profiler *profiler;
+	UChar *pstr, *pend;
+	OnigErrorInfo einfo;
+	int rv;
+#endif
+
+	if (!PyArg_ParseTuple(args, "OOn:profiler", &regexp, &pattern,
+			      &callouts))
+		return NULL;
+	if (!PyObject_IsInstance((PyObject *)regexp,
+				 (PyObject *)&BaseRegexpType)) {
+		PyErr_SetString(PyExc_TypeError, "regular expression "
+				"object required");
+		return NULL;
+	}
+#ifdef HAVE_MATCH_PARAM
+	if (ENSURE_COMPILED(regexp) < 0)
+		return NULL;
+	if (regexp->unicode ? !PyUnicode_Check(pattern)
+			    : !PyString_Check(pattern)) {
+		PyErr_SetString(PyExc_TypeError, "pattern type differs "
+				"from the regexp");
+		return NULL;
+	}
+	if (regexp->utf8) {
+		encoded = PyUnicode_AsUTF8String(pattern);
+		if (!encoded)
+			return NULL;
+		pstr = (UChar *) PyString_AS_STRING(encoded);
+		pend = pstr + PyString_GET_SIZE(encoded);
+	}
+	else if (regexp->unicode) {
+		pstr = (UChar *) PyUnicode_AS_UNICODE(pattern);
+		pend = pstr + (PyUnicode_GET_SIZE(pattern) *
+			       sizeof(PY_UNICODE_TYPE));
+	}
+	else {
+		pstr = (UChar *) PyString_AS_STRING(pattern);
+		pend = pstr + PyString_GET_SIZE(pattern);
+	}
+
+	profiler = PyObject_New(Profiler, &ProfilerType);
+	if (!profiler) {
+		Py_XDECREF(encoded);
+		return NULL;
+	}
+	profiler->regex = NULL;
+	profiler->callouts = callouts;
+	profiler->progress = PyMem_New(unsigned long, callouts + 1);
+	profiler->retraction = PyMem_New(unsigned long, callouts + 1);
+	if (!profiler->progress || !profiler->retraction) {
+		Py_XDECREF(encoded);
+		Py_DECREF(profiler);
+		return PyErr_NoMemory();
+	}
+	memset(profiler->progress, 0, sizeof(unsigned long) * (callouts + 1));
+	memset(profiler->retraction, 0, sizeof(unsigned long) * (callouts + 1));
+
+	/* the same syntax with support for (?{...}) callouts */
+	onig_copy_syntax(&profiler->syntax, onig_get_syntax(regexp->regex));
+	onig_set_syntax_op2(&profiler->syntax,
+			    onig_get_syntax_op2(&profiler->syntax) |
+			    ONIG_SYN_OP2_QMARK_BRACE_CALLOUT_CONTENTS);
+	rv = onig_new(&profiler->regex, pstr, pend,
+		      onig_get_options(regexp->regex),
+		      onig_get_encoding(regexp->regex), &profiler->syntax,
+		      &einfo);
+	Py_XDECREF(encoded);
+	if (rv != ONIG_NORMAL) {
+		UChar s[ONIG_MAX_ERROR_MESSAGE_LEN];
+		onig_error_code_to_str(s, rv, &einfo);
+		PyErr_SetString(RegexpError, (char *)s);
+		Py_DECREF(profiler);
+		return NULL;
+	}
+	return (PyObject *)profiler;
+#else
+	PyErr_SetString(PyExc_NotImplementedError, "profiling requires "
+			"oniguruma 6.8 or later");
+	return NULL;
+#endif
+}
+
+
+/**
+ * Raise the exception for an error code oniguruma returned while
+ * matching.  Exceeding one of the limits raises a MatchLimitError.
+ */
+static void
+set_match_error(int rv)
+{
+	UChar s[ONIG_MAX_ERROR_MESSAGE_LEN];
+	PyObject *exc = RegexpError;
+
+	switch (rv) {
+	case DEADLINE_EXPIRED:
+		PyErr_SetString(MatchTimeout, "deadline expired");
+		return;
+#ifdef ONIGERR_MATCH_STACK_LIMIT_OVER
+	case ONIGERR_MATCH_STACK_LIMIT_OVER:
+#endif
+#ifdef ONIGERR_RETRY_LIMIT_IN_MATCH_OVER
+	case ONIGERR_RETRY_LIMIT_IN_MATCH_OVER:
+#endif
+#ifdef ONIGERR_RETRY_LIMIT_IN_SEARCH_OVER
+	case ONIGERR_RETRY_LIMIT_IN_SEARCH_OVER:
+#endif
+		exc = MatchLimitError;
+		break;
+	case ONIGERR_MEMORY:
+		PyErr_NoMemory();
+		return;
+	}
+	onig_error_code_to_str(s, rv);
+	PyErr_SetString(exc, (char *)s);
+}
+
+
+#ifdef HAVE_MATCH_PARAM
+/**
+ * Callout function of profilers, counts how often the engine reached
+ * a callout and how often it backtracked over it.
+ */
+static int
+profiler_callout(OnigCalloutArgs *args, void *user_data)
+{
+	Profiler *profiler = (Profiler *)user_data;
+	int num = onig_get_callout_num_by_callout_args(args) - 1;
+
+	if (num >= 0 && num < profiler->callouts) {
+		if (onig_get_callout_in_by_callout_args(args) ==
+		    ONIG_CALLOUT_IN_RETRACTION)
+			profiler->retraction[num]++;
+		else
+			profiler->progress[num]++;
+	}
+	return ONIG_CALLOUT_SUCCESS;
+}
+#endif
+
+/**
+ * Match or search with the instrumented pattern of a profiler.
+ */
+static int
+match_with_profiler(BaseRegexp *regexp, Profiler *profiler, UChar *str,
+		    UChar *start, UChar *end, OnigRegion *region,
+		    int from_start)
+{
+#ifdef HAVE_MATCH_PARAM
+	OnigMatchParam *mp = copy_match_param(regexp);
+	int rv;
+
+	if (!mp)
+		return ONIGERR_MEMORY;
+	onig_set_progress_callout_of_match_param(mp, profiler_callout);
+	onig_set_retraction_callout_of_match_param(mp, profiler_callout);
+	onig_set_callout_user_data_of_match_param(mp, profiler);
+	rv = (from_start)
+		? onig_match_with_param(profiler->regex, str, end, start,
+					region, ONIG_OPTION_NONE, mp)
+		: onig_search_with_param(profiler->regex, str, end, start,
+					 end, region, ONIG_OPTION_NONE, mp);
+	onig_free_match_param(mp);
+	return rv;
+#else
+	/* profilers can't be created without match params */
+	return ONIG_MISMATCH;
+#endif
+}
+
+
+/**
+ * Match or search with a deadline.  Forward searches run onig_search
+ * with a retry budget (see HAVE_SEARCH_BUDGET) so that searches that
+ * don't backtrack much run at full speed, and check the deadline when
+ * the budget is used up.  onig_search can't be used for parts of the
+ * subject as its optimizer doesn't look at data after the end of the
+ * search range, so a search that used up its budget continues with
+ * single attempts that check the deadline after each one.  Without
+ * retry budgets (oniguruma before 6.9.5) every search works like this,
+ * which is about a hundred times slower than onig_search.
+ *
+ * Scanning for the literals of a pattern doesn't count as retries, so a
+ * search that doesn't backtrack only checks the deadline at the end.
+ * The GIL is released while matching so that other threads can cancel
+ * the deadline, unless keep_gil is true because another thread could
+ * close the buffer.  A single match attempt can't be interrupted, use a
+ * retry limit to bound that.  If range is before start the positions
+ * are tried backwards.
+ */
+static int
+match_with_deadline(BaseRegexp *regexp, UChar *str, UChar *start,
+		    UChar *end, UChar *range, OnigRegion *region,
+		    int from_start, Deadline *deadline, int keep_gil)
+{
+	OnigEncoding enc = onig_get_encoding(regexp->regex);
+	PyThreadState *save;
+	double started, slice = DEADLINE_SLICE;
+	int rv = ONIG_MISMATCH;
+#ifdef HAVE_SEARCH_BUDGET
+	unsigned long budget = DEADLINE_BUDGET;
+	double now, allowed;
+#endif
+#ifdef HAVE_MATCH_PARAM
+	/* the param of the regexp isn't used as other threads may use
+	   the regexp while the GIL is released */
+	OnigMatchParam *mp = NULL;
+
+#  ifdef HAVE_SEARCH_BUDGET
+	if (regexp->match_param || !from_start) {
+#  else
+	if (regexp->match_param) {
+#  endif
+		mp = copy_match_param(regexp);
+		if (!mp)
+			return ONIGERR_MEMORY;
+	}
+#  define DO_MATCH(at) (mp \
+	? onig_match_with_param(regexp->regex, str, end, at, region, \
+				ONIG_OPTION_NONE, mp) \
+	: onig_match(regexp->regex, str, end, at, region, ONIG_OPTION_NONE))
+#  define DO_SEARCH(from, to) (mp \
+	? onig_search_with_param(regexp->regex, str, end, from, to, region, \
+				 ONIG_OPTION_NONE, mp) \
+	: onig_search(regexp->regex, str, end, from, to, region, \
+		      ONIG_OPTION_NONE))
+#else
+#  define DO_MATCH(at) onig_match(regexp->regex, str, end, at, region, \
+				  ONIG_OPTION_NONE)
+#  define DO_SEARCH(from, to) onig_search(regexp->regex, str, end, from, \
+					  to, region, ONIG_OPTION_NONE)
+#endif
+
+	save = keep_gil ? NULL : PyEval_SaveThread();
+	if (deadline_expired(deadline))
+		rv = DEADLINE_EXPIRED;
+	else if (from_start)
+		rv = DO_MATCH(start);
+	else if (regexp->search_anchor)
+		/* \G refers to the start of the search, it can't be split */
+		rv = DO_SEARCH(start, range);
+	else if (range < start) {
+		for (;;) {
+			rv = DO_MATCH(start);
+			if (rv != ONIG_MISMATCH || start <= range)
+				break;
+			start = onigenc_get_prev_char_head(enc, str, start);
+			if (!start || start < range)
+				break;
+			if (deadline_expired(deadline)) {
+				rv = DEADLINE_EXPIRED;
+				break;
+			}
+		}
+	}
+	else {
+		started = monotonic_time();
+		for (;;) {
+#ifdef HAVE_SEARCH_BUDGET
+			onig_set_retry_limit_in_search_of_match_param(mp,
+								      budget);
+			rv = DO_SEARCH(start, range);
+			if (rv != ONIGERR_RETRY_LIMIT_IN_SEARCH_OVER)
+				break;
+			/* the budget applies to single attempts too */
+			onig_set_retry_limit_in_search_of_match_param(mp, 0);
+			rv = ONIG_MISMATCH;
+			now = monotonic_time();
+			allowed = deadline->expires > 0.0
+				? (deadline->expires - now) / 8
+				: DEADLINE_LATENCY;
+			slice = now - started;
+			if (slice * 2 < allowed && budget < ULONG_MAX / 2) {
+				budget *= 2;
+				slice = DEADLINE_SLICE;
+			}
+			else if (slice < DEADLINE_SLICE)
+				slice = DEADLINE_SLICE;
+			started = now;
+#endif
+			if (deadline_expired(deadline)) {
+				rv = DEADLINE_EXPIRED;
+				break;
+			}
+			while (monotonic_time() - started < slice) {
+				rv = DO_MATCH(start);
+				if (rv != ONIG_MISMATCH || start >= range)
+					goto done;
+				start += ONIGENC_MBC_ENC_LEN(enc, start);
+				if (start > range)
+					goto done;
+				if (deadline_expired(deadline)) {
+					rv = DEADLINE_EXPIRED;
+					goto done;
+				}
+			}
+			started = monotonic_time();
+		}
+	}
+done:
+	if (save)
+		PyEval_RestoreThread(save);
+
+#undef DO_MATCH
+#undef DO_SEARCH
+#ifdef HAVE_MATCH_PARAM
+	if (mp)
+		onig_free_match_param(mp);
+#endif
+	return rv;
+}
+
+
+/**
+ * Search backwards from start to range.  The backward search of
+ * onig_search misses matches of exact strings that end after the start
+ * position, so this searches forward through blocks before start and
+ * takes the last match of the first block that has one.  The blocks
+ * grow so that the time spent is proportional to the distance of the
+ * match from start.  The forward searches can't stop at the end of the
+ * block as onig_search doesn't look at data after the range, they stop
+ * at the first match after it instead.
+ */
+static int
+search_backward(BaseRegexp *regexp, UChar *str, UChar *start, UChar *end,
+		UChar *range, OnigRegion *region)
+{
+	OnigEncoding enc = onig_get_encoding(regexp->regex);
+	UChar *low, *high = start, *s, *found = NULL;
+	Py_ssize_t block = BACKWARD_BLOCK;
+	int rv;
+
+#ifdef HAVE_MATCH_PARAM
+#  define DO_SEARCH(from, to) (regexp->match_param \
+	? onig_search_with_param(regexp->regex, str, end, from, to, region, \
+				 ONIG_OPTION_NONE, regexp->match_param) \
+	: onig_search(regexp->regex, str, end, from, to, region, \
+		      ONIG_OPTION_NONE))
+#else
+#  define DO_SEARCH(from, to) onig_search(regexp->regex, str, end, from, \
+					  to, region, ONIG_OPTION_NONE)
+#endif
+
+	for (;;) {
+		low = high - range > block ? onigenc_get_left_adjust_char_head(
+			enc, str, high - block) : range;
+		for (s = low; s <= high;) {
+			rv = DO_SEARCH(s, end);
+			if (rv == ONIG_MISMATCH || str + rv > high)
+				break;
+			if (rv < 0)
+				return rv;
+			found = str + rv;
+			if (found == end)
+				break;
+			s = found + ONIGENC_MBC_ENC_LEN(enc, found);
+		}
+		if (found || low == range)
+			break;
+		high = onigenc_get_prev_char_head(enc, str, low);
+		if (!high || high < range)
+			break;
+		block *= 2;
+	}
+#undef DO_SEARCH
+
+	if (!found)
+		return ONIG_MISMATCH;
+	/* the region of the last search isn't the one of the match */
+#ifdef HAVE_MATCH_PARAM
+	if (regexp->match_param)
+		rv = onig_match_with_param(regexp->regex, str, end, found,
+					   region, ONIG_OPTION_NONE,
+					   regexp->match_param);
+	else
+#endif
+	rv = onig_match(regexp->regex, str, end, found, region,
+			ONIG_OPTION_NONE);
+	return rv < 0 ? rv : (int)(found - str);
+}
+
+
+/**
+ * Find string data in the buffer between start and end.  Unicode data
+ * is compared by character so that a match can't be misaligned.  With
+ * from_start the data has to be at start.
+ */
+static UChar *
+find_data(PyObject *data, UChar *start, UChar *end, int from_start)
+{
+	UChar *needle, *s, *last;
+	Py_ssize_t size;
+
+	if (PyUnicode_Check(data)) {
+		needle = (UChar *)PyUnicode_AS_DATA(data);
+		size = PyUnicode_GET_DATA_SIZE(data);
+	}
+	else {
+		needle = (UChar *)PyString_AS_STRING(data);
+		size = PyString_GET_SIZE(data);
+	}
+	if (end - start < size)
+		return NULL;
+	last = end - size;
+
+	if (from_start)
+		return memcmp(start, needle, size) ? NULL : start;
+	if (PyUnicode_Check(data)) {
+		Py_UNICODE first = *(Py_UNICODE *)needle, *u;
+		for (u = (Py_UNICODE *)start; (UChar *)u <= last; u++)
+			if (*u == first && !memcmp(u, needle, size))
+				return (UChar *)u;
+		return NULL;
+	}
+	for (s = start; s <= last; s++) {
+		s = memchr(s, needle[0], last - s + 1);
+		if (!s)
+			break;
+		if (!memcmp(s, needle, size))
+			return s;
+	}
+	return NULL;
+}
+
+
+/**
+ * Like find_data but find the last occurrence of the data that starts
+ * between low and high and ends before end.
+ */
+static UChar *
+find_data_backward(PyObject *data, UChar *low, UChar *high, UChar *end)
+{
+	UChar *needle, *s;
+	Py_ssize_t size;
+
+	if (PyUnicode_Check(data)) {
+		needle = (UChar *)PyUnicode_AS_DATA(data);
+		size = PyUnicode_GET_DATA_SIZE(data);
+	}
+	else {
+		needle = (UChar *)PyString_AS_STRING(data);
+		size = PyString_GET_SIZE(data);
+	}
+	if (end - low < size)
+		return NULL;
+	if (high > end - size)
+		high = end - size;
+
+	if (PyUnicode_Check(data)) {
+		Py_UNICODE first = *(Py_UNICODE *)needle, *u;
+		for (u = (Py_UNICODE *)high; (UChar *)u >= low; u--)
+			if (*u == first && !memcmp(u, needle, size))
+				return (UChar *)u;
+		return NULL;
+	}
+	for (s = high; s >= low; s--)
+		if (*s == needle[0] && !memcmp(s, needle, size))
+			return s;
+	return NULL;
+}
+
+
+/**
+ * Match or search a literal pattern with a substring search instead of
+ * the engine.  Like onig_search this returns the offset of the match or
+ * ONIG_MISMATCH.
+ */
+static int
+match_literal(BaseRegexp *regexp, UChar *str, UChar *start, UChar *end,
+	      UChar *range, OnigRegion *region, int from_start)
+{
+	UChar *found = range < start
+		? find_data_backward(regexp->literal_data, range, start, end)
+		: find_data(regexp->literal_data, start, end, from_start);
+	Py_ssize_t size = PyUnicode_Check(regexp->literal_data)
+		? PyUnicode_GET_DATA_SIZE(regexp->literal_data)
+		: PyString_GET_SIZE(regexp->literal_data);
+
+	if (!found)
+		return ONIG_MISMATCH;
+	if (onig_region_resize(region, 1) != ONIG_NORMAL)
+		return ONIGERR_MEMORY;
+	onig_region_set(region, 0, found - str, found - str + size);
+	return found - str;
+}
+
+
+/**
+ * Check that the subject contains the required literals of a regexp
+ * between start and end.
+ */
+static int
+has_required_data(BaseRegexp *regexp, UChar *start, UChar *end)
+{
+	Py_ssize_t i;
+
+	for (i = 0; i < PyTuple_GET_SIZE(regexp->required_data); i++)
+		if (!find_data(PyTuple_GET_ITEM(regexp->required_data, i),
+			       start, end, 0))
+			return 0;
+	return 1;
+}
+
+
+/**
+ * Call ponyguruma.slow_match_func for an engine call that took longer
+ * than the slow match threshold.
+ */
+static int
+report_slow_match(BaseRegexp *regexp, Py_ssize_t length, Py_ssize_t pos,
+		  Py_ssize_t endpos, double elapsed)
+{
+	PyObject *module, *slow_match_func, *result;
+
+	module = PyImport_ImportModule("ponyguruma");
+	if (!module)
+		return -1;
+	slow_match_func = PyObject_GetAttrString(module, "slow_match_func");
+	Py_DECREF(module);
+	if (!slow_match_func)
+		return -1;
+	result = PyObject_CallFunction(slow_match_func, "Onnnd", regexp,
+				       length, pos, endpos, elapsed);
+	Py_DECREF(slow_match_func);
+	if (!result)
+		return -1;
+	Py_DECREF(result);
+	return 0;
+}
+
+
+/**
+ * Match or search with the profiler, the deadline or the fastest way
+ * available.  Searches try the start positions from start to range,
+ * backwards if range is before start.  Offsets in the region are
+ * relative to str and have to fit into an int.  keep_gil is true for
+ * subjects with the old buffer interface.
+ */
+static int
+run_match(BaseRegexp *regexp, PyObject *profiler, PyObject *deadline,
+	  UChar *str, UChar *start, UChar *end, UChar *range,
+	  OnigRegion *region, int from_start, int keep_gil)
+{
+	if (profiler != Py_None)
+		return match_with_profiler(regexp, (Profiler *)profiler, str,
+					   start, end, region, from_start);
+	if (deadline != Py_None && deadline_expired((Deadline *)deadline))
+		return DEADLINE_EXPIRED;
+	if (regexp->literal && (from_start || range == end || range < start))
+		return match_literal(regexp, str, start, end, range, region,
+				     from_start);
+	/* anchored matches fail faster than a scan of the whole subject.
+	   the check goes up to the end, so backward searches, which
+	   should only look at the end, don't do it */
+	if (!from_start && range == end && regexp->required_data &&
+	    !has_required_data(regexp, start, end))
+		return ONIG_MISMATCH;
+	if (deadline != Py_None)
+		return match_with_deadline(regexp, str, start, end, range,
+					   region, from_start,
+					   (Deadline *)deadline, keep_gil);
+	if (!from_start && range != end)
+		return search_backward(regexp, str, start, end, range, region);
+#ifdef HAVE_MATCH_PARAM
+	if (regexp->match_param)
+		return (from_start)
+			? onig_match_with_param(regexp->regex, str, end, start,
+						region, ONIG_OPTION_NONE,
+						regexp->match_param)
+			: onig_search_with_param(regexp->regex, str, end,
+						 start, range, region,
+						 ONIG_OPTION_NONE,
+						 regexp->match_param);
+#endif
+	return (from_start)
+		? onig_match(regexp->regex, str, end, start, region,
+			     ONIG_OPTION_NONE)
+		: onig_search(regexp->regex, str, end, start, range, region,
+			      ONIG_OPTION_NONE);
+}
+
+
+/**
+ * Like run_match for subjects larger than 2 GiB.  The search goes
+ * through windows of at most INT_MAX bytes, the offset of the window
+ * the region is relative to is stored in window.  A single match can't
+ * be longer than WINDOW_MARGIN bytes.
+ */
+static int
+run_match_windowed(BaseRegexp *regexp, PyObject *profiler,
+		   PyObject *deadline, UChar *str, UChar *start, UChar *end,
+		   UChar *range, OnigRegion *region, int from_start,
+		   int keep_gil, Py_ssize_t *window)
+{
+	OnigEncoding enc = onig_get_encoding(regexp->regex);
+	UChar *base, *limit, *reliable, *low;
+	int rv;
+
+	/* backward searches start at the end, every window leaves room
+	   for matches that start at its last position */
+	while (range < start) {
+		limit = end - start > WINDOW_MARGIN
+			? start + WINDOW_MARGIN : end;
+		base = limit - str > INT_MAX ? limit - INT_MAX : str;
+		base = onigenc_get_left_adjust_char_head(enc, str, base);
+		low = base == str || range - base >= WINDOW_CONTEXT ? range
+			: onigenc_get_left_adjust_char_head(
+				enc, str, base + WINDOW_CONTEXT);
+		*window = base - str;
+		rv = run_match(regexp, profiler, deadline, base, start, limit,
+			       low, region, 0, keep_gil);
+		if (rv != ONIG_MISMATCH || low == range)
+			return rv;
+		start = low;
+	}
+
+	for (;;) {
+		base = start - str > WINDOW_CONTEXT
+			? start - WINDOW_CONTEXT : str;
+		base = onigenc_get_left_adjust_char_head(enc, str, base);
+		limit = end - base > INT_MAX ? base + INT_MAX : end;
+		*window = base - str;
+		rv = run_match(regexp, profiler, deadline, base, start, limit,
+			       limit, region, from_start, keep_gil);
+		if (limit == end || from_start ||
+		    (rv < 0 && rv != ONIG_MISMATCH))
+			return rv;
+
+		/* only matches that start before the margin are known to
+		   fit into the window */
+		reliable = onigenc_get_left_adjust_char_head(
+			enc, str, limit - WINDOW_MARGIN);
+		if (rv >= 0 && base + region->beg[0] < reliable)
+			return rv;
+		start = rv >= 0 ? base + region->beg[0] : reliable;
+	}
+}
+
+
+/**
+ * Append the spans of the matches a forward search finds in the
+ * RFIND_BLOCK bytes before the match of a backward search to a list,
+ * like find does, up to the match that starts at or covers that match.
+ * rfind yields them backwards, so that it doesn't have to search
+ * backwards from every match it finds.  low is the lowest position a
+ * match may start at and end the end of the subject.
+ */
+static int
+collect_spans(MatchState *state, PyObject *deadline, UChar *low,
+	      UChar *end, PyObject *spans)
+{
+	BaseRegexp *regexp = state->regexp;
+	Subject *subject = state->subject;
+	OnigEncoding enc = onig_get_encoding(regexp->regex);
+	UChar *base = subject->str + state->window, *found, *limit, *s;
+	OnigRegion *region;
+	Py_ssize_t start, stop;
+	PyObject *span;
+	int rv = ONIG_MISMATCH, failed = 0;
+
+	found = base + state->region->beg[0];
+	limit = end - base > INT_MAX ? base + INT_MAX : end;
+	s = found - base > RFIND_BLOCK ? found - RFIND_BLOCK : base;
+	if (s < low)
+		s = low;
+	s = onigenc_get_right_adjust_char_head(enc, base, s);
+	region = onig_region_new();
+	if (!region) {
+		PyErr_NoMemory();
+		return -1;
+	}
+
+	while (s <= found) {
+		rv = run_match(regexp, Py_None, deadline, base, s, limit,
+			       limit, region, 0, subject->old_buffer);
+		if (rv < 0 || base + rv > found)
+			break;
+		start = state->window + rv;
+		stop = state->window + region->end[0];
+		if (regexp->unicode) {
+			start = subject_char_offset(subject, start);
+			stop = subject_char_offset(subject, stop);
+			if (start == -2 || stop == -2) {
+				failed = 1;
+				break;
+			}
+		}
+		span = Py_BuildValue("(nn)", start, stop);
+		if (!span || PyList_Append(spans, span) < 0) {
+			Py_XDECREF(span);
+			failed = 1;
+			break;
+		}
+		Py_DECREF(span);
+		/* the next match starts after this one, empty matches
+		   move on by a character */
+		s = base + region->end[0];
+		if (region->end[0] == rv) {
+			if (s >= limit)
+				break;
+			s += ONIGENC_MBC_ENC_LEN(enc, s);
+		}
+	}
+	onig_region_free(region, 1);
+
+	if (failed)
+		return -1;
+	if (rv < 0 && rv != ONIG_MISMATCH) {
+		if (!PyErr_Occurred())
+			set_match_error(rv);
+		return -1;
+	}
+	return 0;
+}
+
+
+/**
+ * regexp match/search function.  If last is given the search goes
+ * backwards from that position, -1 means endpos, to pos, and if spans
+ * is a list the spans of the matches before the match are added to it
+ * as collect_spans does.  If base is given the engine only sees the
+ * subject from there on, as if the string started at base.
+ */
+static PyObject *
+regexp_match(PyObject *self, PyObject *args)
+{
+	PyObject *string, *from_start, *deadline = Py_None;
+	PyObject *profiler = Py_None, *last = Py_None, *spans = Py_None;
+	BaseRegexp *regexp;
+	Subject *subject;
+	Py_ssize_t pos, endpos, pos_offset, endpos_offset, last_pos = -1;
+	Py_ssize_t last_offset, base = 0, base_offset = 0, window = 0;
+	int ifrom_start, rv, stats, timed, tracking = track_overhead;
+	double started = 0.0, elapsed = 0.0, marks[OVERHEAD_ENGINE] = {0.0};
+	MatchState *state = NULL;
+	UChar *str, *str_start, *str_end, *str_range;
+
+	if (tracking)
+		marks[OVERHEAD_PARSE] = monotonic_time();
+	if (!PyArg_ParseTuple(args, "OOnnO|OOOOn:match", &regexp, &string,
+			      &pos, &endpos, &from_start, &deadline,
+			      &profiler, &last, &spans, &base))
+		return NULL;
+	if (tracking)
+		marks[OVERHEAD_TYPECHECK] = monotonic_time();
+	if (!PyObject_IsInstance((PyObject *)regexp,
+				      (PyObject *)&BaseRegexpType)) {
+		PyErr_SetString(PyExc_TypeError, "regular expression "
+				"object required");
+		return NULL;
+	}
+	if (deadline != Py_None && !PyObject_TypeCheck(deadline, &DeadlineType)) {
+		PyErr_SetString(PyExc_TypeError, "deadline must be a Deadline "
+				"or None");
+		return NULL;
+	}
+	if (spans != Py_None && !PyList_Check(spans)) {
+		PyErr_SetString(PyExc_TypeError, "spans must be a list or "
+				"None");
+		return NULL;
+	}
+	if (profiler != Py_None &&
+	    !PyObject_TypeCheck(profiler, &ProfilerType)) {
+		PyErr_SetString(PyExc_TypeError, "profiler must be a Profiler "
+				"or None");
+		return NULL;
+	}
+	if (pos < 0) {
+		PyErr_SetString(PyExc_ValueError, "pos must be >= 0");
+		return NULL;
+	}
+	if (base < 0 || base > pos) {
+		PyErr_SetString(PyExc_ValueError, "base must be between 0 "
+				"and pos");
+		return NULL;
+	}
+	ifrom_start = PyObject_IsTrue(from_start);
+	if (ifrom_start < 0)
+		return NULL;
+	if (last != Py_None) {
+		last_pos = PyInt_AsSsize_t(last);
+		if (last_pos == -1 && PyErr_Occurred())
+			return NULL;
+		if (last_pos < -1) {
+			PyErr_SetString(PyExc_ValueError, "last must be >= -1");
+			return NULL;
+		}
+	}
+	if (tracking)
+		marks[OVERHEAD_SUBJECT] = monotonic_time();
+	subject = get_subject(regexp, string);
+	if (!subject)
+		return NULL;
+	if (endpos == -1)
+		endpos = subject->length;
+	if (endpos < 0) {
+		PyErr_SetString(PyExc_ValueError, "endpos must be >= -1, where "
+				"-1 means the length of the string to match");
+		Py_DECREF(subject);
+		return NULL;
+	}
+	/* like sre, an endpos past the end means the end of the string */
+	if (endpos > subject->length)
+		endpos = subject->length;
+
+	if (last_pos == -1 || last_pos > endpos)
+		last_pos = endpos;
+
+	/* positions into unicode strings are character offsets.  convert
+	   the end first so that the offset cache of utf-8 subjects is left
+	   at the start position */
+	if (regexp->unicode) {
+		endpos_offset = subject_byte_offset(subject, endpos);
+		last_offset = last == Py_None ? endpos_offset
+			: subject_byte_offset(subject, last_pos);
+		base_offset = base ? subject_byte_offset(subject, base) : 0;
+		pos_offset = subject_byte_offset(subject, pos);
+		if (endpos_offset == -2 || last_offset == -2 ||
+		    base_offset == -2 || pos_offset == -2) {
+			Py_DECREF(subject);
+			return NULL;
+		}
+	}
+	else {
+		endpos_offset = endpos;
+		last_offset = last_pos;
+		base_offset = base;
+		pos_offset = pos;
+	}
+	str = subject->str;
+	str_start = str + pos_offset;
+	str_end = str + endpos_offset;
+	str_range = str_end;
+
+	if (str_start > str_end) {
+		Py_DECREF(subject);
+		goto nomatch;
+	}
+	/* backward searches start at last, which may be in the middle of
+	   a character of a multibyte byte string */
+	if (last != Py_None && !ifrom_start) {
+		str_range = str_start;
+		str_start = onigenc_get_left_adjust_char_head(
+			subject->enc, str, str + last_offset);
+		if (str_start < str_range) {
+			Py_DECREF(subject);
+			goto nomatch;
+		}
+	}
+	str += base_offset;
+
+	if (tracking)
+		marks[OVERHEAD_REGION] = monotonic_time();
+	state = PyObject_New(MatchState, &MatchStateType);
+	if (!state) {
+		Py_DECREF(subject);
+		return NULL;
+	}
+	live_states++;
+	state->accounted = 0;
+	state->detached = 0;
+	state->byte_base = state->char_base = 0;
+	state->window = base_offset;
+	Py_INCREF(regexp);
+	state->regexp = regexp;
+	state->region = onig_region_new();
+	state->subject = subject;
+	state->pos = pos;
+	state->endpos = endpos;
+
+	stats = regexp->collect_stats || collect_all_stats;
+	timed = stats || tracking || slow_match_threshold > 0.0;
+	if (stats && register_stats(regexp) < 0) {
+		Py_DECREF(state);
+		return NULL;
+	}
+	if (timed)
+		started = monotonic_time();
+	if (tracking) {
+		record_overhead(OVERHEAD_PARSE, marks[OVERHEAD_TYPECHECK] -
+				marks[OVERHEAD_PARSE]);
+		record_overhead(OVERHEAD_TYPECHECK, marks[OVERHEAD_SUBJECT] -
+				marks[OVERHEAD_TYPECHECK]);
+		record_overhead(OVERHEAD_SUBJECT, marks[OVERHEAD_REGION] -
+				marks[OVERHEAD_SUBJECT]);
+		record_overhead(OVERHEAD_REGION, started -
+				marks[OVERHEAD_REGION]);
+	}
+
+	if (str_end - str <= INT_MAX)
+		rv = run_match(regexp, profiler, deadline, str, str_start,
+			       str_end, str_range, state->region, ifrom_start,
+			       subject->old_buffer);
+	else
+		rv = run_match_windowed(regexp, profiler, deadline, str,
+					str_start, str_end, str_range,
+					state->region, ifrom_start,
+					subject->old_buffer, &window);
+	state->window += window;
+
+	if (timed)
+		elapsed = monotonic_time() - started;
+	if (tracking)
+		record_overhead(OVERHEAD_ENGINE, elapsed);
+	if (stats) {
+		regexp->engine_time += elapsed;
+		regexp->bytes_scanned += str_end - (str_range < str_start
+						    ? str_range : str_start);
+		regexp->calls++;
+		if (rv >= 0)
+			regexp->hits++;
+		else if (rv == ONIG_MISMATCH)
+			regexp->misses++;
+	}
+	if (slow_match_threshold > 0.0 && elapsed >= slow_match_threshold &&
+	    !PyErr_Occurred() &&
+	    report_slow_match(regexp, subject->length, pos, endpos,
+			      elapsed) < 0) {
+		Py_DECREF(state);
+		return NULL;
+	}
+
+	if (rv >= 0 && spans != Py_None && last != Py_None && !ifrom_start &&
+	    collect_spans(state, deadline, str_range, str_end, spans) < 0) {
+		Py_DECREF(state);
+		return NULL;
+	}
+	if (rv >= 0) {
+		account_state(state);
+		return (PyObject *) state;
+	}
+	if (rv != ONIG_MISMATCH) {
+		if (!PyErr_Occurred())
+			set_match_error(rv);
+		Py_DECREF(state);
+		return NULL;
+	}
+
+nomatch:
+	Py_XDECREF(state);
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+
+/**
+ * get a tuple of group spans.  If chars is true the spans are character
+ * offsets even for byte strings in multibyte encodings.
+ */
+static PyObject *
+get_groups(MatchState *state, int chars)
+{
+	OnigRegion *region = state->region;
+	Subject *subject = state->subject;
+	Py_ssize_t beg, end;
+	int count, i;
+	PyObject *rv;
+
+	count = region->num_regs;
+	chars = chars || state->regexp->unicode;
+	if (chars && subject_refresh(subject) < 0)
+		return NULL;
+
+	rv = PyTuple_New(count);
+	if (!rv)
+		return NULL;
+
+	for (i = 0; i < count; i++) {
+		PyObject *pair;
+		beg = region->beg[i];
+		end = region->end[i];
+		if (beg >= 0) {
+			beg += state->window;
+			end += state->window;
+		}
+		if (chars) {
+			beg = subject_char_offset(subject, beg);
+			end = subject_char_offset(subject, end);
+			if (beg == -2 || end == -2) {
+				Py_DECREF(rv);
+				return NULL;
+			}
+		}
+		/* groups of detached matches are relative to the part of
+		   the string that was kept */
+		if (beg >= 0) {
+			beg += chars ? state->char_base : state->byte_base;
+			end += chars ? state->char_base : state->byte_base;
+		}
+		pair = Py_BuildValue("(nn)", beg, end);
+		if (!pair) {
+			Py_DECREF(rv);
+			return NULL;
+		}
+		PyTuple_SET_ITEM(rv, i, pair);
+	}
+
+	return rv;
+}
+
+static PyObject *
+match_get_groups(PyObject *self, PyObject *state)
+{
+	if (!PyObject_IsInstance(state, (PyObject *)&MatchStateType)) {
+		PyErr_SetString(PyExc_TypeError, "match state required");
+		return NULL;
+	}
+	return get_groups((MatchState *)state, 0);
+}
+
+static PyObject *
+match_get_char_groups(PyObject *self, PyObject *state)
+{
+	if (!PyObject_IsInstance(state, (PyObject *)&MatchStateType)) {
+		PyErr_SetString(PyExc_TypeError, "match state required");
+		return NULL;
+	}
+	return get_groups((MatchState *)state, 1);
+}
+
+
+/**
+ * get a dict for idx -> name
+ */
+typedef struct {
+	PyObject *names;
+	BaseRegexp *regexp;
+} GroupNames;
+
+static int
+iterate_group_names(const UChar *name, const UChar *name_end,
+		    int ngroup_num, int *group_nums, regex_t *reg,
+		    void *arg)
+{
+	GroupNames *info = (GroupNames *)arg;
+	PyObject *key, *value;
+	Py_ssize_t len = name_end - name;
+	int i, rv = 0;
+
+	/* the name is in the encoding of the pattern and not terminated */
+	if (info->regexp->utf8)
+		key = PyUnicode_DecodeUTF8((char *)name, len, NULL);
+	else if (info->regexp->unicode)
+		key = PyUnicode_FromUnicode((Py_UNICODE *)name,
+					    len / sizeof(Py_UNICODE));
+	else
+		key = PyString_FromStringAndSize((char *)name, len);
+	if (!key)
+		return -1;
+
+	for (i = 0; i < ngroup_num && rv == 0; i++) {
+		value = PyInt_FromLong(group_nums[i]);
+		if (!value || PyDict_SetItem(info->names, key, value) < 0)
+			rv = -1;
+		Py_XDECREF(value);
+	}
+	Py_DECREF(key);
+	return rv;
+}
+
+
+static PyObject *
+match_get_group_names(PyObject *self, PyObject *state)
+{
+	GroupNames info;
+	regex_t *regex;
+
+	if (!PyObject_IsInstance(state, (PyObject *)&MatchStateType)) {
+		PyErr_SetString(PyExc_TypeError, "match state required");
+		return NULL;
+	}
+
+	info.names = PyDict_New();
+	if (!info.names)
+		return NULL;
+	info.regexp = ((MatchState *)state)->regexp;
+
+	regex = info.regexp->regex;
+	if (onig_number_of_names(regex)) {
+		if (onig_foreach_name(regex, iterate_group_names,
+				      (void *)&info) < 0) {
+			Py_DECREF(info.names);
+			return NULL;
+		}
+	}
+	return info.names;
+}
+
+
+/**
+ * extract the substring of a group.
+ */
+static PyObject *
+match_extract_group(PyObject *self, PyObject *args)
+{
+	MatchState *state;
+	int group;
+	Py_ssize_t len, start;
+
+	if (!PyArg_ParseTuple(args, "Oi:match_extract_group", &state, &group))
+		return NULL;
+
+	if (!PyObject_IsInstance((PyObject *)state, (PyObject *)&MatchStateType)) {
+		PyErr_SetString(PyExc_TypeError, "match state required");
+		return NULL;
+	}
+
+	if (state->region->num_regs <= group) {
+		PyErr_SetString(PyExc_IndexError, "no such group");
+		return NULL;
+	}
+
+	start = state->region->beg[group];
+	if (start < 0 && state->region->end[group] < 0) {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+	if (subject_refresh(state->subject) < 0)
+		return NULL;
+	len = state->region->end[group] - start;
+	start += state->window;
+
+	if (state->regexp->utf8)
+		return PyUnicode_DecodeUTF8(
+			(char *)state->subject->str + start, len, NULL);
+	else if (state->regexp->unicode)
+		return PyUnicode_FromUnicode(
+			PyUnicode_AS_UNICODE(state->subject->string) +
+			start / sizeof(Py_UNICODE), len / sizeof(Py_UNICODE));
+	else
+		return PyString_FromStringAndSize(
+			(char *)state->subject->str + start, len);
+}
+
+
+/**
+ * Return a memoryview of a group of a byte string or buffer subject.
+ */
+static PyObject *
+match_group_view(PyObject *self, PyObject *args)
+{
+	MatchState *state;
+	Py_buffer view;
+	int group;
+	Py_ssize_t start;
+
+	if (!PyArg_ParseTuple(args, "Oi:match_group_view", &state, &group))
+		return NULL;
+	if (!PyObject_IsInstance((PyObject *)state, (PyObject *)&MatchStateType)) {
+		PyErr_SetString(PyExc_TypeError, "match state required");
+		return NULL;
+	}
+	if (state->regexp->unicode) {
+		PyErr_SetString(PyExc_TypeError, "group views need a byte "
+				"string or buffer subject");
+		return NULL;
+	}
+	if (group < 0 || group >= state->region->num_regs) {
+		PyErr_SetString(PyExc_IndexError, "no such group");
+		return NULL;
+	}
+	start = state->region->beg[group];
+	if (start < 0) {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+
+	/* the view keeps the subject and with it the object alive, a
+	   bytearray can't be resized while it exists */
+	if (PyObject_GetBuffer((PyObject *)state->subject, &view,
+			       PyBUF_FULL_RO) < 0)
+		return NULL;
+	view.buf = (char *)view.buf + state->window + start;
+	view.len = state->region->end[group] - start;
+	return PyMemoryView_FromBuffer(&view);
+}
+
+
+/**
+ * Return a copy of a match state that only keeps the part of the
+ * subject the groups cover, so that a match doesn't keep a big string
+ * alive.
+ */
+static PyObject *
+match_detach(PyObject *self, PyObject *arg)
+{
+	MatchState *state = (MatchState *)arg, *rv;
+	OnigRegion *region;
+	Subject *subject;
+	PyObject *part;
+	Py_ssize_t lo = -1, hi = 0, start, char_lo;
+	int i;
+
+	if (!PyObject_IsInstance(arg, (PyObject *)&MatchStateType)) {
+		PyErr_SetString(PyExc_TypeError, "match state required");
+		return NULL;
+	}
+	if (state->detached) {
+		Py_INCREF(state);
+		return arg;
+	}
+
+	/* groups can lie outside of the match, for example in lookbehinds */
+	region = state->region;
+	for (i = 0; i < region->num_regs; i++) {
+		if (region->beg[i] < 0)
+			continue;
+		if (lo < 0 || region->beg[i] < lo)
+			lo = region->beg[i];
+		if (region->end[i] > hi)
+			hi = region->end[i];
+	}
+	subject = state->subject;
+	if (subject_refresh(subject) < 0)
+		return NULL;
+	start = state->window + lo;
+	char_lo = subject_char_offset(subject, start);
+	if (char_lo == -2)
+		return NULL;
+
+	if (subject->encoded)
+		part = PyUnicode_DecodeUTF8((char *)subject->str + start,
+					    hi - lo, NULL);
+	else if (PyUnicode_Check(subject->string))
+		part = PyUnicode_FromUnicode(
+			PyUnicode_AS_UNICODE(subject->string) +
+			start / sizeof(Py_UNICODE),
+			(hi - lo) / sizeof(Py_UNICODE));
+	else
+		part = PyString_FromStringAndSize((char *)subject->str + start,
+						  hi - lo);
+	if (!part)
+		return NULL;
+	subject = get_subject(state->regexp, part);
+	Py_DECREF(part);
+	if (!subject)
+		return NULL;
+
+	rv = PyObject_New(MatchState, &MatchStateType);
+	if (!rv) {
+		Py_DECREF(subject);
+		return NULL;
+	}
+	live_states++;
+	rv->accounted = 0;
+	Py_INCREF(state->regexp);
+	rv->regexp = state->regexp;
+	rv->subject = subject;
+	rv->pos = state->pos;
+	rv->endpos = state->endpos;
+	rv->detached = 1;
+	rv->byte_base = start;
+	rv->char_base = char_lo;
+	rv->window = 0;
+	rv->region = onig_region_new();
+	if (!rv->region ||
+	    onig_region_resize(rv->region, region->num_regs) != ONIG_NORMAL) {
+		Py_DECREF(rv);
+		return PyErr_NoMemory();
+	}
+	for (i = 0; i < region->num_regs; i++) {
+		rv->region->beg[i] = region->beg[i] < 0 ? region->beg[i]
+			: region->beg[i] - (int)lo;
+		rv->region->end[i] = region->end[i] < 0 ? region->end[i]
+			: region->end[i] - (int)lo;
+	}
+	account_state(rv);
+	return (PyObject *)rv;
+}
 
 
 /**
- * regexp match/search function
+ * escape all non-alphanumeric characters of a pattern.  the escapes
+ * dict maps ascii characters to their escaped form, every other
+ * character is prefixed with a backslash.
  */
+#define ESCAPE_PATTERN(TYPE, src, length, dst) do {			\
+	Py_ssize_t _i;							\
+	unsigned long _c;						\
+	TYPE *_out = (dst);						\
+	for (_i = 0; _i < (length); _i++) {				\
+		_c = (src)[_i];						\
+		if (_c < 128 && escape_plain[_c])			\
+			*_out++ = (TYPE)_c;				\
+		else if (_c < 128 && table[_c]) {			\
+			const char *_s = PyString_AS_STRING(table[_c]);	\
+			const char *_e = _s + PyString_GET_SIZE(table[_c]);\
+			while (_s < _e)					\
+				*_out++ = (unsigned char)*_s++;		\
+		}							\
+		else {							\
+			*_out++ = '\\';					\
+			*_out++ = (TYPE)_c;				\
+		}							\
+	}								\
+} while (0)
+
+static void
+init_escape_table(void)
+{
+	int c;
+	for (c = 0; c < 128; c++)
+		escape_plain[c] = (c >= 'a' && c <= 'z') ||
+				  (c >= 'A' && c <= 'Z') ||
+				  (c >= '0' && c <= '9');
+}
+
 static PyObject *
-regexp_match(PyObject *self, PyObject *args)
+escape_pattern(PyObject *self, PyObject *args)
 {
-	PyObject *string, *from_start;
-	BaseRegexp *regexp;
-	Py_ssize_t pos, endpos;
-	int ifrom_start;
-	MatchState *state = NULL;
-	UChar *str, *str_start, *str_end;
-	
-	if (!PyArg_ParseTuple(args, "OOiiO:match", &regexp, &string,
-			      &pos, &endpos, &from_start))
-		return NULL;
-	if (!PyObject_IsInstance((PyObject *)regexp,
-				      (PyObject *)&BaseRegexpType)) {
-		PyErr_SetString(PyExc_TypeError, "regular expression "
-				"object required");
+	PyObject *pattern, *escapes, *key, *value, *rv;
+	PyObject *table[128];
+	Py_ssize_t pos = 0, i, length, size;
+	unsigned long c;
+	int unicode;
+
+	if (!PyArg_ParseTuple(args, "OO!:escape_pattern", &pattern,
+			      &PyDict_Type, &escapes))
 		return NULL;
+
+	if (PyUnicode_Check(pattern)) {
+		unicode = 1;
+		length = PyUnicode_GET_SIZE(pattern);
 	}
-	if (pos < 0) {
-		PyErr_SetString(PyExc_ValueError, "pos must be >= 0");
-		return NULL;
+	else if (PyString_Check(pattern)) {
+		unicode = 0;
+		length = PyString_GET_SIZE(pattern);
 	}
-	ifrom_start = PyObject_IsTrue(from_start);
-	if (ifrom_start < 0)
+	else {
+		PyErr_SetString(PyExc_TypeError, "expected string or unicode");
 		return NULL;
-	if (PyString_Check(string)) {
-		if (regexp->unicode) {
-			/* Encode using default encoding. */
-			string = PyUnicode_FromEncodedObject(string, NULL, NULL);
-			if (!string)
-				return NULL;
-		} else {
-			Py_INCREF(string);
-		}
 	}
-	else if (PyUnicode_Check(string)) {
-		if (regexp->unicode) {
-			Py_INCREF(string);
-		} else {
-			/* Decode using default encoding. */
-			string = PyUnicode_AsEncodedString(string, NULL, NULL);
-			if (!string)
-				return NULL;
+
+	/* translation table for this call, the dict is tiny */
+	memset(table, 0, sizeof(table));
+	while (PyDict_Next(escapes, &pos, &key, &value)) {
+		if (PyString_Check(key) && PyString_GET_SIZE(key) == 1)
+			c = (unsigned char)PyString_AS_STRING(key)[0];
+		else if (PyUnicode_Check(key) && PyUnicode_GET_SIZE(key) == 1)
+			c = PyUnicode_AS_UNICODE(key)[0];
+		else
+			continue;
+		if (c >= 128 || escape_plain[c])
+			continue;
+		if (!PyString_Check(value)) {
+			PyErr_SetString(PyExc_TypeError, "escapes must be strings");
+			return NULL;
 		}
+		table[c] = value;
 	}
-	else {
-		PyErr_SetString(PyExc_TypeError, "string to match must be "
-				"string or unicode");
-		return NULL;
-	}
-	if (endpos == -1) {
-		endpos = (regexp->unicode ? PyUnicode_GET_SIZE(string) :
-			  PyString_GET_SIZE(string));
+
+	size = 0;
+	for (i = 0; i < length; i++) {
+		if (unicode)
+			c = PyUnicode_AS_UNICODE(pattern)[i];
+		else
+			c = (unsigned char)PyString_AS_STRING(pattern)[i];
+		if (c < 128 && escape_plain[c])
+			size += 1;
+		else if (c < 128 && table[c])
+			size += PyString_GET_SIZE(table[c]);
+		else
+			size += 2;
 	}
-	if (endpos < 0) {
-		PyErr_SetString(PyExc_ValueError, "endpos must be >= -1, where "
-				"-1 means the length of the string to match");
-		Py_DECREF(string);
-		return NULL;
+
+	if (unicode) {
+		rv = PyUnicode_FromUnicode(NULL, size);
+		if (rv)
+			ESCAPE_PATTERN(Py_UNICODE, PyUnicode_AS_UNICODE(pattern),
+				       length, PyUnicode_AS_UNICODE(rv));
 	}
-	
-	if (regexp->unicode) {
-		str = (UChar *) PyUnicode_AS_UNICODE(string);
-		str_start = str + (sizeof(Py_UNICODE) * pos);
-		str_end = str + (sizeof(Py_UNICODE) * endpos);
-	} else {
-		str = (UChar *) PyString_AS_STRING(string);
-		str_start = str + pos;
-		str_end = str + endpos;
+	else {
+		rv = PyString_FromStringAndSize(NULL, size);
+		if (rv)
+			ESCAPE_PATTERN(unsigned char,
+				       (unsigned char *)PyString_AS_STRING(pattern),
+				       length, (unsigned char *)PyString_AS_STRING(rv));
 	}
+	return rv;
+}
 
-	if (str_start > str_end)
-		goto nomatch;
 
-	state = PyObject_New(MatchState, &MatchStateType);
-	Py_INCREF(regexp);
-	state->regexp = regexp;
-	state->region = onig_region_new();
-	state->string = string;
-	state->pos = pos;
-	state->endpos = endpos;
+/**
+ * global limits
+ */
+static PyObject *
+get_retry_limit(PyObject *self)
+{
+#ifdef HAVE_MATCH_PARAM
+	return PyLong_FromUnsignedLong(onig_get_retry_limit_in_match());
+#else
+	Py_INCREF(Py_None);
+	return Py_None;
+#endif
+}
 
-	if (((ifrom_start)
-	      ? onig_match(regexp->regex, str, str_end, str_start, state->region,
-			   ONIG_OPTION_NONE)
-	      : onig_search(regexp->regex, str, str_end, str_start, str_end,
-			    state->region, ONIG_OPTION_NONE)
-		    ) >= 0)
-		return (PyObject *) state;
+static PyObject *
+set_retry_limit(PyObject *self, PyObject *value)
+{
+	unsigned long limit;
 
-nomatch:
-	Py_XDECREF(state);
+	if (parse_limit(value, &limit) < 0)
+		return NULL;
+#ifdef HAVE_MATCH_PARAM
+	onig_set_retry_limit_in_match(limit);
+#endif
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *
+get_match_stack_limit(PyObject *self)
+{
+#ifdef HAVE_MATCH_PARAM
+	return PyLong_FromUnsignedLong(onig_get_match_stack_limit_size());
+#else
+	Py_INCREF(Py_None);
+	return Py_None;
+#endif
+}
+
+static PyObject *
+set_match_stack_limit(PyObject *self, PyObject *value)
+{
+	unsigned long limit;
+
+	if (parse_limit(value, &limit) < 0)
+		return NULL;
+#ifdef HAVE_MATCH_PARAM
+	onig_set_match_stack_limit_size((unsigned int)limit);
+#endif
 	Py_INCREF(Py_None);
 	return Py_None;
 }
 
 
 /**
- * get a tuple of groups
+ * statistics
  */
 static PyObject *
-match_get_groups(PyObject *self, PyObject *state)
+regexp_stats(PyObject *self, PyObject *args)
 {
-	OnigRegion *region;
-	int count, i;
-	PyObject *rv;
+	BaseRegexp *regexp;
+	PyObject *result;
+	int reset = 0;
 
-	if (!PyObject_IsInstance(state, (PyObject *)&MatchStateType)) {
-		PyErr_SetString(PyExc_TypeError, "match state required");
+	if (!PyArg_ParseTuple(args, "O|i:stats", &regexp, &reset))
+		return NULL;
+	if (!PyObject_IsInstance((PyObject *)regexp,
+				 (PyObject *)&BaseRegexpType)) {
+		PyErr_SetString(PyExc_TypeError, "regular expression "
+				"object required");
 		return NULL;
 	}
+	result = Py_BuildValue("{s:L,s:L,s:L,s:L,s:d}",
+			       "calls", regexp->calls,
+			       "hits", regexp->hits,
+			       "misses", regexp->misses,
+			       "bytes_scanned", regexp->bytes_scanned,
+			       "engine_time", regexp->engine_time);
+	if (result && reset) {
+		regexp->calls = regexp->hits = regexp->misses = 0;
+		regexp->bytes_scanned = 0;
+		regexp->engine_time = 0.0;
+	}
+	return result;
+}
 
-	region = ((MatchState *)state)->region;
-	count = region->num_regs;
+static PyObject *
+get_stats_registry(PyObject *self)
+{
+	PyObject *result, *regexp;
+	Py_ssize_t i;
 
-	rv = PyTuple_New(count);
-	if (!rv)
+	result = PyList_New(0);
+	if (!result)
 		return NULL;
-
-	for (i = 0; i < count; i++) {
-		int beg = region->beg[i];
-		int end = region->end[i];
-		PyObject *pair;
-		if (((MatchState *)state)->regexp->unicode) {
-			beg /= sizeof(Py_UNICODE);
-			end /= sizeof(Py_UNICODE);
-		}
-		pair = Py_BuildValue("(ii)", beg, end);
-		if (!pair) {
-			Py_DECREF(rv);
-			return NULL;
-		}
-		PyTuple_SET_ITEM(rv, i, pair);
+	/* drop the references of dead regexps while we're at it */
+	if (prune_stats_registry() < 0)
+		goto error;
+	for (i = 0; i < PyList_GET_SIZE(stats_registry); i++) {
+		regexp = PyWeakref_GET_OBJECT(PyList_GET_ITEM(stats_registry,
+							       i));
+		if (regexp != Py_None && PyList_Append(result, regexp) < 0)
+			goto error;
 	}
+	return result;
 
-	return rv;
+error:
+	Py_DECREF(result);
+	return NULL;
 }
 
-
-/**
- * get a dict for idx -> name
- */
-static int
-iterate_group_names(const UChar *name, const UChar *name_end,
-		    int ngroup_num, int *group_nums, regex_t *reg,
-		    void *arg)
+static PyObject *
+get_collect_stats(PyObject *self)
 {
-	int i;
-	for (i = 0; i < ngroup_num; i++) {
-		if (PyDict_SetItemString((PyObject *)arg, (char *)name,
-					 PyInt_FromLong(group_nums[i])) < 0)
-			return -1;
-	}
-	return 0;
+	return PyBool_FromLong(collect_all_stats);
 }
 
-
 static PyObject *
-match_get_group_names(PyObject *self, PyObject *state)
+set_collect_stats(PyObject *self, PyObject *value)
 {
-	PyObject *rv;
-	regex_t *regex;
+	int flag = PyObject_IsTrue(value);
 
-	if (!PyObject_IsInstance(state, (PyObject *)&MatchStateType)) {
-		PyErr_SetString(PyExc_TypeError, "match state required");
+	if (flag < 0)
 		return NULL;
-	}
+	collect_all_stats = flag;
+	Py_INCREF(Py_None);
+	return Py_None;
+}
 
-	rv = PyDict_New();
-	if (!rv)
-		return NULL;
 
-	regex = ((MatchState *)state)->regexp->regex;
-	if (onig_number_of_names(regex)) {
-		if (onig_foreach_name(regex, iterate_group_names, (void *)rv) < 0) {
-			Py_DECREF(rv);
+static PyObject *
+get_slow_match_threshold(PyObject *self)
+{
+	if (slow_match_threshold > 0.0)
+		return PyFloat_FromDouble(slow_match_threshold);
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *
+set_slow_match_threshold(PyObject *self, PyObject *value)
+{
+	double threshold = 0.0;
+
+	if (value != Py_None) {
+		threshold = PyFloat_AsDouble(value);
+		if (threshold == -1.0 && PyErr_Occurred())
+			return NULL;
+		if (threshold < 0.0) {
+			PyErr_SetString(PyExc_ValueError, "threshold must "
+					"be >= 0");
 			return NULL;
 		}
 	}
-	return rv;
+	slow_match_threshold = threshold;
+	Py_INCREF(Py_None);
+	return Py_None;
 }
 
 
 /**
- * extract the substring of a group.
+ * overhead tracking
  */
 static PyObject *
-match_extract_group(PyObject *self, PyObject *args)
+overhead_set_tracking(PyObject *self, PyObject *value)
 {
-	MatchState *state;
-	long group;
-	Py_ssize_t len, start;
+	int flag = PyObject_IsTrue(value);
 
-	if (!PyArg_ParseTuple(args, "Oi:match_extract_group", &state, &group))
+	if (flag < 0)
 		return NULL;
+	track_overhead = flag;
+	Py_INCREF(Py_None);
+	return Py_None;
+}
 
-	if (!PyObject_IsInstance((PyObject *)state, (PyObject *)&MatchStateType)) {
-		PyErr_SetString(PyExc_TypeError, "match state required");
+static PyObject *
+memory_set_tracking(PyObject *self, PyObject *value)
+{
+	int flag = PyObject_IsTrue(value);
+
+	if (flag < 0)
 		return NULL;
+	track_memory = flag;
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+/**
+ * Return the counters of the memory report as a dict.
+ */
+static PyObject *
+memory_get_counters(PyObject *self)
+{
+	PyObject *key, *capsule;
+	Py_ssize_t pos = 0, bytes = 0, measured = 0;
+	Program *program;
+
+	while (PyDict_Next(programs, &pos, &key, &capsule)) {
+		program = (Program *)PyCapsule_GetPointer(capsule, NULL);
+		bytes += program->size;
+		measured += program->measured;
 	}
+	return Py_BuildValue("{s:n,s:n,s:n,s:n,s:n,s:n,s:n,s:n,s:n}",
+			     "programs", PyDict_Size(programs),
+			     "program_bytes", bytes,
+			     "measured_programs", measured,
+			     "regexps", live_regexps,
+			     "regexp_bytes", regexp_bytes,
+			     "subjects", live_subjects,
+			     "subject_bytes", subject_bytes,
+			     "match_states", live_states,
+			     "match_state_bytes", state_bytes);
+}
 
-	if (state->region->num_regs <= group) {
-		PyErr_SetString(PyExc_IndexError, "no such group");
+static PyObject *
+overhead_timer(PyObject *self)
+{
+	return PyFloat_FromDouble(monotonic_time());
+}
+
+static PyObject *
+overhead_record_wrap(PyObject *self, PyObject *value)
+{
+	double seconds = PyFloat_AsDouble(value);
+
+	if (seconds == -1.0 && PyErr_Occurred())
 		return NULL;
-	}
+	record_overhead(OVERHEAD_WRAP, seconds);
+	Py_INCREF(Py_None);
+	return Py_None;
+}
 
-	start = state->region->beg[group];
-	if (start < 0 && state->region->end[group] < 0) {
-		Py_INCREF(Py_None);
-		return Py_None;
-	}
-	len = state->region->end[group] - start;
+static PyObject *
+overhead_get_histograms(PyObject *self, PyObject *args)
+{
+	PyObject *result, *buckets, *item;
+	Histogram *histogram;
+	int reset = 0, phase, bucket;
 
-	if (state->regexp->unicode)
-		return PyUnicode_FromUnicode(
-			PyUnicode_AS_UNICODE(state->string) + start / sizeof(Py_UNICODE),
-			len / sizeof(Py_UNICODE));
-	else
-		return PyString_FromStringAndSize(
-			PyString_AS_STRING(state->string) + start, len);
+	if (!PyArg_ParseTuple(args, "|i:get_histograms", &reset))
+		return NULL;
+	result = PyList_New(OVERHEAD_PHASES);
+	if (!result)
+		return NULL;
+	for (phase = 0; phase < OVERHEAD_PHASES; phase++) {
+		histogram = &overhead[phase];
+		buckets = PyList_New(OVERHEAD_BUCKETS);
+		if (!buckets) {
+			Py_DECREF(result);
+			return NULL;
+		}
+		for (bucket = 0; bucket < OVERHEAD_BUCKETS; bucket++) {
+			item = PyLong_FromLongLong(histogram->buckets[bucket]);
+			if (!item) {
+				Py_DECREF(buckets);
+				Py_DECREF(result);
+				return NULL;
+			}
+			PyList_SET_ITEM(buckets, bucket, item);
+		}
+		item = Py_BuildValue("(sLdN)", overhead_phases[phase],
+				     histogram->count, histogram->total,
+				     buckets);
+		if (!item) {
+			Py_DECREF(result);
+			return NULL;
+		}
+		PyList_SET_ITEM(result, phase, item);
+	}
+	if (reset)
+		memset(overhead, 0, sizeof(overhead));
+	return result;
 }
 
 
 /**
- * Forward a warning call to the _highlevel module
+ * Forward a warning call to the _highlevel module.  Patterns are
+ * compiled without the GIL so it has to be acquired first.
  */
 static void
 on_regexp_warning(const char *message)
 {
-	PyObject *module = NULL, *warn_func = NULL;
-	PyObject *args = Py_BuildValue("(s)", message);
+	PyObject *module = NULL, *warn_func = NULL, *args;
+	PyGILState_STATE gil = PyGILState_Ensure();
+
+	args = Py_BuildValue("(s)", message);
 	if (!args)
 		goto ret;
 	module = PyImport_ImportModule("ponyguruma");
@@ -643,18 +4270,97 @@ on_regexp_warning(const char *message)
 	Py_XDECREF(args);
 	Py_XDECREF(module);
 	Py_XDECREF(warn_func);
+	PyGILState_Release(gil);
+}
+
+/**
+ * Initialize oniguruma and all the encodings up front.  Otherwise
+ * oniguruma does that on the first compilation of a pattern, which
+ * isn't safe while other threads compile patterns too.
+ */
+static void
+init_encodings(void)
+{
+#if defined(ONIGURUMA_VERSION_INT) && ONIGURUMA_VERSION_INT >= 60000
+	OnigEncoding encodings[33];
+	int i, n = 0;
+
+	for (i = 0; i < 32; i++)
+		if (get_onig_encoding(i) != ONIG_ENCODING_UNDEF)
+			encodings[n++] = get_onig_encoding(i);
+	encodings[n++] = UNICODE_ENCODING;
+	onig_initialize(encodings, n);
+#endif
 }
 
 
 static PyMethodDef module_methods[] = {
 	{"regexp_match", (PyCFunction)regexp_match, METH_VARARGS,
 	 "internal matching helper function"},
+	{"regexp_subject", (PyCFunction)regexp_subject, METH_VARARGS,
+	 "internal matching helper function"},
+	{"subject_find_line", (PyCFunction)subject_find_line, METH_VARARGS,
+	 "internal matching helper function"},
+	{"regexp_profiler", (PyCFunction)regexp_profiler, METH_VARARGS,
+	 "internal matching helper function"},
 	{"match_get_groups", (PyCFunction)match_get_groups, METH_O,
 	 "internal matching helper function"},
+	{"match_get_char_groups", (PyCFunction)match_get_char_groups, METH_O,
+	 "internal matching helper function"},
 	{"match_get_group_names", (PyCFunction)match_get_group_names, METH_O,
 	 "internal matching helper function"},
 	{"match_extract_group", (PyCFunction)match_extract_group, METH_VARARGS,
 	 "internal matching helper function"},
+	{"match_detach", (PyCFunction)match_detach, METH_O,
+	 "internal matching helper function"},
+	{"match_group_view", (PyCFunction)match_group_view, METH_VARARGS,
+	 "internal matching helper function"},
+	{"escape_pattern", (PyCFunction)escape_pattern, METH_VARARGS,
+	 "internal helper function"},
+	{"regexp_compile", (PyCFunction)regexp_compile, METH_O,
+	 "internal helper function"},
+	{"get_program_stats", (PyCFunction)get_program_stats, METH_NOARGS,
+	 "internal helper function"},
+	{"get_retry_limit", (PyCFunction)get_retry_limit, METH_NOARGS,
+	 "Return the global limit of backtracking retries for one match "
+	 "attempt.\n0 means unlimited."},
+	{"set_retry_limit", (PyCFunction)set_retry_limit, METH_O,
+	 "Set the global limit of backtracking retries for one match "
+	 "attempt.\nExceeding it raises a MatchLimitError, 0 disables the "
+	 "limit."},
+	{"get_match_stack_limit", (PyCFunction)get_match_stack_limit,
+	 METH_NOARGS, "Return the global match stack limit.\n0 means "
+	 "unlimited."},
+	{"set_match_stack_limit", (PyCFunction)set_match_stack_limit, METH_O,
+	 "Set the global match stack limit.\nExceeding it raises a "
+	 "MatchLimitError, 0 disables the limit."},
+	{"regexp_stats", (PyCFunction)regexp_stats, METH_VARARGS,
+	 "internal matching helper function"},
+	{"get_stats_registry", (PyCFunction)get_stats_registry, METH_NOARGS,
+	 "internal matching helper function"},
+	{"get_collect_stats", (PyCFunction)get_collect_stats, METH_NOARGS,
+	 "Return True if statistics are collected for all regexps."},
+	{"set_collect_stats", (PyCFunction)set_collect_stats, METH_O,
+	 "Enable or disable collecting statistics for all regexps.\n"
+	 "Regexps with collect_stats set always collect them."},
+	{"overhead_set_tracking", (PyCFunction)overhead_set_tracking, METH_O,
+	 "internal matching helper function"},
+	{"overhead_timer", (PyCFunction)overhead_timer, METH_NOARGS,
+	 "internal matching helper function"},
+	{"memory_set_tracking", (PyCFunction)memory_set_tracking, METH_O,
+	 "internal helper function"},
+	{"memory_get_counters", (PyCFunction)memory_get_counters,
+	 METH_NOARGS, "internal helper function"},
+	{"overhead_record_wrap", (PyCFunction)overhead_record_wrap, METH_O,
+	 "internal matching helper function"},
+	{"overhead_get_histograms", (PyCFunction)overhead_get_histograms,
+	 METH_VARARGS, "internal matching helper function"},
+	{"get_slow_match_threshold", (PyCFunction)get_slow_match_threshold,
+	 METH_NOARGS, "Return the slow match threshold in seconds or None."},
+	{"set_slow_match_threshold", (PyCFunction)set_slow_match_threshold,
+	 METH_O, "Set the number of seconds after which a single engine "
+	 "call is\nreported to ponyguruma.slow_match_func.  None or 0 "
+	 "disables the reports."},
 	{NULL, NULL, 0, NULL}
 };
 
@@ -669,8 +4375,12 @@ init_lowlevel(void)
 
 	if (init_python_syntax() < 0)
 		return;
+	init_escape_table();
 
 	if (PyType_Ready(&BaseRegexpType) < 0 ||
+	    PyType_Ready(&SubjectType) < 0 ||
+	    PyType_Ready(&DeadlineType) < 0 ||
+	    PyType_Ready(&ProfilerType) < 0 ||
 	    PyType_Ready(&MatchStateType) < 0 )
 		return;
 
@@ -678,13 +4388,37 @@ init_lowlevel(void)
 	if (!module)
 		return;
 
+	stats_registry = PyList_New(0);
+	if (!stats_registry)
+		return;
+
+	programs = PyDict_New();
+	if (!programs)
+		return;
+
 	RegexpError = PyErr_NewException("ponyguruma.RegexpError", NULL, NULL);
 	Py_INCREF(RegexpError);
 	PyModule_AddObject(module, "RegexpError", RegexpError);
 
+	MatchLimitError = PyErr_NewException("ponyguruma.MatchLimitError",
+					     RegexpError, NULL);
+	Py_INCREF(MatchLimitError);
+	PyModule_AddObject(module, "MatchLimitError", MatchLimitError);
+
+	MatchTimeout = PyErr_NewException("ponyguruma.MatchTimeout",
+					  MatchLimitError, NULL);
+	Py_INCREF(MatchTimeout);
+	PyModule_AddObject(module, "MatchTimeout", MatchTimeout);
+
+	Py_INCREF(&DeadlineType);
+	PyModule_AddObject(module, "Deadline", (PyObject *)&DeadlineType);
+
 	Py_INCREF(&BaseRegexpType);
 	PyModule_AddObject(module, "BaseRegexp", (PyObject *)&BaseRegexpType);
 
+	Py_INCREF(&SubjectType);
+	PyModule_AddObject(module, "Subject", (PyObject *)&SubjectType);
+
 	Py_INCREF(&MatchStateType);
 	PyModule_AddObject(module, "MatchState", (PyObject *)&MatchStateType);
 
@@ -695,4 +4429,5 @@ init_lowlevel(void)
 
 	onig_set_warn_func(on_regexp_warning);
 	onig_set_verb_warn_func(on_regexp_warning);
+	init_encodings();
 }
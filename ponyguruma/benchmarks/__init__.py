@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmarks comparing ponyguruma with sre.  Every benchmark is set up
+    once per engine and then timed with a warmup phase followed by a
+    number of repeats.  Run them with::
+
+        python -m ponyguruma.benchmarks [options] [name ...]
+
+    The results can be written as JSON with ``-o results.json`` so that
+    different runs can be compared.  ``--compare`` checks the results
+    against the baseline stored in ``baseline.json`` and exits with 1 if
+    a benchmark got slower than its threshold allows, ``--save-baseline``
+    replaces the stored baseline.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+import os
+import re
+import sys
+import time
+import platform
+import sre_compile
+from fnmatch import fnmatchcase
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    json = None
+
+import ponyguruma
+from ponyguruma.constants import OPTION_IGNORECASE, ENCODING_ASCII
+
+
+if sys.platform == 'win32':
+    timer = time.clock
+else:
+    timer = time.time
+
+
+class Engine(object):
+    """
+    Wraps the API differences of the engines so that every benchmark
+    can be written once.
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        #: the module to import in the import benchmarks
+        self.module = module
+
+
+class OnigurumaEngine(Engine):
+
+    def __init__(self):
+        Engine.__init__(self, 'ponyguruma', 'ponyguruma')
+
+    def compile(self, pattern, ignorecase=False, encoding=ENCODING_ASCII,
+                lazy=False):
+        flags = ignorecase and OPTION_IGNORECASE or 0
+        if isinstance(pattern, unicode) and encoding == ENCODING_ASCII:
+            return ponyguruma.Regexp(pattern, flags, lazy=lazy)
+        return ponyguruma.Regexp(pattern, flags, encoding, lazy=lazy)
+
+    def compile_many(self, patterns):
+        return ponyguruma.compile_many(patterns)
+
+    def find(self, regexp, string):
+        return regexp.find(string)
+
+    def search_last(self, regexp, string):
+        return regexp.rsearch(string)
+
+    def find_reverse(self, regexp, string):
+        return regexp.rfind(string)
+
+    def escape(self, string):
+        return ponyguruma.escape(string)
+
+
+class SreEngine(Engine):
+
+    def __init__(self):
+        Engine.__init__(self, 're', 're')
+
+    def compile(self, pattern, ignorecase=False, encoding=None, lazy=False):
+        # sre has no lazy compilation, so `lazy` is ignored
+        flags = ignorecase and re.IGNORECASE or 0
+        if isinstance(pattern, unicode):
+            flags |= re.UNICODE
+        # re.compile caches the patterns, we want the real work
+        return sre_compile.compile(pattern, flags)
+
+    def compile_many(self, patterns):
+        return [self.compile(pattern) for pattern in patterns]
+
+    def find(self, regexp, string):
+        return regexp.finditer(string)
+
+    def search_last(self, regexp, string):
+        # sre can only search forward, so every match has to be found
+        match = None
+        for match in regexp.finditer(string):
+            pass
+        return match
+
+    def find_reverse(self, regexp, string):
+        return reversed(list(regexp.finditer(string)))
+
+    def escape(self, string):
+        return re.escape(string)
+
+
+ENGINES = [OnigurumaEngine(), SreEngine()]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+_benchmarks = []
+
+
+def benchmark(name):
+    """
+    Register a benchmark.  The decorated function is called with an
+    `Engine` and returns the function to time, or `None` if the
+    benchmark doesn't apply to the engine.
+    """
+    def decorator(setup):
+        _benchmarks.append((name, setup))
+        return setup
+    return decorator
+
+
+def iter_benchmarks(patterns=None):
+    """Iterate over ``(name, setup)`` of the matching benchmarks."""
+    import ponyguruma.benchmarks.cases
+    for name, setup in _benchmarks:
+        if not patterns or [p for p in patterns if fnmatchcase(name, p)]:
+            yield name, setup
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def stddev(values):
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / float(len(values))
+    return (sum([(x - mean) ** 2 for x in values]) /
+            (len(values) - 1)) ** 0.5
+
+
+def calibrate(func, min_time):
+    """Return the number of calls that take at least `min_time`."""
+    loops = 1
+    while 1:
+        start = timer()
+        for x in xrange(loops):
+            func()
+        if timer() - start >= min_time or loops >= 1 << 30:
+            return loops
+        loops *= 2
+
+
+def measure(func, repeats=7, warmup=0.1, min_time=0.05):
+    """
+    Time `func` and return a dict with the median, standard deviation,
+    minimum and mean seconds per call.  `func` is called for `warmup`
+    seconds first, then `repeats` times as often as needed to run for
+    `min_time` seconds.
+    """
+    loops = calibrate(func, min_time)
+    end = timer() + warmup
+    while timer() < end:
+        func()
+    timings = []
+    for x in xrange(repeats):
+        start = timer()
+        for y in xrange(loops):
+            func()
+        timings.append((timer() - start) / loops)
+    return {
+        'median':   median(timings),
+        'stddev':   stddev(timings),
+        'min':      min(timings),
+        'mean':     sum(timings) / len(timings),
+        'loops':    loops,
+        'repeats':  repeats
+    }
+
+
+def run(patterns=None, engines=None, repeats=7, warmup=0.1, min_time=0.05,
+        callback=None):
+    """
+    Run the benchmarks matching the glob `patterns` for the engines with
+    the given names and return the results as a JSON compatible dict.
+    `callback` is called with the name, engine name and timings after
+    every measurement.
+    """
+    results = {}
+    for name, setup in iter_benchmarks(patterns):
+        for engine in ENGINES:
+            if engines and engine.name not in engines:
+                continue
+            func = setup(engine)
+            if func is None:
+                continue
+            timings = measure(func, repeats, warmup, min_time)
+            results.setdefault(name, {})[engine.name] = timings
+            if callback is not None:
+                callback(name, engine.name, timings)
+    return {
+        'python':       platform.python_version(),
+        'platform':     platform.platform(),
+        'oniguruma':    '.'.join(map(str, ponyguruma.VERSION)),
+        'benchmarks':   results
+    }
+
+
+def format_time(seconds):
+    for unit, factor in ('s', 1), ('ms', 1e3), ('us', 1e6):
+        if seconds * factor >= 1:
+            break
+    else:
+        unit, factor = 'ns', 1e9
+    return '%.2f%s' % (seconds * factor, unit)
+
+
+def format_results(results):
+    """Format results as table with the engines side by side."""
+    names = [engine.name for engine in ENGINES]
+    lines = ['%-28s' % 'benchmark' +
+             ''.join(['%24s' % name for name in names]) + '%10s' % 'ratio']
+    for name, timings in sorted(results['benchmarks'].items()):
+        line = '%-28s' % name
+        for engine in names:
+            if engine in timings:
+                line += '%24s' % ('%s +- %s' % (
+                    format_time(timings[engine]['median']),
+                    format_time(timings[engine]['stddev'])))
+            else:
+                line += '%24s' % '-'
+        if len(timings) == len(names):
+            line += '%10.2f' % (timings[names[0]]['median'] /
+                                timings[names[1]]['median'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def load_results(filename):
+    f = open(filename)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def save_results(results, filename):
+    f = open(filename, 'w')
+    try:
+        json.dump(results, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        f.write('\n')
+    finally:
+        f.close()
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] [name ...]',
+                          description='Run the ponyguruma benchmarks.  '
+                          'Names are glob patterns like "search.*".')
+    parser.add_option('-o', '--output', dest='output', metavar='FILE',
+                      help='write the results as JSON to FILE')
+    parser.add_option('-e', '--engine', dest='engines', action='append',
+                      metavar='NAME', help='only run the given engine '
+                      '(ponyguruma or re)')
+    parser.add_option('-r', '--repeats', dest='repeats', type='int',
+                      default=7, help='number of timed runs [%default]')
+    parser.add_option('-w', '--warmup', dest='warmup', type='float',
+                      default=0.1, help='seconds of warmup [%default]')
+    parser.add_option('-t', '--min-time', dest='min_time', type='float',
+                      default=0.05, help='minimal seconds per timed run '
+                      '[%default]')
+    parser.add_option('-l', '--list', dest='list', action='store_true',
+                      help='list the benchmarks and exit')
+    parser.add_option('-b', '--baseline', dest='baseline', metavar='FILE',
+                      default=DEFAULT_BASELINE, help='the baseline results '
+                      '[%default]')
+    parser.add_option('-c', '--compare', dest='compare', action='store_true',
+                      help='compare the results with the baseline and exit '
+                      'with 1 on regressions')
+    parser.add_option('-s', '--save-baseline', dest='save_baseline',
+                      action='store_true', help='store the results as new '
+                      'baseline, keeping its thresholds')
+    options, patterns = parser.parse_args(args)
+    if (options.output or options.compare or options.save_baseline) and \
+       json is None:
+        parser.error('the json module is required for reading and '
+                     'writing results')
+
+    if options.list:
+        for name, setup in iter_benchmarks(patterns):
+            sys.stdout.write(name + '\n')
+        return 0
+
+    def progress(name, engine, timings):
+        sys.stderr.write('%-28s %-12s %s\n' % (name, engine,
+                                              format_time(timings['median'])))
+
+    results = run(patterns, options.engines, options.repeats,
+                  options.warmup, options.min_time, progress)
+    sys.stdout.write(format_results(results) + '\n')
+    if options.output:
+        save_results(results, options.output)
+
+    rv = 0
+    if options.compare:
+        from ponyguruma.benchmarks.compare import compare, format_report, \
+             has_regressions
+        baseline = load_results(options.baseline)
+        # benchmarks that were not run are no regressions
+        if patterns or options.engines:
+            for name in baseline['benchmarks'].keys():
+                if name not in results['benchmarks']:
+                    del baseline['benchmarks'][name]
+        report = compare(baseline, results)
+        sys.stdout.write('\n' + format_report(report) + '\n')
+        if has_regressions(report):
+            rv = 1
+    if options.save_baseline:
+        if os.path.exists(options.baseline):
+            thresholds = load_results(options.baseline).get('thresholds')
+            if thresholds is not None:
+                results['thresholds'] = thresholds
+        save_results(results, options.baseline)
+    return rv
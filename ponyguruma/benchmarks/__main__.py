@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.benchmarks.__main__
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Run the benchmarks with ``python -m ponyguruma.benchmarks``.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+import sys
+from ponyguruma.benchmarks import main
+
+sys.exit(main())
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.benchmarks.cases
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The benchmarks.  Names are ``operation.variant`` so that groups can
+    be selected with glob patterns.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+import os
+import sys
+import random
+import subprocess
+
+import ponyguruma
+from ponyguruma.constants import ENCODING_UTF8, ENCODING_EUC_JP, \
+     ENCODING_SJIS
+from ponyguruma.benchmarks import benchmark
+
+
+COMPLEX = r"(^[-!#$%&'*+/=?^_`{}|~0-9A-Z]+(\.[-!#$%&'*+/=?^_`{}|~0-9A-Z]+)*" \
+          r'|^"([\001-\010\013\014\016-\037!#-\[\]-\177]|\\[\001-011\013\014\016-\177])*"' \
+          r')@(?:[A-Z0-9-]+\.)+[A-Z]{2,6}$'
+
+
+def _make_text(words, size, seed=42):
+    rnd = random.Random(seed)
+    result = []
+    length = 0
+    while length < size:
+        word = rnd.choice(words)
+        result.append(word)
+        length += len(word) + 1
+    return u' '.join(result)
+
+
+WORDS = [u'lorem', u'ipsum', u'dolor', u'sit', u'amet', u'consectetur',
+         u'adipisicing', u'elit', u'sed', u'do', u'eiusmod', u'tempor',
+         u'incididunt', u'ut', u'labore', u'et', u'dolore', u'magna',
+         u'aliqua', u'42', u'1337', u'foo@example.com', u'(x)', u'a,b']
+TEXT = _make_text(WORDS, 10000).encode('ascii')
+UNICODE_TEXT = _make_text(WORDS + [u'über', u'größe', u'çà', u'ελλάδα'],
+                          10000)
+JAPANESE_TEXT = _make_text([u'日本語', u'テキスト', u'ひらがな', u'漢字',
+                            u'abc', u'123', u'東京', u'カタカナ'], 5000)
+CSV_TEXT = ', '.join(TEXT.split()[:1000])
+EXPRESSION = ' + '.join(['(foo * %d - bar_%d) / 2.5' % (i, i)
+                         for i in xrange(100)])
+KEYWORDS = ['%s.%s-%d (%s)' % (WORDS[i % 20], WORDS[i % 7], i, WORDS[i % 3])
+            for i in xrange(10000)]
+
+
+@benchmark('compile.empty')
+def compile_empty(engine):
+    return lambda: engine.compile('')
+
+
+@benchmark('compile.literal')
+def compile_literal(engine):
+    return lambda: engine.compile('aaaaaaaaaaaaaaa')
+
+
+@benchmark('compile.complex')
+def compile_complex(engine):
+    return lambda: engine.compile(COMPLEX, ignorecase=True)
+
+
+@benchmark('compile.keywords')
+def compile_keywords(engine):
+    keywords = KEYWORDS[:1000]
+    return lambda: engine.compile('|'.join(map(engine.escape, keywords)))
+
+
+@benchmark('compile.interned')
+def compile_interned(engine):
+    # another module already uses the same pattern, the default argument
+    # keeps it alive
+    existing = engine.compile(COMPLEX, ignorecase=True)
+    return lambda existing=existing: engine.compile(COMPLEX,
+                                                    ignorecase=True)
+
+
+@benchmark('compile.many')
+def compile_many(engine):
+    # the rules of a grammar
+    patterns = [r'\b%s_%d\b\s*(?:\(\s*(\w+)\s*\)|\[(\d+)\])?' % (word, i)
+                for i, word in enumerate(WORDS * 20)]
+    return lambda: engine.compile_many(patterns)
+
+
+@benchmark('compile.lazy')
+def compile_lazy(engine):
+    # defining many module level patterns of which only a few are used
+    patterns = [r'%s\s+(\w+)\(%d\)' % (word, i) for i, word in
+                enumerate(WORDS * 10)]
+    def run():
+        for pattern in patterns:
+            engine.compile(pattern, lazy=True)
+    return run
+
+
+@benchmark('import.module')
+def import_module(engine):
+    # the package directory has to be on the path of the child process
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+        os.path.abspath(ponyguruma.__file__)))
+    args = [sys.executable, '-c', 'import ' + engine.module]
+    return lambda: subprocess.call(args, env=env)
+
+
+@benchmark('escape.keywords')
+def escape_keywords(engine):
+    def run():
+        for keyword in KEYWORDS:
+            engine.escape(keyword)
+    return run
+
+
+@benchmark('match.complex_hit')
+def match_complex_hit(engine):
+    r = engine.compile(COMPLEX, ignorecase=True)
+    return lambda: r.match('foo@bar.com')
+
+
+@benchmark('match.complex_miss')
+def match_complex_miss(engine):
+    r = engine.compile(COMPLEX, ignorecase=True)
+    return lambda: r.match('foo@bar')
+
+
+@benchmark('match.object')
+def match_object(engine):
+    r = engine.compile(r'(\w+)@(\w+)')
+    return lambda: r.match('foo@bar').group(2)
+
+
+@benchmark('search.hit')
+def search_hit(engine):
+    r = engine.compile(r'magna\s+(\d+)')
+    text = TEXT + ' magna 42'
+    return lambda: r.search(text)
+
+
+@benchmark('search.miss')
+def search_miss(engine):
+    r = engine.compile(r'magna\s+x\d+')
+    return lambda: r.search(TEXT)
+
+
+@benchmark('search.literal_miss')
+def search_literal_miss(engine):
+    r = engine.compile(r'magna aliqua\.')
+    return lambda: r.search(TEXT)
+
+
+@benchmark('search.unicode_literal_miss')
+def search_unicode_literal_miss(engine):
+    r = engine.compile(u'magna aliqua\\.')
+    text = TEXT.decode('ascii')
+    return lambda: r.search(text)
+
+
+@benchmark('search.required_miss')
+def search_required_miss(engine):
+    r = engine.compile(r'\d+ apples')
+    return lambda: r.search(TEXT)
+
+
+@benchmark('search.unicode_hit')
+def search_unicode_hit(engine):
+    r = engine.compile(u'größe\\s+(\\d+)')
+    text = UNICODE_TEXT + u' größe 42'
+    return lambda: r.search(text)
+
+
+@benchmark('search.utf8_hit')
+def search_utf8_hit(engine):
+    # sre runs the same unicode search, so that the baseline comparison
+    # is normalized and catches slowdowns of the one-shot conversion
+    r = engine.compile(u'größe\\s+(\\d+)', encoding=ENCODING_UTF8)
+    text = UNICODE_TEXT + u' größe 42'
+    return lambda: r.search(text)
+
+
+@benchmark('search.last')
+def search_last(engine):
+    r = engine.compile(r'magna\s+(\d+)')
+    text = TEXT + ' magna 42' + ' lorem ipsum' * 10
+    return lambda: engine.search_last(r, text)
+
+
+@benchmark('find.bytes')
+def find_bytes(engine):
+    r = engine.compile(r'\w+')
+    def run():
+        for m in engine.find(r, TEXT):
+            pass
+    return run
+
+
+@benchmark('find.reverse')
+def find_reverse(engine):
+    # the matches are a few bytes apart
+    r = engine.compile(r'\w+')
+    def run():
+        for m in engine.find_reverse(r, TEXT):
+            pass
+    return run
+
+
+@benchmark('find.unicode')
+def find_unicode(engine):
+    r = engine.compile(u'\\w+')
+    def run():
+        for m in engine.find(r, UNICODE_TEXT):
+            pass
+    return run
+
+
+@benchmark('find.utf8')
+def find_utf8(engine):
+    if engine.name != 'ponyguruma':
+        return
+    r = engine.compile(u'\\w+', encoding=ENCODING_UTF8)
+    def run():
+        for m in engine.find(r, UNICODE_TEXT):
+            pass
+    return run
+
+
+def _find_encoded(engine, encoding, codec):
+    # sre doesn't know multibyte encodings, it matches the unicode text
+    if engine.name == 'ponyguruma':
+        r = engine.compile(u'\\w+'.encode(codec), encoding=encoding)
+        text = JAPANESE_TEXT.encode(codec)
+    else:
+        r = engine.compile(u'\\w+')
+        text = JAPANESE_TEXT
+    def run():
+        for m in engine.find(r, text):
+            pass
+    return run
+
+
+@benchmark('find.enc_utf8')
+def find_enc_utf8(engine):
+    return _find_encoded(engine, ENCODING_UTF8, 'utf-8')
+
+
+@benchmark('find.enc_euc_jp')
+def find_enc_euc_jp(engine):
+    return _find_encoded(engine, ENCODING_EUC_JP, 'euc-jp')
+
+
+@benchmark('find.enc_sjis')
+def find_enc_sjis(engine):
+    return _find_encoded(engine, ENCODING_SJIS, 'shift-jis')
+
+
+@benchmark('sub.string')
+def sub_string(engine):
+    r = engine.compile(r'(\d+)')
+    return lambda: r.sub(r'<\1>', TEXT)
+
+
+@benchmark('sub.callable')
+def sub_callable(engine):
+    r = engine.compile(r'\d+')
+    def repl(match):
+        return str(int(match.group()) * 2)
+    return lambda: r.sub(repl, TEXT)
+
+
+@benchmark('sub.unicode')
+def sub_unicode(engine):
+    r = engine.compile(u'(ü|ö)')
+    return lambda: r.sub(u'[\\1]', UNICODE_TEXT)
+
+
+@benchmark('split.csv')
+def split_csv(engine):
+    r = engine.compile(r'\s*,\s*')
+    return lambda: r.split(CSV_TEXT)
+
+
+@benchmark('scanner.tokenize')
+def scanner_tokenize(engine):
+    rules = [r'\s+', r'\d+(?:\.\d+)?', r'[a-zA-Z_]\w*', r'[-+*/()]']
+    if engine.name == 'ponyguruma':
+        def run():
+            scanner = ponyguruma.Scanner(EXPRESSION)
+            while not scanner.eos:
+                for rule in rules:
+                    if scanner.scan(rule) is not None:
+                        break
+        return run
+    regexps = [engine.compile(rule) for rule in rules]
+    def run():
+        pos = 0
+        end = len(EXPRESSION)
+        while pos < end:
+            for regexp in regexps:
+                match = regexp.match(EXPRESSION, pos)
+                if match is not None:
+                    pos = match.end()
+                    break
+    return run
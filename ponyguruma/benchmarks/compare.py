@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.benchmarks.compare
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compare benchmark results with a stored baseline.
+
+    The baseline is a results file as written by the benchmark runner
+    with an optional ``thresholds`` mapping of benchmark name globs to
+    the relative slowdown that is tolerated for them, for example::
+
+        "thresholds": {"*": 0.25, "compile.*": 0.5}
+
+    The most specific (longest) matching glob wins.  If both runs have
+    timings for sre the ponyguruma timings are divided by them, so that
+    results from different machines can be compared.  A slowdown is a
+    regression if it's above the threshold and larger than three times
+    the combined noise of both runs.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+from fnmatch import fnmatchcase
+
+
+DEFAULT_THRESHOLD = 0.25
+
+#: how many standard deviations a slowdown must be to be significant
+SIGNIFICANCE = 3.0
+
+ENGINE = 'ponyguruma'
+REFERENCE = 're'
+
+
+def get_threshold(thresholds, name):
+    """Return the tolerated slowdown for a benchmark."""
+    best = None
+    for pattern, value in thresholds.iteritems():
+        if fnmatchcase(name, pattern) and \
+           (best is None or len(pattern) > len(best)):
+            best = pattern
+    if best is None:
+        return DEFAULT_THRESHOLD
+    return thresholds[best]
+
+
+def _normalize(timings, normalized):
+    """
+    Return the value and relative noise of the timings of a benchmark.
+    """
+    own = timings[ENGINE]
+    value = own['median']
+    noise = (own['stddev'] / own['median']) ** 2
+    if normalized:
+        ref = timings[REFERENCE]
+        value /= ref['median']
+        noise += (ref['stddev'] / ref['median']) ** 2
+    return value, noise
+
+
+def compare(baseline, results):
+    """
+    Compare two results and return a list of ``(name, status, change,
+    threshold)`` tuples sorted by name.  The status is one of
+    ``'regression'``, ``'faster'``, ``'ok'``, ``'new'`` and
+    ``'missing'``, the change is the relative slowdown or `None`.
+    """
+    thresholds = baseline.get('thresholds', {})
+    old = baseline['benchmarks']
+    new = results['benchmarks']
+    report = []
+    for name in sorted(set(old) | set(new)):
+        threshold = get_threshold(thresholds, name)
+        if ENGINE not in old.get(name, ()):
+            if ENGINE in new.get(name, ()):
+                report.append((name, 'new', None, threshold))
+            continue
+        if ENGINE not in new.get(name, ()):
+            report.append((name, 'missing', None, threshold))
+            continue
+        normalized = REFERENCE in old[name] and REFERENCE in new[name]
+        old_value, old_noise = _normalize(old[name], normalized)
+        new_value, new_noise = _normalize(new[name], normalized)
+        change = new_value / old_value - 1
+        noise = (old_noise + new_noise) ** 0.5 * SIGNIFICANCE
+        if change > threshold and change > noise:
+            status = 'regression'
+        elif change < -threshold and -change > noise:
+            status = 'faster'
+        else:
+            status = 'ok'
+        report.append((name, status, change, threshold))
+    return report
+
+
+def has_regressions(report):
+    """True if a comparison report contains regressions."""
+    for name, status, change, threshold in report:
+        if status == 'regression':
+            return True
+    return False
+
+
+def format_report(report):
+    """Format a comparison report as table."""
+    lines = ['%-28s%12s%12s  %s' % ('benchmark', 'change', 'threshold',
+                                    'status')]
+    for name, status, change, threshold in report:
+        if change is None:
+            change = '-'
+        else:
+            change = '%+.1f%%' % (change * 100)
+        lines.append('%-28s%12s%11.0f%%  %s' % (name, change,
+                                                threshold * 100,
+                                                status.upper()))
+    regressions = len([x for x in report if x[1] == 'regression'])
+    lines.append('')
+    lines.append('%d benchmarks, %d regressions.' % (len(report),
+                                                     regressions))
+    return '\n'.join(lines)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.index
+    ~~~~~~~~~~~~~~~~
+
+    A persistent trigram index for searching large file trees, like
+    Google Code Search.  The index records which trigrams (sequences of
+    three bytes) appear in which files.  A search turns the required
+    literals of the pattern into a query for the files that contain all
+    of their trigrams and runs the regular expression on those files
+    only::
+
+        >>> index = build_index('/var/log/archive', 'archive.idx')
+        >>> for filename, match in index.search(r'error \d+ in foo'):
+        ...     print filename, match.group()
+
+    Patterns without required literals, for example ignorecase patterns,
+    are run on every file.  Files that changed since they were indexed
+    are always searched, `Index.update` indexes them again and picks up
+    new files.  Unicode patterns are matched against the decoded files
+    and their literals are looked up in the encoded form.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+import os
+import mmap
+import marshal
+from array import array
+from fnmatch import fnmatch
+
+from ponyguruma import Regexp
+
+
+INDEX_VERSION = 2
+
+#: files are read in blocks of this size while indexing
+BLOCK_SIZE = 1 << 20
+
+
+def get_trigrams(data):
+    """Return the set of trigrams in a string."""
+    return set([data[i:i + 3] for i in xrange(len(data) - 2)])
+
+
+def get_file_trigrams(filename):
+    """Return the set of trigrams in a file."""
+    result = set()
+    tail = ''
+    f = open(filename, 'rb')
+    try:
+        while 1:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            data = tail + block
+            result.update(get_trigrams(data))
+            tail = data[-2:]
+    finally:
+        f.close()
+    return result
+
+
+def get_query(regexp, encoding='utf-8'):
+    """
+    Return the set of trigrams every file with a match contains.  An
+    empty set means that every file has to be searched.
+    """
+    result = set()
+    for literal in regexp.required_literals:
+        if isinstance(literal, unicode):
+            literal = literal.encode(encoding)
+        result.update(get_trigrams(literal))
+    return result
+
+
+def _stat(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    # the full precision of the mtime catches files rewritten within
+    # a second
+    return st.st_mtime, st.st_size
+
+
+class Index(object):
+    """
+    A trigram index loaded from `filename`.  Use `build_index` to create
+    a new one.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            data = marshal.load(f)
+        finally:
+            f.close()
+        if data.get('version') != INDEX_VERSION:
+            raise ValueError('unsupported index version %r' %
+                             data.get('version'))
+        self.root = data['root']
+        self.include = data['include']
+        #: list of ``[path, mtime, size]`` or `None` for removed files
+        self.files = data['files']
+        self.postings = {}
+        for trigram, ids in data['postings'].iteritems():
+            self.postings[trigram] = array('i', ids)
+
+    def _add_file(self, path):
+        filename = os.path.join(self.root, path)
+        stat = _stat(filename)
+        if stat is None:
+            return
+        file_id = len(self.files)
+        for trigram in get_file_trigrams(filename):
+            self.postings.setdefault(trigram, array('i')).append(file_id)
+        self.files.append([path, stat[0], stat[1]])
+
+    def _walk(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if self.include and not [p for p in self.include
+                                         if fnmatch(name, p)]:
+                    continue
+                path = os.path.join(dirpath, name)
+                yield path[len(self.root):].lstrip(os.path.sep)
+
+    def update(self):
+        """
+        Index new and changed files and forget removed ones.  The index
+        is saved afterwards.
+        """
+        known = {}
+        for file_id, entry in enumerate(self.files):
+            if entry is None:
+                continue
+            path, mtime, size = entry
+            if _stat(os.path.join(self.root, path)) != (mtime, size):
+                self.files[file_id] = None
+            else:
+                known[path] = file_id
+        for path in self._walk():
+            if path not in known:
+                self._add_file(path)
+        self.save()
+
+    def save(self):
+        """
+        Write the index to its file.  Removed files are dropped from the
+        posting lists.
+        """
+        mapping = {}
+        files = []
+        for file_id, entry in enumerate(self.files):
+            if entry is not None:
+                mapping[file_id] = len(files)
+                files.append(entry)
+        postings = {}
+        for trigram, ids in self.postings.iteritems():
+            ids = array('i', [mapping[x] for x in ids if x in mapping])
+            if ids:
+                postings[trigram] = ids
+        self.files = files
+        self.postings = postings
+        data = {
+            'version':  INDEX_VERSION,
+            'root':     self.root,
+            'include':  self.include,
+            'files':    files,
+            'postings': dict([(trigram, ids.tostring()) for trigram, ids
+                              in postings.iteritems()])
+        }
+        # write a new file first so that a failure doesn't leave a broken
+        # index behind
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump(data, f)
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp, self.filename)
+
+    def candidates(self, regexp, encoding='utf-8'):
+        """
+        Return the paths, relative to the root, of the files that may
+        contain a match for `regexp`.  Changed files are always
+        candidates.
+        """
+        if not isinstance(regexp, Regexp):
+            regexp = Regexp(regexp)
+        query = get_query(regexp, encoding)
+        ids = None
+        if query:
+            # start with the rarest trigram to keep the sets small
+            for trigram in sorted(query, key=lambda t:
+                                  len(self.postings.get(t, ()))):
+                if trigram not in self.postings:
+                    ids = set()
+                    break
+                if ids is None:
+                    ids = set(self.postings[trigram])
+                else:
+                    ids.intersection_update(self.postings[trigram])
+                if not ids:
+                    break
+        result = []
+        for file_id, entry in enumerate(self.files):
+            if entry is None:
+                continue
+            path, mtime, size = entry
+            if ids is None or file_id in ids or \
+               _stat(os.path.join(self.root, path)) != (mtime, size):
+                result.append(path)
+        return result
+
+    def search(self, regexp, encoding='utf-8'):
+        """
+        Iterate over ``(path, match)`` for the matches in all indexed
+        files.  Files are decoded with `encoding` for unicode patterns,
+        byte patterns search a memory map of the file.
+        """
+        if not isinstance(regexp, Regexp):
+            regexp = Regexp(regexp)
+        for path in self.candidates(regexp, encoding):
+            try:
+                f = open(os.path.join(self.root, path), 'rb')
+            except IOError:
+                continue
+            try:
+                data = None
+                if not regexp.unicode_mode:
+                    try:
+                        if os.fstat(f.fileno()).st_size:
+                            data = mmap.mmap(f.fileno(), 0,
+                                             access=mmap.ACCESS_READ)
+                    except EnvironmentError:
+                        pass
+                # the map stays open as long as the matches refer to it
+                if data is None:
+                    data = f.read()
+            finally:
+                f.close()
+            if regexp.unicode_mode:
+                data = data.decode(encoding, 'replace')
+            for match in regexp.find(data):
+                yield path, match
+
+    def __repr__(self):
+        return '<%s %r: %d files, %d trigrams>' % (
+            self.__class__.__name__,
+            self.root,
+            len([x for x in self.files if x is not None]),
+            len(self.postings)
+        )
+
+
+def build_index(root, filename, include=None):
+    """
+    Index the files below `root` and write the index to `filename`.
+    `include` is an optional list of glob patterns for the file names
+    to index.
+    """
+    f = open(filename, 'wb')
+    try:
+        marshal.dump({
+            'version':  INDEX_VERSION,
+            'root':     os.path.abspath(root),
+            'include':  include and list(include) or [],
+            'files':    [],
+            'postings': {}
+        }, f)
+    finally:
+        f.close()
+    index = Index(filename)
+    index.update()
+    return index
@@ -33,11 +33,11 @@ class SRE_Pattern(Regexp):
         if rv is not None:
             return SRE_Match(rv)
 
-    def subn(self, repl, string, count=0, pos=0, endpos=-1):
+    def subn(self, repl, string, count=0, pos=0, endpos=-1, timeout=None):
         if callable(repl):
             def repl(m, r=repl):
                 return r(SRE_Match(m))
-        return Regexp.subn(self, repl, string, count, pos, endpos)
+        return Regexp.subn(self, repl, string, count, pos, endpos, timeout)
 
     def split(self, string, maxsplit=0, pos=0, endpos=-1):
         return Regexp.split(self, string, maxsplit, pos, endpos, True)
@@ -47,7 +47,8 @@ class SRE_Pattern(Regexp):
             yield SRE_Match(match)
 
     def findall(self, string, pos=0, endpos=-1):
-        return list(Regexp.findstrings(self, string, pos, endpos))
+        return [match.group() for match in
+                Regexp.find(self, string, pos, endpos)]
 
     def _missing(self):
         raise AttributeError("'%s' object has no attribute 'find'" %
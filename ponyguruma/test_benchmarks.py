@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.test_benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the benchmark runner and the baseline comparison.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+
+from ponyguruma.benchmarks import measure, median, stddev
+from ponyguruma.benchmarks.compare import compare, get_threshold, \
+     has_regressions
+
+errors = []
+runs = [0]
+
+def eq(result, expected, what):
+    runs[0] += 1
+    if result != expected:
+        errors.append("%s: expected %r, got %r" % (what, expected, result))
+
+
+def timings(own, ref=None, noise=0.0):
+    result = {'ponyguruma': {'median': own, 'stddev': own * noise}}
+    if ref is not None:
+        result['re'] = {'median': ref, 'stddev': ref * noise}
+    return result
+
+
+def test_statistics():
+    eq(median([3, 1, 2]), 2, 'odd median')
+    eq(median([4, 1, 2, 3]), 2.5, 'even median')
+    eq(round(stddev([2, 4, 4, 4, 5, 5, 7, 9]) ** 2, 9), round(32 / 7.0, 9),
+       'stddev')
+    eq(stddev([1]), 0.0, 'stddev of one value')
+    result = measure(lambda: None, repeats=3, warmup=0, min_time=0.001)
+    eq((result['repeats'], len(result)), (3, 6), 'measure')
+
+
+def test_compare():
+    baseline = {
+        'thresholds':   {'*': 0.2, 'compile.*': 0.5},
+        'benchmarks':   {
+            'compile.x':    timings(1.0),
+            'search.slow':  timings(1.0),
+            'search.noisy': timings(1.0, noise=0.5),
+            'search.fast':  timings(1.0),
+            'search.ratio': timings(1.0, 1.0),
+            'gone':         timings(1.0)
+        }
+    }
+    results = {
+        'benchmarks':   {
+            'compile.x':    timings(1.4),
+            'search.slow':  timings(1.5),
+            'search.noisy': timings(1.5, noise=0.5),
+            'search.fast':  timings(0.5),
+            'search.ratio': timings(3.0, 2.5),
+            'added':        timings(1.0)
+        }
+    }
+    report = dict([(name, status) for name, status, change, threshold
+                   in compare(baseline, results)])
+    eq(report, {'compile.x': 'ok', 'search.slow': 'regression',
+                'search.noisy': 'ok', 'search.fast': 'faster',
+                'search.ratio': 'ok', 'gone': 'missing', 'added': 'new'},
+       'comparison')
+    eq(has_regressions(compare(baseline, results)), True, 'regressions')
+    del results['benchmarks']['search.slow']
+    eq(has_regressions(compare(baseline, results)), False, 'no regressions')
+    eq(get_threshold({}, 'x'), 0.25, 'default threshold')
+    eq(get_threshold({'*': 0.1, 'x.*': 0.3}, 'x.y'), 0.3, 'threshold')
+
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_'):
+            func()
+
+    for entry in errors:
+        print entry
+    print
+    print "RESULTS:"
+    print "%d tests, %d failed." % (runs[0], len(errors))
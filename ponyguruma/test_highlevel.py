@@ -0,0 +1,742 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.test_highlevel
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the high level Regexp / Match interface.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+
+from ponyguruma import *
+from ponyguruma.constants import ENCODING_UTF8, ENCODING_EUC_JP
+
+errors = []
+runs = [0]
+
+def eq(result, expected, what):
+    runs[0] += 1
+    if result != expected:
+        errors.append("%s: expected %r, got %r" % (what, expected, result))
+
+def raises(exc, func, *args, **kwargs):
+    runs[0] += 1
+    try:
+        func(*args, **kwargs)
+    except exc:
+        return
+    except Exception, err:
+        errors.append("%s raised %r instead of %s" % (func.__name__, err,
+                                                       exc.__name__))
+    else:
+        errors.append("%s did not raise %s" % (func.__name__, exc.__name__))
+
+
+def test_conversion():
+    r = Regexp('a+')
+    eq([m.span() for m in r.find(u'baac aa')], [(1, 3), (5, 7)],
+       'find with unicode subject')
+    eq(r.sub('-', u'baac aa'), 'b-c -', 'sub with unicode subject')
+    eq(Regexp(u',').split('a,b,c'), [u'a', u'b', u'c'],
+       'split with byte subject')
+    eq(Regexp('(,)').split('a,b', flat=True), ['a', ',', 'b'], 'flat split')
+    eq(Regexp('(,)').split('a,b'), ['a', (',',), 'b'], 'split')
+
+    strict = Regexp(u'a+', strict=True)
+    eq(strict.strict, True, 'strict flag')
+    eq(strict.search(u'baa').span(), (1, 3), 'strict search')
+    raises(TypeError, strict.search, 'baa')
+    raises(TypeError, lambda: list(strict.find('baa')))
+    raises(TypeError, Regexp('a', strict=True).sub, 'b', u'a')
+    raises(TypeError, Regexp('a').search, 42)
+
+
+def test_escape():
+    from ponyguruma._highlevel import _special_escapes
+    def reference(pattern):
+        s = list(pattern)
+        for i, c in enumerate(s):
+            if not ('a' <= c <= 'z' or 'A' <= c <= 'Z' or '0' <= c <= '9'):
+                s[i] = _special_escapes.get(c, '\\' + c)
+        return type(pattern)().join(s)
+    data = ''.join(map(chr, range(256)))
+    eq(escape(data), reference(data), 'escape all bytes')
+    udata = data.decode('latin-1') + u'äöü日本語\U0001d11e'
+    eq(escape(udata), reference(udata), 'escape unicode')
+    eq(type(escape(u'a.b')), unicode, 'unicode result')
+    eq(escape(''), '', 'escape empty string')
+    eq(Regexp(escape(data)).match(data).span(), (0, 256), 'escaped match')
+    raises(TypeError, escape, 42)
+
+
+def test_literal():
+    eq(Regexp(escape('foo@bar.com (x)\n\b\0')).literal,
+       'foo@bar.com (x)\n\b\0', 'escaped literal')
+    eq(Regexp(u'äx').literal, u'äx', 'unicode literal')
+    eq(Regexp('a.b').literal, None, 'metacharacter')
+    eq(Regexp(r'\01').literal, None, 'octal escape')
+    eq(Regexp('ab', OPTION_IGNORECASE).literal, None, 'ignorecase')
+    eq(Regexp('ab', encoding=ENCODING_EUC_JP).literal, None, 'multibyte')
+
+    # the engine is used for the same pattern in a group
+    def span(match):
+        return match and match.span()
+    for pattern, subject in [('ab', 'xabaabab'), (u'öx', u'xöxööxx'),
+                             (u'\0\1', u'\1\0\0\1\0\1')]:
+        literal, engine = Regexp(pattern), Regexp('(?:%s)' % pattern)
+        eq(engine.literal, None, 'grouped literal')
+        for args in [(), (1,), (3,), (2, 5), (4, 4)]:
+            eq(span(literal.search(subject, *args)),
+               span(engine.search(subject, *args)),
+               'literal search %r' % (args,))
+            eq(span(literal.match(subject, *args)),
+               span(engine.match(subject, *args)),
+               'literal match %r' % (args,))
+        eq(map(span, literal.find(subject)), map(span, engine.find(subject)),
+           'literal find')
+        eq(literal.sub('-', subject), engine.sub('-', subject), 'literal sub')
+    r = Regexp(u'öb', encoding=ENCODING_UTF8)
+    eq(r.literal, u'öb', 'utf-8 literal')
+    eq(r.search(u'aööb', 1).span(), (2, 4), 'utf-8 literal search')
+    raises(MatchTimeout, Regexp('x').search, 'abx', timeout=0)
+
+
+def test_required_literals():
+    from ponyguruma.benchmarks.cases import COMPLEX
+    eq(Regexp(COMPLEX).required_literals, ('@',), 'email pattern')
+    eq(Regexp(r'foo\d+\.bar(baz)?x{0,2}y').required_literals,
+       ('.bar', 'foo', 'y'), 'required literals')
+    eq(Regexp(r'abc(d)abcd').required_literals, ('abcd',), 'substrings')
+    eq(Regexp(r'ab').required_literals, ('ab',), 'literal pattern')
+    eq(Regexp(u'äö?x').required_literals, (u'ä', u'x'), 'unicode literals')
+    eq(Regexp('x\xc3\xa4?y', encoding=ENCODING_UTF8).required_literals,
+       ('x', 'y'), 'multibyte quantifier')
+    for pattern in [r'a|b', r'(?i)ab', r'\Aab', r'ab\x41', r'(?<n>a)b\k<n>']:
+        eq(Regexp(pattern).required_literals, (), 'no literals in %r'
+           % pattern)
+
+    # inline options disable the prefilter
+    def span(match):
+        return match and match.span()
+    subjects = ['foo12.bar', 'xx foo1.barxxy', 'foo.bar y', 'y foo1.bar',
+                'foo1.bar.bary']
+    for pattern in [r'foo\d+\.bar(baz)?x{0,2}y', r'\d\.(bar)+y', r'o[^x]*y']:
+        filtered, engine = Regexp(pattern), Regexp('(?-i:%s)' % pattern)
+        eq(engine.required_literals, (), 'unfiltered pattern')
+        for subject in subjects:
+            for pos in 0, 3:
+                eq(span(filtered.search(subject, pos)),
+                   span(engine.search(subject, pos)),
+                   'prefiltered search %r' % subject)
+    r = Regexp(u'x\\w?ö', encoding=ENCODING_UTF8)
+    eq(r.search(u'ääxö').span(), (2, 4), 'utf-8 prefilter')
+
+    # quantifiers on quantifiers and {n}? which is optional in ruby
+    for syntax in SYNTAX_JAVA, SYNTAX_PERL, SYNTAX_PERL_NG, SYNTAX_RUBY, \
+                  SYNTAX_PYTHON:
+        for pattern in r'ab+??', r'ab++?', r'ab+*', r'ab{2}*', r'ab+{0}':
+            eq(span(Regexp(pattern, syntax=syntax).search('a')), (0, 1),
+               'quantified quantifier %r' % pattern)
+        eq(Regexp(r'ab*+c', syntax=syntax).required_literals, ('a', 'c'),
+           'possessive quantifier')
+    eq(span(Regexp(r'xa{2}?y').search('xy')), (0, 2), 'optional interval')
+    eq(Regexp(r'xa{2}?y').required_literals, ('x', 'y'),
+       'optional interval literals')
+    eq(Regexp(r'xa{2}?y', syntax=SYNTAX_JAVA).required_literals, ('xa', 'y'),
+       'lazy interval literals')
+    eq(span(Regexp(r'ab{2}+?', syntax=SYNTAX_JAVA).search('a')), (0, 1),
+       'possessive interval')
+
+    # quantifiers after comments apply to the atom before them
+    eq(Regexp(r'ab(?#note)?c').required_literals, ('a', 'c'),
+       'quantified comment')
+    eq(span(Regexp(r'ab(?#note)?c').search('xac')), (1, 3),
+       'quantified comment search')
+    eq(span(Regexp(r'xab(?#c)*').search('xa')), (0, 2),
+       'starred comment search')
+    eq(Regexp(r'ab(?#note)c').required_literals, ('abc',), 'comment')
+    eq(Regexp(r'ab+(?#note)?c').required_literals, (),
+       'quantifier on a quantifier after a comment')
+
+
+def test_lazy():
+    r = Regexp('(', lazy=True)
+    eq(r.compiled, False, 'not compiled')
+    raises(RegexpError, r.search, 'x')
+    raises(RegexpError, getattr, r, 'flags')
+    eq(r.compiled, False, 'still not compiled')
+    raises(TypeError, Regexp, 42, lazy=True)
+
+    r = Regexp(r'(\d+)x', OPTION_IGNORECASE, lazy=True)
+    eq(r.flags & OPTION_IGNORECASE, OPTION_IGNORECASE, 'lazy flags')
+    eq(r.compiled, True, 'compiled by flags')
+    r = Regexp(u'äb', encoding=ENCODING_UTF8, lazy=True)
+    eq(r.literal, u'äb', 'lazy literal')
+    r = Regexp(r'(\d+)x', lazy=True)
+    eq(r.search('a 12X 42x').group(1), '42', 'lazy search')
+    eq(r.compiled, True, 'compiled by search')
+    r = Regexp(r'\d+', lazy=True)
+    eq(r.prepare('a1').string, 'a1', 'lazy prepare')
+    eq(Regexp.factory(lazy=True)('b+').compiled, False, 'lazy factory')
+
+
+def test_interning():
+    from ponyguruma._lowlevel import get_program_stats
+    programs, users = get_program_stats()
+    a = Regexp(r'\d+intern')
+    b = Regexp(r'\d+intern')
+    c = Regexp(u'\\d+intern')
+    d = Regexp(r'\d+intern', OPTION_IGNORECASE)
+    eq(get_program_stats(), (programs + 3, users + 4), 'shared programs')
+    eq(b.search('x 42intern').span(), (2, 10), 'shared search')
+    del a
+    eq(b.search('x 42intern').span(), (2, 10), 'after release')
+    del b, c, d
+    eq(get_program_stats(), (programs, users), 'released programs')
+    lazy = Regexp(r'\d+intern', lazy=True)
+    eq(get_program_stats(), (programs, users), 'lazy programs')
+    del lazy
+
+    eq(Regexp('a+'), Regexp('a+'), 'equal')
+    eq(Regexp('a+') != Regexp('a+'), False, 'not unequal')
+    eq(Regexp('a+', lazy=True), Regexp('a+'), 'lazy equal')
+    for other in [Regexp('a'), Regexp(u'a+'), Regexp('a+', OPTION_IGNORECASE),
+                  Regexp('a+', encoding=ENCODING_EUC_JP),
+                  Regexp('a+', strict=True), 'a+']:
+        eq(Regexp('a+') == other, False, 'not equal to %r' % other)
+    eq(hash(Regexp(u'ä+')), hash(Regexp(u'ä+')), 'hash')
+    mapping = {Regexp('a+'): 1, Regexp('b+'): 2}
+    eq(mapping[Regexp('b+')], 2, 'dict key')
+
+
+def test_detach():
+    import sys
+    big = 'x' * 100000 + ' name=value; ' + 'y' * 1000
+    refs = sys.getrefcount(big)
+    r = Regexp(r'(?<=(x) )(?<key>\w+)=(?<value>\w+)(z)?')
+    m = r.search(big)
+    spans, groups = m.spans, m.groups
+    m = r.search(big)
+    eq(m.detach(), m, 'detach returns the match')
+    eq(sys.getrefcount(big), refs, 'string released')
+    eq(m.detached, True, 'detached')
+    eq(m.string, None, 'no string')
+    eq(m.spans, spans, 'spans')
+    eq(m.groups, groups, 'groups')
+    eq(m.groupdict, {'key': 'name', 'value': 'value'}, 'groupdict')
+    eq(m.expand(r'\g<value>=\2'), 'value=name', 'expand')
+    eq(m.state.__sizeof__() < 1000, True, 'small state')
+    eq(m.detach().spans, spans, 'detach twice')
+
+    u = Regexp(u'(ö+)(.)')
+    text = u'äöü' * 1000 + u'öö!'
+    eq(u.search(text, 3000, detached=True).span(2), (3002, 3003),
+       'unicode detached')
+    u8 = Regexp(u'(ö+)(.)', encoding=ENCODING_UTF8)
+    m = u8.search(text, 3000).detach()
+    eq((m.span(1), m.group(2)), ((3000, 3002), u'!'), 'utf-8 detached')
+    e = Regexp(u'(い)(.)'.encode('euc-jp'), encoding=ENCODING_EUC_JP)
+    m = e.match(u'あいう'.encode('euc-jp'), 2, detached=True)
+    eq((m.span(), m.char_span(2), m.group(2)),
+       ((2, 6), (2, 3), u'う'.encode('euc-jp')), 'multibyte detached')
+    eq([m.span() for m in Regexp(r'\d+').find('a1b22', detached=True)],
+       [(1, 2), (3, 5)], 'find detached')
+    eq(Regexp('(a)|(b)').search('xb').detach().groups, (None, 'b'),
+       'unmatched group')
+
+
+def test_buffers():
+    import mmap
+    import tempfile
+    r = Regexp(r'(?<key>\w+)=(\d+)?')
+    for subject in ('a key= b', bytearray('a key= b'),
+                    buffer('xa key= b', 1), memoryview('a key= b')):
+        what = type(subject).__name__
+        m = r.search(subject)
+        eq((m.span(), m.group('key')), ((2, 6), 'key'), what)
+        eq(m.group_view('key').tobytes(), 'key', what + ' view')
+        eq(m.group_view(2), None, what + ' unmatched view')
+        eq(r.sub(r'<\1>', subject), 'a <key> b', what + ' sub')
+        eq(r.split(subject), ['a ', ('key', None), ' b'], what + ' split')
+        eq(list(r.findspans(subject)), [((2, 6), (2, 5), (-1, -1))],
+           what + ' findspans')
+
+    data = bytearray('a key=1')
+    m = r.search(data)
+    view = m.group_view()
+    eq((view.tobytes(), view.readonly), ('key=1', True), 'bytearray view')
+    raises(BufferError, data.extend, 'x')
+    del view, m
+    data.extend('x')
+    m = r.search(data).detach()
+    eq(m.group_view(2).tobytes(), '1', 'detached view')
+
+    f = tempfile.TemporaryFile()
+    try:
+        f.write('spam ' * 1000 + 'eggs=42')
+        f.flush()
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = r.search(data, 4990).group_view(2)
+        eq(view.tobytes(), '42', 'mmap view')
+        m = r.search(data, 4990, timeout=Deadline(10))
+        eq(m.group(2), '42', 'mmap deadline')
+        del view
+        data.close()
+        eq(m.span(2), (5005, 5007), 'span of closed mmap')
+        raises(ValueError, m.group)
+        raises(ValueError, m.group_view)
+        raises(ValueError, m.detach)
+    finally:
+        f.close()
+
+    # an endpos past the end is the end of the subject
+    data = mmap.mmap(-1, 4096)
+    eq(Regexp('z').search(data, 0, 1 << 28), None, 'mmap endpos')
+    eq(Regexp('.+').search('ab', 0, 5).span(), (0, 2), 'endpos')
+    eq(Regexp(u'.+').search(u'äb', 0, 5).span(), (0, 2), 'unicode endpos')
+    eq(Regexp('.+').search('ab', 3, 5), None, 'pos past the end')
+
+    data = bytearray('a key=1')
+    m = r.search(buffer(data))
+    data.extend('x' * 100000)
+    raises(ValueError, m.group, 2)
+    data[7:] = ''
+    eq(m.group(2), '1', 'buffer of resized bytearray')
+
+    raises(TypeError, Regexp(u'b').search, bytearray('b'))
+    raises(TypeError, Regexp(u'b').search(u'b').group_view)
+
+
+def test_reverse():
+    r = Regexp(r'(?<!\d)(\d+)')
+    text = 'a1 b22 c333 d'
+    eq(r.rsearch(text).span(), (8, 11), 'rsearch')
+    eq(r.rsearch(text, 0, 7).group(), '22', 'endpos')
+    eq(r.rsearch(text, 9), None, 'pos')
+    eq(Regexp(r'\d+').rsearch(text).span(), (10, 11), 'starts last')
+    eq(r.rsearch(text, timeout=10).span(), (8, 11), 'timeout')
+    eq(r.rsearch(text, detached=True).detached, True, 'detached')
+    eq(Regexp('ERROR').rsearch('ERROR x ERROR y').span(), (8, 13),
+       'literal')
+    eq(Regexp('ERR(O)R').rsearch('ERROR x ERROR y', 0, 12).span(), (0, 5),
+       'exact string before the end')
+    eq(Regexp(r'\d\z').rsearch('1 2 3').span(), (4, 5), 'string end')
+    eq(Regexp(r'(?<=b)\d').rsearch('b1 a2').span(), (1, 2), 'lookbehind')
+    eq(Regexp(r'\d').rsearch('1 2', 1, 1), None, 'empty range')
+    big = 'x' * 100000 + ' 42 ' + 'y' * 10000
+    eq(r.rsearch(big).span(), (100001, 100003), 'long distance')
+    far = 'y' * 5000 + '1' + 'x' * 4100 + 'needle' + 'z' * 10
+    eq(Regexp(r'\d.{4100}needle').rsearch(far).span(), (5000, 9107),
+       'literal after the block')
+
+    eq([m.group() for m in r.rfind(text)], ['333', '22', '1'], 'rfind')
+    eq([m.span() for m in r.rfind(text, 2, 10)], [(8, 10), (4, 6)],
+       'rfind range')
+    eq([m.span() for m in Regexp('aa').rfind('aaaaa')], [(2, 4), (0, 2)],
+       'overlapping')
+    eq([m.span() for m in Regexp(r'\w+').rfind('baab ab')], [(5, 7), (0, 4)],
+       'unanchored')
+    eq([m.group() for m in Regexp(r'\w+').rfind('baab ab', 0, 6)],
+       ['a', 'baab'], 'unanchored with endpos')
+    words = [m.group() for m in Regexp(r'(?<!\w)\w+').rfind('word ' * 2000)]
+    eq((len(words), set(words)), (2000, set(['word'])), 'words in blocks')
+    dense = ' '.join([str(i) for i in xrange(3000)])
+    matches = [m.group() for m in r.rfind(dense)]
+    eq((len(matches), matches[0], matches[-1]), (3000, '2999', '0'),
+       'dense matches')
+    eq([m.group() for m in r.rfind(dense, timeout=10)], matches,
+       'dense matches with a timeout')
+    eq([m.span() for m in Regexp('x*').rfind('axx')],
+       [(3, 3), (1, 3), (0, 0)], 'empty matches')
+    eq([m.group() for m in Regexp('^E.*').rfind('E1\nx\nE2\n')],
+       ['E2', 'E1'], 'lines')
+    eq([m.span() for m in Regexp(u'(?<!ö)ö+').rfind(u'äöxöö')],
+       [(3, 5), (1, 2)], 'unicode')
+    eq([m.span() for m in Regexp(u'(?<!ö)ö+', encoding=ENCODING_UTF8)
+        .rfind(u'äöxöö')], [(3, 5), (1, 2)], 'utf-8')
+    e = Regexp(u'(い)'.encode('euc-jp'), encoding=ENCODING_EUC_JP)
+    text = u'いあい'.encode('euc-jp')
+    eq([m.span() for m in e.rfind(text)], [(4, 6), (0, 2)], 'multibyte')
+    eq(e.rsearch(text, 0, 5).span(), (0, 2), 'multibyte endpos')
+
+
+def test_grep():
+    import tempfile
+    r = Regexp(r'error (\d)')
+    text = 'error 1\ninfo\nerror 2 error 3\n\nwarn x\nerror 4'
+    eq([(n, s, e, m.group(1)) for n, s, e, m in r.grep_lines(text)],
+       [(1, 0, 7, '1'), (3, 13, 28, '2'), (6, 37, 44, '4')], 'grep')
+    eq(list(r.grep_lines(text, invert=True)),
+       [(2, 8, 12, None), (4, 29, 29, None), (5, 30, 36, None)], 'invert')
+    eq(r.grep_lines(text, count=True), 3, 'count')
+    eq(r.grep_lines(text, invert=True, count=True), 3, 'count inverted')
+    eq([n for n, s, e, m in r.grep_lines(bytearray(text))], [1, 3, 6],
+       'buffer')
+    eq([(n, m.group()) for n, s, e, m in
+        Regexp(r'o\s+\w').grep_lines('foo\nbar foo x\n')], [(2, 'o x')],
+       'match across a line end')
+    eq(list(Regexp(r'\n').grep_lines('a\nb\n')), [], 'newline')
+    eq([(n, m.span()) for n, s, e, m in Regexp('^').grep_lines('a\nb\n')],
+       [(1, (0, 0)), (2, (2, 2))], 'trailing newline')
+    eq(Regexp('x').grep_lines('a\n\nb\n', invert=True, count=True), 3,
+       'inverted trailing newline')
+    eq(Regexp('^').grep_lines('', count=True), 0, 'empty')
+    eq([(n, m.span()) for n, s, e, m in
+        Regexp(r'^\s*$').grep_lines('a\n\n  \nb\n')],
+       [(2, (2, 2)), (3, (3, 5))], 'empty line')
+    eq([n for n, s, e, m in Regexp(r'^\s*').grep_lines('a\n\n\nb')],
+       [1, 2, 3, 4], 'line start of empty lines')
+    eq(Regexp(r'^\s*$').grep_lines('a\n\n  \nb\n', count=True), 2,
+       'count empty lines')
+    eq([n for n, s, e, m in
+        Regexp(r'^\s*$').grep_lines('a\n\n  \nb\n', invert=True)], [1, 4],
+       'invert empty lines')
+    eq([n for n, s, e, m in Regexp(r'b\z').grep_lines('b\nb')], [2],
+       'buffer end')
+    eq([(n, s, e) for n, s, e, m in Regexp(u'ö').grep_lines(u'ä\nxö\nö')],
+       [(2, 2, 4), (3, 5, 6)], 'unicode')
+    eq([(n, s, e) for n, s, e, m in Regexp(u'ö', encoding=ENCODING_UTF8)
+        .grep_lines(u'ä\nxö\nö')], [(2, 2, 4), (3, 5, 6)], 'utf-8')
+
+    f = tempfile.TemporaryFile()
+    try:
+        f.write(text)
+        f.flush()
+        eq([n for n, s, e, m in r.grep_lines(f)], [1, 3, 6], 'file')
+        f.seek(0)
+        eq([n for n, s, e, m in Regexp(u'error').grep_lines(f)], [1, 3, 6],
+           'decoded file')
+    finally:
+        f.close()
+
+
+def test_memory():
+    import sys
+    before = memory_report()
+    r = Regexp(r'(\w+)@(\w+)memory')
+    report = memory_report()
+    eq(report['programs'], before['programs'] + 1, 'programs')
+    eq(report['regexps'], before['regexps'] + 1, 'regexps')
+    eq(report['regexp_bytes'] - before['regexp_bytes'],
+       type(r).__basicsize__, 'regexp bytes')
+    eq(sys.getsizeof(r) > sys.getsizeof(Regexp('x', lazy=True)), True,
+       'program in sizeof')
+    program = report['program_bytes'] - before['program_bytes']
+    eq(program > 0, True, 'program bytes')
+    shared = Regexp(r'(\w+)@(\w+)memory')
+    eq(r.__sizeof__(), type(r).__basicsize__ + program // 2,
+       'shared program')
+    eq(memory_report()['program_bytes'], report['program_bytes'],
+       'shared program bytes')
+
+    subject = r.prepare('x foo@barmemory ' * 100)
+    matches = [r.search(subject), r.search(subject, 5)]
+    report = memory_report()
+    eq(report['subjects'], before['subjects'] + 1, 'subjects')
+    eq(report['match_states'], before['match_states'] + 2, 'match states')
+    state = matches[0].state
+    eq(sys.getsizeof(state) > type(state).__basicsize__ + 6 * 4, True,
+       'region in sizeof')
+    eq(report['match_state_bytes'] - before['match_state_bytes'],
+       state.__sizeof__() * 2, 'match state bytes')
+    eq(report['total_bytes'], sum([value for key, value in report.items()
+                                   if key.endswith('_bytes') and
+                                   key != 'total_bytes']), 'total')
+
+    u = Regexp(u'ä(.)', encoding=ENCODING_UTF8)
+    text = u.prepare(u'xäbc' * 1000)
+    size = memory_report()['subject_bytes']
+    m = u.search(text, 3001)
+    eq(memory_report()['subject_bytes'] > size, True, 'offset index')
+    del subject, matches, state, m, u, text, r, shared
+    report = memory_report()
+    for key in 'programs', 'regexps', 'subjects', 'match_states', \
+               'program_bytes', 'regexp_bytes', 'subject_bytes', \
+               'match_state_bytes':
+        eq(report[key], before[key], 'released %s' % key)
+
+    set_memory_tracking(True)
+    try:
+        r = Regexp(r'[a-z]+(\d+)' * 20)
+    finally:
+        set_memory_tracking(False)
+    eq(memory_report()['measured_programs'] - before['measured_programs'],
+       int(sys.platform.startswith('linux')), 'measured programs')
+
+
+def test_compile_many():
+    patterns = [r'(\d+)-%d' % i for i in xrange(200)]
+    regexps = compile_many(patterns)
+    eq([r.pattern for r in regexps], patterns, 'order')
+    eq([r.compiled for r in regexps], [True] * 200, 'compiled')
+    eq(regexps[42].search('x 12-42').group(1), '12', 'search')
+    r = compile_many([('ab', OPTION_IGNORECASE), (u'ä', 0, ENCODING_UTF8),
+                      'x'], threads=1)
+    eq(r[0].search('xAB').span(), (1, 3), 'flags')
+    eq(r[1].utf8_mode, True, 'encoding')
+    eq(compile_many([]), [], 'no patterns')
+
+    try:
+        compile_many(['a', '(', 'b', ('c', 0, 0, 0, 0, 0, 0), u'[',
+                      (u'x', 0, ENCODING_EUC_JP)])
+    except CompileErrors, err:
+        eq([(index, pattern) for index, pattern, exc in err.errors],
+           [(1, '('), (3, 'c'), (4, u'['), (5, u'x')], 'all errors')
+        eq([exc.__class__ for index, pattern, exc in err.errors],
+           [RegexpError, TypeError, RegexpError, TypeError], 'error types')
+    else:
+        eq(None, CompileErrors, 'compile errors')
+
+    # threads that compile the same lazy regexp all get a working regexp
+    from threading import Thread
+    r = Regexp(r'(\w)' * 50, lazy=True)
+    results = []
+    def search():
+        results.append(r.search('-' + 'a' * 50).span())
+    threads = [Thread(target=search) for x in xrange(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    eq(results, [(1, 51)] * 8, 'concurrent compilation')
+
+
+def test_utf8_mode():
+    r = Regexp(u'(ö+)(x)?', encoding=ENCODING_UTF8)
+    eq(r.utf8_mode, True, 'utf8 flag')
+    eq(Regexp(u'ö').utf8_mode, False, 'utf8 flag')
+    m = r.search(u'aäöö b')
+    eq(m.spans, ((2, 4), (2, 4), (-1, -1)), 'utf-8 spans')
+    eq(m.group(1), u'öö', 'utf-8 group')
+    eq(m.string, u'aäöö b', 'utf-8 match string')
+    eq([m.span() for m in r.find(u'ööaäöxö')], [(0, 2), (4, 6), (6, 7)],
+       'utf-8 find')
+    eq(r.search(u'öaöö', 1).span(), (2, 4), 'utf-8 pos')
+    eq(r.search(u'öaöö', 1, 3).span(), (2, 3), 'utf-8 endpos')
+    eq(r.sub(u'<\\1>', u'äöäöö'), u'ä<ö>ä<öö>', 'utf-8 sub')
+    eq(Regexp(u'ä', encoding=ENCODING_UTF8).split(u'xäyäz'),
+       [u'x', u'y', u'z'], 'utf-8 split')
+    eq(r.search('abc'), None, 'utf-8 byte subject')
+    raises(TypeError, Regexp, u'a', encoding=ENCODING_EUC_JP)
+
+
+def test_char_offsets():
+    text = (u'äöü abc ' * 100 + u'xあy ') * 5
+    native = Regexp(u'\\w+')
+    utf8 = Regexp(u'\\w+', encoding=ENCODING_UTF8)
+    eq([m.span() for m in utf8.find(text)],
+       [m.span() for m in native.find(text)], 'utf-8 find on long subject')
+    subject = utf8.prepare(text)
+    for pos in (0, 1, 300, 801, 2000, len(text) - 4):
+        eq(utf8.search(subject, pos).span(), native.search(text, pos).span(),
+           'utf-8 search at %d' % pos)
+
+    for encoding, codec in ((ENCODING_UTF8, 'utf-8'),
+                            (ENCODING_EUC_JP, 'euc-jp')):
+        data = text.encode(codec)
+        r = Regexp(u'x(あ)y'.encode(codec), encoding=encoding)
+        subject = r.prepare(data)
+        matches = list(r.find(subject))
+        eq(len(matches), 5, '%s matches' % codec)
+        for m in matches:
+            start, end = m.span(1)
+            eq(m.char_span(1), (len(data[:start].decode(codec)),
+                                len(data[:end].decode(codec))),
+               '%s char span' % codec)
+        eq(r.search(subject).char_start(), 800, '%s char start' % codec)
+    eq(Regexp('b').search('abc').char_span(), (1, 2), 'single byte char span')
+
+
+def test_limits():
+    r = Regexp(r'(a|aa)+b')
+    # the b keeps the required literal prefilter from skipping the engine
+    subject = 'a' * 40 + 'cb'
+    eq(r.retry_limit, 0, 'default retry limit')
+    r.retry_limit = 1000
+    eq(r.retry_limit, 1000, 'retry limit')
+    raises(MatchLimitError, r.search, subject)
+    raises(MatchLimitError, r.sub, '', subject)
+    eq(r.search('aab').span(), (0, 3), 'match within retry limit')
+    r.retry_limit = None
+    eq(r.retry_limit, 0, 'reset retry limit')
+    raises(ValueError, setattr, r, 'retry_limit', -1)
+
+    default = get_retry_limit()
+    set_retry_limit(1000)
+    try:
+        eq(get_retry_limit(), 1000, 'global retry limit')
+        raises(MatchLimitError, Regexp(r'(a|aa)+b').match, subject)
+    finally:
+        set_retry_limit(default)
+
+    r = Regexp(r'(?:a|b)*c')
+    r.match_stack_limit = 100
+    raises(MatchLimitError, r.match, 'ab' * 1000)
+    eq(issubclass(MatchLimitError, RegexpError), True, 'error hierarchy')
+
+
+def test_deadlines():
+    import time, threading
+    r = Regexp(r'(?:a|b)*?x')
+    subject = 'ab' * 100000 + 'cx'
+    raises(MatchTimeout, r.search, subject, timeout=0)
+    raises(MatchTimeout, lambda: list(r.find(subject, timeout=0.05)))
+    eq(r.search(subject[:-2] + 'x', timeout=10).span(), (0, 200001),
+       'search within timeout')
+    eq(Regexp('x').sub('y', 'axbx', timeout=10), 'ayby', 'sub with timeout')
+    # searches that use up their retry budget continue with single
+    # attempts and searches with a bigger budget
+    text = 'lorem ipsum dolor ' * 20000 + 'x7'
+    eq(Regexp(r'\w+\d').search(text, timeout=Deadline()).span(),
+       (len(text) - 2, len(text)), 'search after the budget ran out')
+    eq(Regexp(r'.{30}needle\d+').search('z' * 50000 + 'needle42',
+                                        timeout=10).start(), 49970,
+       'literal far from the start')
+    deadline = Deadline()
+    eq(deadline.remaining, None, 'remaining without timeout')
+    threading.Timer(0.05, deadline.cancel).start()
+    start = time.time()
+    raises(MatchTimeout, r.search, subject, timeout=deadline)
+    eq(time.time() - start < 5, True, 'cancelled search returns early')
+    eq((deadline.cancelled, deadline.expired), (True, True), 'cancelled')
+    eq(Deadline(60).expired, False, 'expired')
+    eq(issubclass(MatchTimeout, MatchLimitError), True, 'error hierarchy')
+
+
+def test_stats():
+    r = Regexp('b+')
+    r.search('abbc')
+    eq(r.stats()['calls'], 0, 'no stats by default')
+    r.collect_stats = True
+    eq(r.search('abbc').span(), (1, 3), 'search with stats')
+    r.search('xyz')
+    eq([m.span() for m in r.find('bab')], [(0, 1), (2, 3)], 'find with stats')
+    stats = r.stats(reset=True)
+    eq((stats['calls'], stats['hits'], stats['misses']), (5, 3, 2),
+       'call counters')
+    eq(stats['bytes_scanned'], 4 + 3 + 3 + 2 + 0, 'bytes scanned')
+    eq(stats['engine_time'] >= 0, True, 'engine time')
+    eq(r.stats()['calls'], 0, 'reset stats')
+
+    other = Regexp(u'ö')
+    set_collect_stats(True)
+    try:
+        eq(get_collect_stats(), True, 'global stats flag')
+        other.search(u'aöb')
+        other.search(u'ab')
+    finally:
+        set_collect_stats(False)
+    other.search(u'ö')
+    snapshot = dict((id(regexp), stats)
+                    for regexp, stats in stats_snapshot())
+    eq(snapshot[id(other)]['calls'], 2, 'registry snapshot')
+    eq(snapshot[id(other)]['bytes_scanned'],
+       5 * len(u'\0'.encode('unicode_internal')), 'unicode bytes scanned')
+    eq(id(r) in snapshot, True, 'registered regexp')
+
+    # the references of short lived regexps don't pile up
+    import gc, weakref
+    def dead_references():
+        gc.collect()
+        return len([obj for obj in gc.get_objects()
+                    if type(obj) is weakref.ref and obj() is None])
+    before = dead_references()
+    for x in xrange(1000):
+        Regexp('c+').collect_stats = True
+    eq(dead_references() - before < 100, True, 'registry pruned')
+
+
+def test_slow_match_func():
+    import ponyguruma
+    reports = []
+    def report(*args):
+        reports.append(args)
+    r = Regexp(r'(a|aa)+b')
+    subject = 'a' * 28 + 'cb'
+    old_func = ponyguruma.slow_match_func
+    ponyguruma.slow_match_func = report
+    try:
+        r.search(subject)
+        eq(reports, [], 'no reports by default')
+        set_slow_match_threshold(0.005)
+        eq(get_slow_match_threshold(), 0.005, 'threshold')
+        r.search(subject, 2)
+        Regexp('x').search('axb')
+        set_slow_match_threshold(None)
+        r.search(subject)
+    finally:
+        ponyguruma.slow_match_func = old_func
+        set_slow_match_threshold(None)
+    eq(len(reports), 1, 'one slow match')
+    regexp, length, pos, endpos, elapsed = reports[0]
+    eq((regexp, length, pos, endpos), (r, 30, 2, 30), 'report arguments')
+    eq(elapsed >= 0.005, True, 'elapsed time')
+    eq(get_slow_match_threshold(), None, 'disabled threshold')
+    raises(ValueError, set_slow_match_threshold, -1)
+
+
+def test_profile():
+    from ponyguruma.benchmarks.cases import COMPLEX
+    r = Regexp(r'(a|aa)+b')
+    profile = r.profile('a' * 10)
+    eq(profile.match, None, 'profiled mismatch')
+    eq(profile.positions[0][0] in (1, 3), True, 'hot alternative')
+    eq(profile.backtracks > 100, True, 'backtracks')
+    eq(profile.steps >= profile.backtracks, True, 'steps')
+    eq(r.profile('xaab').match.span(), (1, 4), 'profiled match')
+    eq(r.profile('xaab', from_start=True).match, None, 'profiled anchor')
+
+    profile = Regexp(COMPLEX, OPTION_IGNORECASE).profile('foo@bar.com')
+    eq(profile.match.span(), (0, 11), 'complex pattern')
+    eq(len(profile.positions), 7, 'complex positions')
+    eq(Regexp(u'(?<=ö|x)(y|z)').profile(u'öz').match.span(), (1, 2),
+       'look-behind')
+    eq(Regexp(u'(?<n>ö)|x', encoding=ENCODING_UTF8).profile(u'aö').match
+       .group('n'), u'ö', 'utf-8 profile')
+
+
+def test_overhead():
+    from StringIO import StringIO
+    r = Regexp('b+')
+    get_overhead_histograms(reset=True)
+    r.search('abbc')
+    set_overhead_tracking(True)
+    try:
+        r.search('abbc')
+        r.match('abbc')
+        list(r.find('abbc'))
+        r.sub('-', 'abbc')
+        r.split('abbc')
+    finally:
+        set_overhead_tracking(False)
+    r.search('abbc')
+    histograms = get_overhead_histograms(reset=True)
+    # every match that is found is wrapped, the failed searches that
+    # end find, sub and split aren't
+    eq([(phase, calls) for phase, calls, total, buckets in histograms],
+       [('parse', 8), ('typecheck', 8), ('subject', 8), ('region', 8),
+        ('engine', 8), ('wrap', 4)], 'overhead phases')
+    eq([sum(buckets) for phase, calls, total, buckets in histograms],
+       [8, 8, 8, 8, 8, 4], 'histogram buckets')
+    eq(get_overhead_histograms()[0][1], 0, 'reset histograms')
+
+    set_overhead_tracking(True)
+    r.search('abbc')
+    set_overhead_tracking(False)
+    out = StringIO()
+    dump_overhead(out, reset=True)
+    eq(out.getvalue().splitlines()[1].split()[:2], ['parse', '1'],
+       'overhead dump')
+
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_'):
+            func()
+
+    for entry in errors:
+        print entry
+    print
+    print "RESULTS:"
+    print "%d tests, %d failed." % (runs[0], len(errors))
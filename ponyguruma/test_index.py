@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.test_index
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the trigram index.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+import os
+import shutil
+import tempfile
+
+from ponyguruma import Regexp, OPTION_IGNORECASE
+from ponyguruma.constants import ENCODING_UTF8
+from ponyguruma.index import Index, build_index, get_trigrams, get_query
+
+errors = []
+runs = [0]
+
+def eq(result, expected, what):
+    runs[0] += 1
+    if result != expected:
+        errors.append("%s: expected %r, got %r" % (what, expected, result))
+
+
+def write(root, path, data):
+    filename = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    f = open(filename, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def test_trigrams():
+    eq(get_trigrams('abcab'), set(['abc', 'bca', 'cab']), 'trigrams')
+    eq(get_trigrams('ab'), set(), 'short string')
+    eq(get_query(Regexp(r'foo\d+ba')), set(['foo']), 'query')
+    eq(get_query(Regexp(u'ä\\d+xy', encoding=ENCODING_UTF8)), set(),
+       'short literals')
+    eq(get_query(Regexp(u'äxy')), set(['\xc3\xa4x', '\xa4xy']),
+       'encoded query')
+    eq(get_query(Regexp('foo', OPTION_IGNORECASE)), set(), 'ignorecase')
+    eq(get_query(Regexp('abcd{2}?')), set(['abc']), 'optional interval')
+
+
+def test_index():
+    root = tempfile.mkdtemp()
+    try:
+        write(root, 'a.log', 'started\nerror 42 in foo\n')
+        write(root, 'b.log', 'started\nwarning 23 in bar\n')
+        write(root, 'sub/c.log', 'error 7 in bar\n')
+        write(root, 'sub/d.txt', 'error 1 in foo\n')
+        write(root, 'e.log', u'größe 3\n'.encode('utf-8'))
+        filename = os.path.join(root, 'index')
+        index = build_index(root, filename, ['*.log'])
+        eq(len(index.files), 4, 'indexed files')
+
+        index = Index(filename)
+        eq(index.candidates(r'error \d+ in foo'), ['a.log'], 'candidates')
+        eq(index.candidates(r'in bar'), ['b.log', os.path.join('sub',
+                                                                'c.log')],
+           'several candidates')
+        eq(index.candidates(r'nothing'), [], 'no candidates')
+        eq(len(index.candidates(r'\d+')), 4, 'pattern without literals')
+        eq(index.candidates(r'startedx{2}?'), ['a.log', 'b.log'],
+           'optional interval')
+        eq(len(index.candidates(r'in foox+*')), 4, 'quantified quantifier')
+        eq([(path, m.group()) for path, m in index.search(r'error \d+')],
+           [('a.log', 'error 42'), (os.path.join('sub', 'c.log'),
+                                    'error 7')], 'search')
+        eq([m.group(1) for path, m in index.search(u'öße (\\d)')], [u'3'],
+           'unicode search')
+        matches = list(index.search(r'error (\d+)'))
+        eq([m.group(1) for path, m in matches], ['42', '7'],
+           'matches after the search')
+
+        # changed files are searched until the index is updated
+        write(root, 'b.log', 'error 5 in foo and something longer\n')
+        eq(index.candidates(r'in foo'), ['a.log', 'b.log'], 'changed file')
+        write(root, 'f.log', 'error 6 in foo\n')
+        os.remove(os.path.join(root, 'a.log'))
+        index.update()
+        eq(Index(filename).candidates(r'in foo'), ['b.log', 'f.log'],
+           'updated index')
+        eq(len(Index(filename).files), 4, 'removed files')
+
+        # a file rewritten within the same second with the same size
+        path = os.path.join(root, 'f.log')
+        os.utime(path, (1000000000.25, 1000000000.25))
+        index.update()
+        write(root, 'f.log', 'error 6 in bar\n')
+        os.utime(path, (1000000000.75, 1000000000.75))
+        eq(Index(filename).candidates(r'in bar'),
+           [os.path.join('sub', 'c.log'), 'f.log'], 'rewritten file')
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_'):
+            func()
+
+    for entry in errors:
+        print entry
+    print
+    print "RESULTS:"
+    print "%d tests, %d failed." % (runs[0], len(errors))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.test_large
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for subjects beyond 2 GiB.  They use sparse files mapped into
+    memory, so they need a 64 bit python and a file system with sparse
+    files.  The searches start close to the data or use patterns with a
+    literal prefix as scanning gigabytes of zeros takes a while.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+import sys
+import mmap
+import tempfile
+
+from ponyguruma import Regexp
+
+errors = []
+runs = [0]
+
+GIB = 1 << 30
+
+def eq(result, expected, what):
+    runs[0] += 1
+    if result != expected:
+        errors.append("%s: expected %r, got %r" % (what, expected, result))
+
+
+def sparse_map(size, chunks):
+    """
+    Return a read only mmap of a sparse file with `size` bytes that
+    contains the ``(offset, data)`` `chunks`, or `None` if that isn't
+    possible on this system.
+    """
+    f = tempfile.TemporaryFile()
+    try:
+        for offset, data in chunks:
+            f.seek(offset)
+            f.write(data)
+        f.seek(size - 1)
+        f.write('\0')
+        f.flush()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, OverflowError, ValueError):
+        return None
+    finally:
+        f.close()
+
+
+def test_large_offsets():
+    data = sparse_map(2 * GIB + 4096, [(2 * GIB - 50, 'first=1\n'),
+                                       (2 * GIB + 99, '\nx key=42 y\n')])
+    if data is None:
+        return
+    r = Regexp(r'(?<=x )(?<key>\w+)=(\d+)')
+    start = 2 * GIB + 102
+    m = r.search(data, 2 * GIB)
+    eq(m.spans, ((start, start + 6), (start, start + 3),
+                 (start + 4, start + 6)), 'spans')
+    eq(m.char_spans, m.spans, 'char spans')
+    eq((m.start(), m.end('key')), (start, start + 3), 'start and end')
+    eq(m.group(), 'key=42', 'group')
+    eq(m.group_view(2).tobytes(), '42', 'group view')
+    eq(r.match(data, start).span(), (start, start + 6), 'match')
+    eq(r.match(data, start + 1), None, 'no match')
+    eq(r.search(data, start + 1), None, 'no search match')
+    eq(r.search(data, 2 * GIB, start + 4), None, 'endpos')
+
+    m = r.search(data, 2 * GIB).detach()
+    eq((m.spans[2], m.groups), ((start + 4, start + 6), ('key', '42')),
+       'detached')
+
+    eq(list(Regexp(r'\w+=(\d+)').findspans(data, 2 * GIB - 100,
+                                           2 * GIB + 200)),
+       [((2 * GIB - 50, 2 * GIB - 43), (2 * GIB - 44, 2 * GIB - 43)),
+        ((start, start + 6), (start + 4, start + 6))],
+       'findspans across 2 GiB')
+    eq(Regexp(r'^x').match(data, 2 * GIB + 100).span(),
+       (2 * GIB + 100, 2 * GIB + 101), 'line start at the search start')
+    eq(Regexp(r'\A').search(data, 2 * GIB), None, 'no string start')
+    eq(Regexp(r'y\n\0*\z').search(data, start).end(), 2 * GIB + 4096,
+       'string end')
+
+
+def test_windows():
+    # the match starts in the last part of the first window, the engine
+    # only sees it up to 2 GiB there
+    offset = 2 * GIB - 6
+    data = sparse_map(3 * GIB, [(offset, 'key=1234567890\n'),
+                                (3 * GIB - 100, 'key=5\n')])
+    if data is None:
+        return
+    r = Regexp(r'key=(\d+)')
+    eq(r.search(data).spans, ((offset, offset + 14), (offset + 4,
+                                                      offset + 14)),
+       'match at the end of a window')
+    eq(r.search(data, offset + 1).span(), (3 * GIB - 100, 3 * GIB - 95),
+       'second window')
+    eq(r.rsearch(data).span(), (3 * GIB - 100, 3 * GIB - 95),
+       'rsearch')
+    eq(r.rsearch(data, 0, 3 * GIB - 101).span(),
+       (offset, offset + 14), 'rsearch in an earlier window')
+    eq([m.start() for m in r.rfind(data, 2 * GIB - 100)],
+       [3 * GIB - 100, offset], 'rfind')
+    eq(r.sub('-', data[offset - 10:offset + 20]),
+       '\0' * 10 + '-\n' + '\0' * 5, 'small subject')
+
+
+if __name__ == '__main__':
+    if sys.maxsize > 1 << 32:
+        for name, func in sorted(globals().items()):
+            if name.startswith('test_'):
+                func()
+
+    for entry in errors:
+        print entry
+    print
+    print "RESULTS:"
+    print "%d tests, %d failed." % (runs[0], len(errors))
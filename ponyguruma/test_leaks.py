@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    ponyguruma.test_leaks
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Leak tests for the hot paths.  Every public API is called in a loop
+    and the number of live objects, the objects counted by
+    `memory_report`, the reference counts of the objects involved and,
+    if available, the memory seen by `tracemalloc` and
+    ``sys.gettotalrefcount`` (debug builds) must not grow.
+
+    :copyright: Copyright 2007 by Armin Ronacher, Georg Brandl.
+    :license: BSD.
+"""
+import gc
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from ponyguruma import *
+from ponyguruma import sre
+from ponyguruma.constants import ENCODING_UTF8
+
+errors = []
+runs = [0]
+
+#: net memory blocks per call for every checked api, filled by `leaks`
+allocations = {}
+
+WARMUP = 20
+LOOPS = 500
+TOLERANCE = 5
+
+def eq(result, expected, what):
+    runs[0] += 1
+    if result != expected:
+        errors.append("%s: expected %r, got %r" % (what, expected, result))
+
+
+def _measure(watched):
+    gc.collect()
+    rv = {
+        'objects':  len(gc.get_objects()),
+        'refcounts': [sys.getrefcount(obj) for obj in watched]
+    }
+    if hasattr(sys, 'gettotalrefcount'):
+        rv['total refcount'] = sys.gettotalrefcount()
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        rv['memory blocks'] = sum([stat.count for stat in
+                                   tracemalloc.take_snapshot().statistics(
+                                       'filename')])
+    report = memory_report()
+    rv['live ponyguruma objects'] = report['regexps'] + \
+        report['subjects'] + report['match_states']
+    return rv
+
+
+def leaks(what, func, *watched):
+    """
+    Call `func` a few times as warmup and then `LOOPS` times and check
+    that nothing grows.  `watched` are objects like the regexp, the
+    subject and group names whose reference counts must not change.
+    The small integers are always watched because spans and group
+    numbers are built from them.
+    """
+    watched = watched + tuple(range(10))
+    for x in xrange(WARMUP):
+        func()
+    before = _measure(watched)
+    for x in xrange(LOOPS):
+        func()
+    after = _measure(watched)
+    # the measurement itself allocates a few objects and references
+    # some small integers, so allow a little noise that is independent
+    # of the number of calls.  a leak of one object per call in a rarely
+    # used path still shows up as growth by LOOPS
+    for key in before:
+        if key == 'refcounts':
+            growth = max([a - b for a, b in zip(after[key], before[key])])
+        else:
+            growth = after[key] - before[key]
+        if key == 'memory blocks':
+            allocations[what] = growth / float(LOOPS)
+        runs[0] += 1
+        if growth > TOLERANCE:
+            errors.append('%s: %s grew by %d in %d calls' %
+                          (what, key, growth, LOOPS))
+
+
+def test_matching():
+    r = Regexp(r'(?<word>\w+)@(?<host>\w+)')
+    subject = 'mail foo@example now'
+    leaks('search', lambda: r.search(subject), r, subject)
+    leaks('match', lambda: r.match(subject, 5), r, subject)
+    leaks('search miss', lambda: r.search('nothing'), r)
+    leaks('group', lambda: r.search(subject).group('host'), r, subject)
+    leaks('groupdict', lambda: r.search(subject).groupdict, r, subject,
+          'word', 'host')
+    leaks('groupnames', lambda: r.search(subject).groupnames, r, subject,
+          'word', 'host')
+    leaks('spans', lambda: r.search(subject).spans, r, subject)
+    leaks('detach', lambda: r.search(subject).detach().groupdict, r,
+          subject, 'word', 'host')
+    leaks('limits', lambda: r.search(subject, timeout=10), r, subject)
+    leaks('group view', lambda: r.search(subject).group_view(2).tobytes(),
+          r, subject)
+    data = bytearray(subject)
+    leaks('bytearray', lambda: r.search(data).group_view(1), r, data)
+
+    u = Regexp(u'(?<wörd>ä+)')
+    usubject = u'xää y'
+    leaks('unicode groupdict', lambda: u.search(usubject).groupdict, u,
+          usubject)
+    utf8 = Regexp(u'(?<wörd>ä+)', encoding=ENCODING_UTF8)
+    leaks('utf-8 groupdict', lambda: utf8.search(usubject).groupdict, utf8,
+          usubject)
+    leaks('utf-8 char spans', lambda: utf8.search(usubject).char_spans,
+          utf8, usubject)
+
+
+def test_iteration():
+    r = Regexp(r'(\d+)')
+    subject = 'a 1 b 22 c 333 ' * 10
+    leaks('find', lambda: list(r.find(subject)), r, subject)
+    leaks('findstrings', lambda: list(r.findstrings(subject)), r, subject)
+    leaks('findspans', lambda: list(r.findspans(subject)), r, subject)
+    leaks('rsearch', lambda: r.rsearch(subject), r, subject)
+    leaks('rfind', lambda: list(r.rfind(subject)), r, subject)
+    lines = subject.replace(' c', '\nc')
+    leaks('grep lines', lambda: list(r.grep_lines(lines)), r, lines)
+    leaks('grep inverted', lambda: r.grep_lines(lines, True, True), r,
+          lines)
+    leaks('sub', lambda: r.sub(r'<\1>', subject), r, subject)
+    leaks('sub callable', lambda: r.sub(lambda m: m.group(1), subject), r,
+          subject)
+    leaks('split', lambda: Regexp(r'\s+').split(subject), subject)
+    leaks('split groups', lambda: r.split(subject), r, subject)
+    leaks('compile', lambda: Regexp(r'(?<a>x)|y'))
+    shared = Regexp(r'(?<a>x)|y')
+    leaks('compile shared', lambda: Regexp(r'(?<a>x)|y'), shared)
+    leaks('hash', lambda: {shared: shared}, shared)
+
+    def compile_error():
+        try:
+            Regexp('(')
+        except RegexpError:
+            pass
+    leaks('compile error', compile_error)
+
+    def compile_many_errors():
+        try:
+            compile_many([r'\d+', '(', 'x'])
+        except CompileErrors:
+            pass
+    leaks('compile many', lambda: compile_many([r'\d+', 'x']))
+    leaks('compile many errors', compile_many_errors)
+
+
+def test_scanner():
+    subject = 'foo = 42 + bar * 3'
+    rules = [r'\s+', r'\d+', r'\w+', r'[=+*]']
+    def scan():
+        scanner = Scanner(subject)
+        while not scanner.eos:
+            for rule in rules:
+                if scanner.scan(rule) is not None:
+                    break
+    leaks('scanner', scan, subject, *rules)
+
+
+def test_sre():
+    subject = 'spam 12 eggs 3'
+    pattern = r'(\d+)'
+    compiled = sre.compile(pattern)
+    leaks('sre search', lambda: sre.search(pattern, subject), subject,
+          pattern)
+    leaks('sre sub', lambda: sre.sub(pattern, '#', subject), subject,
+          pattern)
+    leaks('sre split', lambda: sre.split(pattern, subject), subject,
+          pattern)
+    leaks('sre finditer', lambda: list(sre.finditer(pattern, subject)),
+          subject, pattern)
+    leaks('sre findall', lambda: compiled.findall(subject), compiled,
+          subject)
+    leaks('sre groups', lambda: compiled.search(subject).groups(), compiled,
+          subject)
+
+
+if __name__ == '__main__':
+    if tracemalloc is not None:
+        tracemalloc.start()
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_'):
+            func()
+    if tracemalloc is not None:
+        tracemalloc.stop()
+
+    if allocations:
+        print "memory blocks per call:"
+        for what, blocks in sorted(allocations.items()):
+            print "  %-20s %.3f" % (what, blocks)
+        print
+    for entry in errors:
+        print entry
+    print
+    print "RESULTS:"
+    print "%d tests, %d failed." % (runs[0], len(errors))
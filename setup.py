@@ -1,7 +1,8 @@
 from distutils.core import setup, Extension
 setup(
     name="ponyguruma",
-    packages=['ponyguruma'],
+    packages=['ponyguruma', 'ponyguruma.benchmarks'],
+    package_data={'ponyguruma.benchmarks': ['baseline.json']},
     ext_modules=[
         Extension("ponyguruma._lowlevel", ['ponyguruma/_lowlevel.c'],
                   library_dirs=['/usr/local/lib'],